@@ -0,0 +1,146 @@
+import json
+import os
+from pathlib import Path
+from typing import Union
+
+import mne
+from mne.parallel import parallel_func
+import numpy as np
+from sklearn.model_selection import BaseCrossValidator
+
+from .linear import fit_linear, score_decision
+from .time_resolved import Splits, get_data, get_labels, get_splits
+from ..utils.cache import hash_params
+from ..utils.logging import setup_logging
+
+logger = setup_logging(name="generalization", level="info", mne_level="info")
+
+
+########################################################################################################################
+# Temporal generalization                                                                                              #
+#                                                                                                                      #
+# Work is split into units of (fold, block of training times). The models of a block are fitted once (see `linear.py`) #
+# and applied to a block of test times with one matrix product, (n_test * test times, features) @ (features, training  #
+# times * outputs), so the cost grows with the size of the matrix and not with the number of cells.                    #
+#                                                                                                                      #
+# Scores are written to `scores.npy` (memory map, n_folds x n_train_times x n_test_times) as soon as a unit is done,   #
+# `done.npy` marks the finished units, so that an interrupted run continues with the remaining units. `gat.json` holds #
+# the parameters, results with other parameters are not continued.                                                     #
+########################################################################################################################
+
+
+SCORES_FILE = "scores.npy"
+DONE_FILE = "done.npy"
+META_FILE = "gat.json"
+
+
+def decode_generalization(X: Union[np.ndarray, str, Path, mne.BaseEpochs], y: np.ndarray, out_dir: Union[str, Path],
+                          model: str = "lda", alpha: Union[None, str, float] = None, scoring: str = "roc_auc",
+                          cv: Union[int, BaseCrossValidator, Splits] = 5, groups: Union[None, np.ndarray] = None,
+                          train_chunk: int = 16, test_chunk: int = 64, n_jobs: int = 1,
+                          random_state: Union[None, int] = 0, overwrite: bool = False) -> np.ndarray:
+    """
+    Cross-validated temporal generalization, models trained at each time point are tested at all time points
+    :param X: array (n_epochs, n_features, n_times) (may be memory-mapped), epochs or directory of memory-mapped
+        epochs or source estimates
+    :param y: labels (n_epochs,)
+    :param out_dir: directory to write the scores to, continued if it contains an unfinished run with the same
+        parameters (the data are assumed to be the same)
+    :param model: 'lda', 'ridge' or 'logistic' (see `linear.py`)
+    :param alpha: regularization of the model, None for its default
+    :param scoring: 'accuracy' or 'roc_auc' (two classes)
+    :param cv: number of stratified folds, scikit-learn splitter or list of (train, test) indices
+    :param groups: groups for the splitter
+    :param train_chunk: number of training times fitted at once (one unit of work)
+    :param test_chunk: number of test times scored at once
+    :param n_jobs: number of units run in parallel
+    :param random_state: seed of the shuffling of stratified folds
+    :param overwrite: whether to discard results with other parameters in `out_dir` instead of raising an error
+    :return:
+        read-only memory map of the scores (n_folds, n_train_times, n_test_times)
+    """
+
+    data = get_data(X)
+    _, labels = get_labels(y)
+    if len(labels) != len(data):
+        raise ValueError(f"Got {len(labels)} labels for {len(data)} epochs")
+
+    splits = get_splits(labels, cv, groups, random_state)
+    n_times = data.shape[2]
+    starts = list(range(0, n_times, int(train_chunk)))
+
+    params = {"model": model, "alpha": alpha, "scoring": scoring, "shape": list(data.shape),
+              "train_chunk": int(train_chunk), "key": hash_params(labels.tolist(),
+                                                                  [(train.tolist(), test.tolist())
+                                                                   for train, test in splits])}
+    out_dir = Path(out_dir)
+    done = _open_results(out_dir, params, len(splits), n_times, len(starts), overwrite)
+
+    units = [(fold, block) for fold in range(len(splits)) for block in range(len(starts)) if not done[fold, block]]
+    if len(units) < done.size:
+        logger.info(f"Continuing temporal generalization in {out_dir}, {len(units)} of {done.size} units left")
+    del done
+
+    parallel, run, _ = parallel_func(_score_unit, n_jobs, verbose=False)
+    parallel(run(data, labels, splits[fold], out_dir, fold, block, starts[block], int(train_chunk), int(test_chunk),
+                 model, alpha, scoring) for fold, block in units)
+
+    scores = np.load(out_dir / SCORES_FILE, mmap_mode="r")
+    logger.info(f"Temporal generalization of {n_times} time points with {len(splits)} folds ({model}) in {out_dir}")
+
+    return scores
+
+
+def _open_results(out_dir: Path, params: dict, n_folds: int, n_times: int, n_blocks: int,
+                  overwrite: bool) -> np.ndarray:
+    """ Finished units of existing results with the same parameters, new empty results otherwise """
+
+    if (out_dir / META_FILE).exists():
+        with open(out_dir / META_FILE) as f:
+            existing = json.load(f)
+        if existing == params:
+            return np.load(out_dir / DONE_FILE)
+        if not overwrite:
+            raise ValueError(f"{out_dir} contains temporal generalization results with other parameters")
+        os.remove(out_dir / META_FILE)
+
+    if not out_dir.exists():
+        os.makedirs(out_dir)
+
+    # Parameters last, results are only continued once they were completely created
+    np.lib.format.open_memmap(out_dir / SCORES_FILE, mode="w+", dtype=np.float64,
+                              shape=(int(n_folds), int(n_times), int(n_times))).flush()
+    np.lib.format.open_memmap(out_dir / DONE_FILE, mode="w+", dtype=bool, shape=(int(n_folds), int(n_blocks))).flush()
+    with open(out_dir / META_FILE, "w") as f:
+        json.dump(params, f)
+
+    return np.zeros((n_folds, n_blocks), dtype=bool)
+
+
+def _score_unit(data: np.ndarray, labels: np.ndarray, split: tuple, out_dir: Path, fold: int, block: int, start: int,
+                train_chunk: int, test_chunk: int, model: str, alpha: Union[None, str, float], scoring: str):
+    """ Fit the models of a block of training times and score them at all test times, written to disk when done """
+
+    train, test = split
+    train_times = slice(start, start + train_chunk)
+
+    coef, intercept = fit_linear(data[train, :, train_times], labels[train], model, alpha)
+    n_train_times, n_features, n_outputs = coef.shape
+    weights = coef.transpose(1, 0, 2).reshape(n_features, n_train_times * n_outputs)
+
+    scores = np.empty((n_train_times, data.shape[2]))
+    for test_start in range(0, data.shape[2], test_chunk):
+        test_times = slice(test_start, test_start + test_chunk)
+        test_data = np.asarray(data[test, :, test_times], dtype=np.float64).transpose(0, 2, 1)
+
+        # (n_test, test times, training times, outputs) with one product
+        decision = (test_data @ weights).reshape(test_data.shape[:2] + (n_train_times, n_outputs)) + intercept
+        scores[:, test_times] = score_decision(labels[test], decision, scoring).T
+
+    results = np.load(out_dir / SCORES_FILE, mmap_mode="r+")
+    results[fold, train_times] = scores
+    results.flush()
+
+    done = np.load(out_dir / DONE_FILE, mmap_mode="r+")
+    done[fold, block] = True
+    done.flush()
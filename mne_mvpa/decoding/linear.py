@@ -0,0 +1,248 @@
+from typing import Tuple, Union
+
+import numpy as np
+import scipy.special
+import scipy.stats
+
+
+########################################################################################################################
+# Batched linear models                                                                                                #
+#                                                                                                                      #
+# Models are fitted for all time points at once: data of shape (n_epochs, n_features, n_times) is transposed to        #
+# (n_times, n_epochs, n_features) and the normal equations of all time points are solved as one stack with BLAS.       #
+# Features are standardized with the training data, the scaling is folded into the returned coefficients so that the   #
+# decision function is `X @ coef + intercept` on the original data (also for other time points, e.g. temporal          #
+# generalization).                                                                                                     #
+#                                                                                                                      #
+# 'lda': shrinkage LDA, same as scikit-learn's `LinearDiscriminantAnalysis(solver="lsqr")` after `StandardScaler`      #
+# 'ridge': ridge classifier (targets -1/1), same as `RidgeClassifier` after `StandardScaler`, solved in the dual when  #
+#     there are more features than epochs (e.g. source spaces)                                                         #
+# 'logistic': binary L2 logistic regression (alpha = 1 / C) solved with Newton's method                                #
+########################################################################################################################
+
+
+MODELS = ["lda", "ridge", "logistic"]
+DEFAULT_ALPHA = {"lda": "auto", "ridge": 1.0, "logistic": 1.0}
+SCORINGS = ["accuracy", "roc_auc"]
+
+
+def fit_linear(X: np.ndarray, y: np.ndarray, model: str = "lda",
+               alpha: Union[None, str, float] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit a linear classifier at each time point
+    :param X: training data (n_epochs, n_features, n_times)
+    :param y: class indices (n_epochs,), 0 to n_classes - 1
+    :param model: 'lda', 'ridge' or 'logistic'
+    :param alpha: regularization, None for the default of the model. 'lda': shrinkage in [0, 1] or 'auto'
+        (Ledoit-Wolf), 'ridge': penalty, 'logistic': inverse of C
+    :return:
+        coef: (n_times, n_features, n_outputs), n_outputs is 1 for two classes and n_classes otherwise
+        intercept: (n_times, n_outputs)
+    """
+
+    if model not in MODELS:
+        raise ValueError(f"Unknown model {model}")
+    if alpha is None:
+        alpha = DEFAULT_ALPHA[model]
+
+    y = np.asarray(y)
+    n_classes = int(y.max()) + 1
+    if n_classes < 2:
+        raise ValueError(f"At least 2 classes are needed, got {n_classes}")
+    if model == "logistic" and n_classes > 2:
+        raise ValueError(f"The logistic model is binary, got {n_classes} classes")
+
+    # Standardized (n_times, n_epochs, n_features)
+    data = np.asarray(X, dtype=np.float64).transpose(2, 0, 1)
+    mean = data.mean(axis=1, keepdims=True)
+    std = data.std(axis=1, keepdims=True)
+    std[std == 0] = 1.0
+    data = (data - mean) / std
+
+    if model == "lda":
+        coef, intercept = _fit_lda(data, y, n_classes, alpha)
+    elif model == "ridge":
+        coef, intercept = _fit_ridge(data, y, n_classes, alpha)
+    else:
+        coef, intercept = _fit_logistic(data, y, alpha)
+
+    # Back to the original scale
+    coef /= std.transpose(0, 2, 1)
+    intercept -= np.einsum("tp,tpk->tk", mean[:, 0], coef)
+
+    return coef, intercept
+
+
+def decision_function(X: np.ndarray, coef: np.ndarray, intercept: np.ndarray) -> np.ndarray:
+    """
+    Decision values of the data of each time point with the model of the same time point
+    :param X: data (n_epochs, n_features, n_times)
+    :param coef: (n_times, n_features, n_outputs)
+    :param intercept: (n_times, n_outputs)
+    :return:
+        (n_epochs, n_times, n_outputs)
+    """
+
+    decision = np.asarray(X, dtype=np.float64).transpose(2, 0, 1) @ coef + intercept[:, np.newaxis]
+
+    return decision.transpose(1, 0, 2)
+
+
+def score_decision(y: np.ndarray, decision: np.ndarray, scoring: str = "roc_auc") -> np.ndarray:
+    """
+    Score decision values of any number of leading dimensions (e.g. times, or train and test times)
+    :param y: class indices (n_epochs,), or (n_epochs, ...) broadcastable to the decision values without outputs (e.g.
+        permuted labels)
+    :param decision: (n_epochs, ..., n_outputs)
+    :param scoring: 'accuracy' or 'roc_auc' (two classes only)
+    :return:
+        scores (...)
+    """
+
+    if scoring not in SCORINGS:
+        raise ValueError(f"Unknown scoring {scoring}")
+
+    y = np.asarray(y)
+    if y.ndim == 1:
+        y = y.reshape((-1,) + (1,) * (decision.ndim - 2))
+
+    if scoring == "accuracy":
+        predicted = (decision[..., 0] > 0).astype(int) if decision.shape[-1] == 1 else decision.argmax(axis=-1)
+        return (predicted == y).mean(axis=0)
+
+    if decision.shape[-1] != 1:
+        raise ValueError("roc_auc is only supported for two classes")
+
+    # Mann-Whitney U statistic of the ranks
+    ranks = scipy.stats.rankdata(decision[..., 0], axis=0)
+    positive = y == 1
+    n_positive = positive.sum(axis=0)
+    n_negative = len(y) - n_positive
+
+    return ((ranks * positive).sum(axis=0) - n_positive * (n_positive + 1) / 2) / (n_positive * n_negative)
+
+
+def _fit_lda(data: np.ndarray, y: np.ndarray, n_classes: int,
+             shrinkage: Union[str, float]) -> Tuple[np.ndarray, np.ndarray]:
+    """ Shrinkage LDA, class-weighted within-class covariance """
+
+    n_times, n_epochs, n_features = data.shape
+    priors = np.bincount(y, minlength=n_classes) / n_epochs
+    means = np.stack([data[:, y == k].mean(axis=1) for k in range(n_classes)], axis=2)  # (n_times, n_features, K)
+
+    cov = np.zeros((n_times, n_features, n_features))
+    for k in range(n_classes):
+        centered = data[:, y == k] - means[:, np.newaxis, :, k]
+        cov += priors[k] * _shrunk_cov(centered, shrinkage)
+
+    coef = np.linalg.solve(cov, means)
+    intercept = -0.5 * np.einsum("tpk,tpk->tk", means, coef) + np.log(priors)
+
+    if n_classes == 2:
+        coef, intercept = coef[..., 1:] - coef[..., :1], intercept[:, 1:] - intercept[:, :1]
+
+    return coef, intercept
+
+
+def _shrunk_cov(centered: np.ndarray, shrinkage: Union[str, float]) -> np.ndarray:
+    """
+    Covariance of centered data (n_times, n_epochs, n_features), shrunk towards a scaled identity. 'auto' is
+    Ledoit-Wolf of the standardized data (as scikit-learn)
+    """
+
+    n_epochs, n_features = centered.shape[1:]
+
+    if shrinkage == "auto":
+        scale = centered.std(axis=1)
+        scale[scale == 0] = 1.0
+        standardized = centered / scale[:, np.newaxis]
+        cov = np.swapaxes(standardized, 1, 2) @ standardized / n_epochs
+
+        # Ledoit-Wolf shrinkage (see `sklearn.covariance.ledoit_wolf_shrinkage`)
+        trace = np.einsum("tii->ti", cov)
+        mu = trace.sum(axis=1) / n_features
+        beta_ = ((standardized ** 2).sum(axis=2) ** 2).sum(axis=1)
+        delta_ = (cov ** 2).sum(axis=(1, 2))
+        beta = (beta_ / n_epochs - delta_) / (n_features * n_epochs)
+        delta = (delta_ - 2 * mu * trace.sum(axis=1) + n_features * mu ** 2) / n_features
+        beta = np.minimum(beta, delta)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            shrinkage = np.where(beta == 0, 0.0, beta / delta)
+
+        cov = _shrink(cov, shrinkage, mu)
+
+        return scale[:, :, np.newaxis] * cov * scale[:, np.newaxis, :]
+
+    shrinkage = float(shrinkage)
+    if not 0.0 <= shrinkage <= 1.0:
+        raise ValueError(f"Shrinkage should be in [0, 1], got {shrinkage}")
+
+    cov = np.swapaxes(centered, 1, 2) @ centered / n_epochs
+
+    return _shrink(cov, np.full(len(cov), shrinkage), np.einsum("tii->t", cov) / n_features)
+
+
+def _shrink(cov: np.ndarray, shrinkage: np.ndarray, mu: np.ndarray) -> np.ndarray:
+    """ (1 - shrinkage) * cov + shrinkage * mu * I of each time point """
+
+    cov = (1 - shrinkage)[:, np.newaxis, np.newaxis] * cov
+    diagonal = np.einsum("tii->ti", cov)
+    diagonal += (shrinkage * mu)[:, np.newaxis]
+
+    return cov
+
+
+def _fit_ridge(data: np.ndarray, y: np.ndarray, n_classes: int, alpha: float) -> Tuple[np.ndarray, np.ndarray]:
+    """ Ridge classifier on standardized (centered) data, primal or dual depending on the shape """
+
+    n_times, n_epochs, n_features = data.shape
+
+    targets = _get_targets(y, n_classes)
+    target_mean = targets.mean(axis=0)
+    targets = targets - target_mean
+
+    if n_features <= n_epochs:
+        gram = np.swapaxes(data, 1, 2) @ data
+        gram[:, np.arange(n_features), np.arange(n_features)] += alpha
+        coef = np.linalg.solve(gram, np.swapaxes(data, 1, 2) @ targets)
+    else:
+        gram = data @ np.swapaxes(data, 1, 2)
+        gram[:, np.arange(n_epochs), np.arange(n_epochs)] += alpha
+        coef = np.swapaxes(data, 1, 2) @ np.linalg.solve(gram, np.broadcast_to(targets, (n_times,) + targets.shape))
+
+    return coef, np.tile(target_mean, (n_times, 1))
+
+
+def _get_targets(y: np.ndarray, n_classes: int) -> np.ndarray:
+    """ -1/1 targets (n_epochs, n_outputs) of the ridge classifier """
+
+    if n_classes == 2:
+        return np.where(y == 1, 1.0, -1.0)[:, np.newaxis]
+
+    return np.where(y[:, np.newaxis] == np.arange(n_classes), 1.0, -1.0)
+
+
+def _fit_logistic(data: np.ndarray, y: np.ndarray, alpha: float, max_iter: int = 100,
+                  tol: float = 1e-8) -> Tuple[np.ndarray, np.ndarray]:
+    """ Binary L2 logistic regression (intercept not penalized), Newton's method for all time points at once """
+
+    n_times, n_epochs, n_features = data.shape
+
+    design = np.concatenate([data, np.ones((n_times, n_epochs, 1))], axis=2)
+    penalty = np.full(n_features + 1, float(alpha))
+    penalty[-1] = 0.0
+
+    weights = np.zeros((n_times, n_features + 1))
+    for _ in range(max_iter):
+
+        prob = scipy.special.expit(np.einsum("tnp,tp->tn", design, weights))
+        gradient = np.einsum("tnp,tn->tp", design, prob - y) + penalty * weights
+        hessian = np.swapaxes(design, 1, 2) @ (design * (prob * (1 - prob))[:, :, np.newaxis])
+        hessian[:, np.arange(n_features + 1), np.arange(n_features + 1)] += penalty
+
+        step = np.linalg.solve(hessian, gradient[:, :, np.newaxis])[:, :, 0]
+        weights -= step
+        if np.abs(step).max() < tol:
+            break
+
+    return weights[:, :-1, np.newaxis], weights[:, -1:]
@@ -0,0 +1,206 @@
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import mne
+from mne.parallel import parallel_func
+import numpy as np
+import scipy.stats
+from sklearn.model_selection import BaseCrossValidator
+
+from .linear import _get_targets, decision_function, fit_linear, score_decision
+from .time_resolved import Splits, get_data, get_labels, get_splits
+from ..utils.logging import setup_logging
+
+logger = setup_logging(name="permutation", level="info", mne_level="info")
+
+
+########################################################################################################################
+# Permutation tests                                                                                                    #
+#                                                                                                                      #
+# Labels are permuted over all epochs, the cross-validation splits stay the same. For the ridge model, the decision    #
+# values of the test epochs are linear in the training targets: with standardized training data Z and test data Z_t,   #
+# decision = H T + mean(T), H = Z_t (Z'Z + alpha I)^-1 Z'. H does not depend on the labels, so it is computed once per #
+# fold and time point, and the decision values of a batch of permutations are one product H @ [T_1, ..., T_n]. Other   #
+# models are refitted for each permutation, permutations are then run in parallel.                                     #
+#                                                                                                                      #
+# Cluster correction over time uses the same null distribution: time points are thresholded with their pointwise       #
+# permutation p-values and the mass (sum of the scores minus the mean of the null) of the largest cluster of each      #
+# permutation gives the null distribution of cluster masses.                                                           #
+########################################################################################################################
+
+
+def permutation_test(X: Union[np.ndarray, str, Path, mne.BaseEpochs], y: np.ndarray, model: str = "ridge",
+                     alpha: Union[None, str, float] = None, scoring: str = "roc_auc",
+                     cv: Union[int, BaseCrossValidator, Splits] = 5, groups: Union[None, np.ndarray] = None,
+                     n_permutations: int = 1000, batch_size: int = 100, chunk_size: Union[None, int] = None,
+                     n_jobs: int = 1, random_state: Union[None, int] = 0
+                     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Time-resolved decoding scores and their permutation null distribution
+    :param X: array (n_epochs, n_features, n_times) (may be memory-mapped), epochs or directory of memory-mapped
+        epochs or source estimates
+    :param y: labels (n_epochs,)
+    :param model: 'lda', 'ridge' or 'logistic' (see `linear.py`), only ridge shares the fits between permutations
+    :param alpha: regularization of the model, None for its default
+    :param scoring: 'accuracy' or 'roc_auc' (two classes)
+    :param cv: number of stratified folds, scikit-learn splitter or list of (train, test) indices
+    :param groups: groups for the splitter
+    :param n_permutations: number of permutations
+    :param batch_size: number of permutations solved at once
+    :param chunk_size: number of time points processed at once, None for all
+    :param n_jobs: number of folds (ridge) or batches of permutations (other models) run in parallel
+    :param random_state: seed of the splits and permutations
+    :return:
+        scores: mean over folds (n_times,)
+        null: scores of the permutations (n_permutations, n_times)
+        p_values: pointwise permutation p-values (n_times,)
+    """
+
+    data = get_data(X)
+    _, labels = get_labels(y)
+    if len(labels) != len(data):
+        raise ValueError(f"Got {len(labels)} labels for {len(data)} epochs")
+
+    splits = get_splits(labels, cv, groups, random_state)
+    n_times = data.shape[2]
+    chunk_size = n_times if chunk_size is None else int(chunk_size)
+
+    # The first row are the original labels
+    rng = np.random.default_rng(random_state)
+    permutations = np.stack([np.arange(len(labels))] + [rng.permutation(len(labels)) for _ in range(n_permutations)])
+    permuted = labels[permutations]
+
+    if model == "ridge":
+        parallel, run, _ = parallel_func(_score_ridge_fold, n_jobs, verbose=False)
+        scores = np.mean(parallel(run(data, permuted, train, test, alpha, scoring, batch_size, chunk_size)
+                                  for train, test in splits), axis=0)
+    else:
+        batches = np.array_split(permuted, max(int(np.ceil(len(permuted) / batch_size)), 1))
+        parallel, run, _ = parallel_func(_score_permutations, n_jobs, verbose=False)
+        scores = np.concatenate(parallel(run(data, batch, splits, model, alpha, scoring, chunk_size)
+                                         for batch in batches))
+
+    null = scores[1:]
+    p_values = (1 + (null >= scores[0]).sum(axis=0)) / (n_permutations + 1)
+    logger.info(f"Permutation test of {n_times} time points with {n_permutations} permutations ({model}), "
+                f"smallest p-value {p_values.min():.4f}")
+
+    return scores[0], null, p_values
+
+
+def cluster_test(scores: np.ndarray, null: np.ndarray,
+                 p_threshold: float = 0.05) -> Tuple[List[np.ndarray], np.ndarray]:
+    """
+    Cluster-based correction over time from a permutation null distribution (one-sided, larger scores)
+    :param scores: observed scores (n_times,)
+    :param null: scores of the permutations (n_permutations, n_times)
+    :param p_threshold: pointwise p-value threshold forming the clusters
+    :return:
+        clusters: time indices of each cluster of the observed scores
+        p_values: corrected p-value of each cluster
+    """
+
+    n_permutations = len(null)
+    chance = null.mean(axis=0)
+
+    # Pointwise p-values of the observed and of each permutation against the null (the rank includes itself)
+    observed_p = (1 + (null >= scores).sum(axis=0)) / (n_permutations + 1)
+    null_p = scipy.stats.rankdata(-null, method="max", axis=0) / (n_permutations + 1)
+
+    observed_ids, observed_mass = _get_cluster_mass((observed_p < p_threshold)[np.newaxis],
+                                                    (scores - chance)[np.newaxis])
+    _, null_mass = _get_cluster_mass(null_p < p_threshold, null - chance)
+    max_null = null_mass.max(axis=1, initial=0.0)
+
+    clusters = [np.flatnonzero(observed_ids[0] == idx) for idx in range(1, observed_mass.shape[1] + 1)]
+    p_values = np.array([(1 + (max_null >= mass).sum()) / (n_permutations + 1) for mass in observed_mass[0]])
+
+    return clusters, p_values
+
+
+def _get_cluster_mass(mask: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Clusters of consecutive time points of all rows at once
+    :param mask: (n_rows, n_times) time points above the threshold
+    :param values: (n_rows, n_times) values summed over clusters
+    :return:
+        ids: cluster of each time point (n_rows, n_times), 1 to n_clusters, 0 outside of clusters
+        mass: (n_rows, max. number of clusters), 0 for missing clusters
+    """
+
+    starts = mask & ~np.concatenate([np.zeros((len(mask), 1), dtype=bool), mask[:, :-1]], axis=1)
+    ids = np.cumsum(starts, axis=1) * mask
+    n_clusters = int(ids.max(initial=0))
+
+    mass = np.zeros((len(mask), n_clusters + 1))
+    np.add.at(mass, (np.repeat(np.arange(len(mask)), mask.shape[1]), ids.ravel()), values.ravel())
+
+    return ids, mass[:, 1:]
+
+
+def _score_ridge_fold(data: np.ndarray, permuted: np.ndarray, train: np.ndarray, test: np.ndarray,
+                      alpha: Union[None, float], scoring: str, batch_size: int, chunk_size: int) -> np.ndarray:
+    """ Scores (n_permutations, n_times) of one fold, ridge fits shared by all permutations """
+
+    alpha = 1.0 if alpha is None else float(alpha)
+    n_classes = int(permuted.max()) + 1
+    n_times = data.shape[2]
+
+    scores = np.empty((len(permuted), n_times))
+    for start in range(0, n_times, chunk_size):
+        times = slice(start, start + chunk_size)
+        hat = _get_ridge_hat(data[train, :, times], data[test, :, times], alpha)  # (times, n_test, n_train)
+
+        for batch in range(0, len(permuted), batch_size):
+            labels = permuted[batch:batch + batch_size]  # (permutations, n_epochs)
+            targets = _get_targets(labels[:, train].ravel(), n_classes).reshape(len(labels), len(train), -1)
+            n_outputs = targets.shape[2]
+
+            # (times, n_test, permutations * outputs) with one product
+            decision = hat @ targets.transpose(1, 0, 2).reshape(len(train), -1)
+            decision = decision.reshape(decision.shape[:2] + (len(labels), n_outputs)) + targets.mean(axis=1)
+            scores[batch:batch + batch_size, times] = score_decision(labels[:, test].T[:, np.newaxis],
+                                                                     decision.transpose(1, 0, 2, 3), scoring).T
+
+    return scores
+
+
+def _get_ridge_hat(train_data: np.ndarray, test_data: np.ndarray, alpha: float) -> np.ndarray:
+    """ Z_t (Z'Z + alpha I)^-1 Z' of each time point (times, n_test, n_train), dual when there are many features """
+
+    train_data = np.asarray(train_data, dtype=np.float64).transpose(2, 0, 1)
+    test_data = np.asarray(test_data, dtype=np.float64).transpose(2, 0, 1)
+
+    # Standardized with the training data, as `fit_linear`
+    mean = train_data.mean(axis=1, keepdims=True)
+    std = train_data.std(axis=1, keepdims=True)
+    std[std == 0] = 1.0
+    train_data, test_data = (train_data - mean) / std, (test_data - mean) / std
+
+    n_train, n_features = train_data.shape[1:]
+    if n_features <= n_train:
+        gram = np.swapaxes(train_data, 1, 2) @ train_data
+        gram[:, np.arange(n_features), np.arange(n_features)] += alpha
+        return test_data @ np.linalg.solve(gram, np.swapaxes(train_data, 1, 2))
+
+    gram = train_data @ np.swapaxes(train_data, 1, 2)
+    gram[:, np.arange(n_train), np.arange(n_train)] += alpha
+
+    return np.swapaxes(np.linalg.solve(gram, train_data @ np.swapaxes(test_data, 1, 2)), 1, 2)
+
+
+def _score_permutations(data: np.ndarray, permuted: np.ndarray, splits: Splits, model: str,
+                        alpha: Union[None, str, float], scoring: str, chunk_size: int) -> np.ndarray:
+    """ Scores (n_permutations, n_times) of a batch of permutations, refitted for each permutation """
+
+    scores = np.zeros((len(permuted), data.shape[2]))
+    for train, test in splits:
+        for start in range(0, data.shape[2], chunk_size):
+            times = slice(start, start + chunk_size)
+            train_data, test_data = data[train, :, times], data[test, :, times]
+            for idx, labels in enumerate(permuted):
+                coef, intercept = fit_linear(train_data, labels[train], model, alpha)
+                scores[idx, times] += score_decision(labels[test], decision_function(test_data, coef, intercept),
+                                                     scoring)
+
+    return scores / len(splits)
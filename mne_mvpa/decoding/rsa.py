@@ -0,0 +1,277 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Tuple, Union
+
+import mne
+import numpy as np
+import scipy.stats
+
+from .time_resolved import get_data
+from ..utils.cache import atomic_path, hash_params
+from ..utils.logging import setup_logging
+
+logger = setup_logging(name="rsa", level="info", mne_level="info")
+
+
+########################################################################################################################
+# Representational similarity analysis                                                                                 #
+#                                                                                                                      #
+# Epochs are averaged per item (e.g. the word token, `value` of `combine_visual`) with one indicator product per chunk #
+# of epochs. RDMs of all time points of a chunk of times are computed from blocks of rows of the Gram matrices of the  #
+# item patterns, so memory is bounded by (time chunk x item chunk x n_items) and the epochs of one chunk of times.     #
+# RDMs are stored in condensed form (n_times, n_pairs), pairs in the order of `scipy.spatial.distance.squareform`.     #
+#                                                                                                                      #
+# 'correlation': 1 - Pearson correlation of the item patterns                                                          #
+# 'euclidean': Euclidean distance of the item patterns                                                                 #
+# 'crossnobis': cross-validated Mahalanobis distance, items are averaged within folds (e.g. runs or blocks) and        #
+#     distances are the mean over pairs of different folds of (a_i - a_j) . (b_i - b_j) / n_features, after whitening  #
+#     with the shrunk residual covariance pooled over time. The sum over fold pairs is the difference of the squared   #
+#     Euclidean distances of S (sum of the fold patterns) and of C (concatenation of the fold patterns)                #
+#                                                                                                                      #
+# Cached RDMs are keyed by the hash of the data, the selected epochs, their items and the parameters.                  #
+########################################################################################################################
+
+
+METRICS = ["correlation", "euclidean", "crossnobis"]
+COMPARISONS = ["spearman", "pearson"]
+
+
+def compute_rdm(X: Union[np.ndarray, str, Path, mne.BaseEpochs], items: np.ndarray, metric: str = "correlation",
+                selection: Union[None, np.ndarray] = None, folds: Union[None, np.ndarray] = None,
+                shrinkage: float = 0.1, chunk_size: int = 32, item_chunk: int = 256,
+                cache_dir: Union[None, str, Path] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Time-resolved RDMs of the items
+    :param X: array (n_epochs, n_features, n_times) (may be memory-mapped), epochs or directory of memory-mapped
+        epochs or source estimates
+    :param items: item of each epoch (n_epochs,), e.g. the word tokens
+    :param metric: 'correlation', 'euclidean' or 'crossnobis'
+    :param selection: boolean mask or indices of the epochs to use (e.g. `EventSelector.select`), default all
+    :param folds: fold of each epoch (n_epochs,) for 'crossnobis', e.g. runs. Each item should be in each fold
+    :param shrinkage: shrinkage of the residual covariance towards a scaled identity for 'crossnobis'
+    :param chunk_size: number of time points computed at once
+    :param item_chunk: number of rows of the RDMs computed at once
+    :param cache_dir: directory to cache the RDMs in, None for no caching
+    :return:
+        items: sorted unique items (n_items,)
+        rdms: (n_times, n_items * (n_items - 1) / 2), read-only memory map if cached
+    """
+
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric}")
+    if metric == "crossnobis" and folds is None:
+        raise ValueError("Folds are needed for crossnobis distances")
+
+    data = get_data(X)
+    items = np.asarray(items)
+    if len(items) != len(data):
+        raise ValueError(f"Got {len(items)} items for {len(data)} epochs")
+
+    indices = np.arange(len(data)) if selection is None else np.arange(len(data))[selection]
+    unique, item_codes = np.unique(items[indices], return_inverse=True)
+    if len(unique) < 2:
+        raise ValueError(f"At least 2 items are needed, got {len(unique)}")
+    if folds is None:
+        fold_codes, n_folds = np.zeros(len(indices), dtype=int), 1
+    else:
+        _, fold_codes = np.unique(np.asarray(folds)[indices], return_inverse=True)
+        n_folds = int(fold_codes.max()) + 1
+        if metric == "crossnobis" and n_folds < 2:
+            raise ValueError("At least 2 folds are needed for crossnobis distances")
+
+    # Cached
+    file = None
+    if cache_dir is not None:
+        key = hash_params(_hash_data(data), indices.tolist(), items[indices].astype(str).tolist(),
+                          None if folds is None else fold_codes.tolist(), metric, shrinkage)
+        file = Path(cache_dir) / f"rdm-{key}.npy"
+        if file.exists():
+            logger.info(f"Reading RDMs from {file.name}")
+            return unique, np.load(file, mmap_mode="r")
+        if not file.parent.exists():
+            os.makedirs(file.parent, exist_ok=True)
+
+    n_items, n_times = len(unique), data.shape[2]
+    shape = (int(n_times), int(n_items * (n_items - 1) // 2))
+    if file is None:
+        rdms = np.empty(shape)
+    else:
+        tmp = atomic_path(file)
+        rdms = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float64, shape=shape)
+
+    whitener = None
+    if metric == "crossnobis":
+        whitener = _get_whitener(data, indices, item_codes, fold_codes, n_items, n_folds, shrinkage, chunk_size)
+
+    for start in range(0, n_times, chunk_size):
+        times = slice(start, start + chunk_size)
+        sums, counts = _get_item_sums(data, indices, item_codes, fold_codes, n_items, n_folds, times)
+        if metric == "crossnobis" and np.any(counts == 0):
+            raise ValueError(f"{np.count_nonzero((counts == 0).any(axis=0))} items are missing in some folds")
+
+        means = sums / counts[:, :, np.newaxis, np.newaxis]  # (n_folds, n_items, n_features, times)
+        _write_distances(rdms, times, means, metric, whitener, item_chunk)
+
+    logger.info(f"RDMs of {n_items} items from {len(indices)} epochs and {n_times} time points ({metric})")
+
+    if file is not None:
+        rdms.flush()
+        del rdms
+        os.replace(tmp, file)
+        return unique, np.load(file, mmap_mode="r")
+
+    return unique, rdms
+
+
+def compare_rdms(rdms: np.ndarray, models: np.ndarray, method: str = "spearman", chunk_size: int = 64) -> np.ndarray:
+    """
+    Correlation of the RDMs of each time point with model RDMs
+    :param rdms: condensed RDMs (n_times, n_pairs)
+    :param models: condensed model RDMs (n_models, n_pairs) or (n_pairs,)
+    :param method: 'spearman' or 'pearson'
+    :param chunk_size: number of time points compared at once
+    :return:
+        correlations (n_models, n_times)
+    """
+
+    if method not in COMPARISONS:
+        raise ValueError(f"Unknown method {method}")
+
+    models = np.atleast_2d(np.asarray(models, dtype=np.float64))
+    if models.shape[1] != rdms.shape[1]:
+        raise ValueError(f"Got models of {models.shape[1]} pairs for RDMs of {rdms.shape[1]} pairs")
+
+    models = _standardize(scipy.stats.rankdata(models, axis=1) if method == "spearman" else models)
+
+    correlations = np.empty((len(models), len(rdms)))
+    for start in range(0, len(rdms), chunk_size):
+        chunk = np.asarray(rdms[start:start + chunk_size], dtype=np.float64)
+        chunk = _standardize(scipy.stats.rankdata(chunk, axis=1) if method == "spearman" else chunk)
+        correlations[:, start:start + chunk_size] = models @ chunk.T / models.shape[1]
+
+    return correlations
+
+
+def _standardize(x: np.ndarray) -> np.ndarray:
+    """ Zero mean and unit (population) variance of each row """
+
+    x = x - x.mean(axis=1, keepdims=True)
+    std = x.std(axis=1, keepdims=True)
+    std[std == 0] = 1.0
+
+    return x / std
+
+
+def _hash_data(data: np.ndarray, chunk_size: int = 64) -> str:
+    """ Content hash of the data, read in chunks of epochs """
+
+    digest = hashlib.sha256(f"{data.shape} {data.dtype}".encode())
+    for start in range(0, len(data), chunk_size):
+        digest.update(np.ascontiguousarray(data[start:start + chunk_size]).tobytes())
+
+    return digest.hexdigest()
+
+
+def _get_item_sums(data: np.ndarray, indices: np.ndarray, item_codes: np.ndarray, fold_codes: np.ndarray,
+                   n_items: int, n_folds: int, times: slice, epoch_chunk: int = 256) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sums of the epochs of each item in each fold, one indicator product per chunk of epochs
+    :return:
+        sums: (n_folds, n_items, n_features, times)
+        counts: (n_folds, n_items)
+    """
+
+    groups = fold_codes * n_items + item_codes
+    n_times = len(range(data.shape[2])[times])
+
+    sums = np.zeros((n_folds * n_items, data.shape[1] * n_times))
+    for start in range(0, len(indices), epoch_chunk):
+        chunk = np.asarray(data[indices[start:start + epoch_chunk], :, times], dtype=np.float64)
+        indicator = np.zeros((n_folds * n_items, len(chunk)))
+        indicator[groups[start:start + epoch_chunk], np.arange(len(chunk))] = 1.0
+        sums += indicator @ chunk.reshape(len(chunk), -1)
+
+    counts = np.bincount(groups, minlength=n_folds * n_items).reshape(n_folds, n_items)
+
+    return sums.reshape(n_folds, n_items, data.shape[1], n_times), counts
+
+
+def _get_whitener(data: np.ndarray, indices: np.ndarray, item_codes: np.ndarray, fold_codes: np.ndarray,
+                  n_items: int, n_folds: int, shrinkage: float, chunk_size: int) -> np.ndarray:
+    """ Inverse square root of the shrunk residual covariance (epochs minus their item means within folds) """
+
+    n_features = data.shape[1]
+    scatter = np.zeros((n_features, n_features))
+    n_samples = 0
+
+    for start in range(0, data.shape[2], chunk_size):
+        times = slice(start, start + chunk_size)
+        sums, counts = _get_item_sums(data, indices, item_codes, fold_codes, n_items, n_folds, times)
+
+        # Residual scatter: total scatter minus the scatter of the group means
+        for epoch_start in range(0, len(indices), 256):
+            chunk = np.asarray(data[indices[epoch_start:epoch_start + 256], :, times], dtype=np.float64)
+            chunk = chunk.transpose(0, 2, 1).reshape(-1, n_features)
+            scatter += chunk.T @ chunk
+        sums = sums.reshape(n_folds * n_items, n_features, -1)
+        present = counts.ravel() > 0
+        group_means = sums[present] / np.sqrt(counts.ravel()[present])[:, np.newaxis, np.newaxis]
+        group_means = group_means.transpose(0, 2, 1).reshape(-1, n_features)
+        scatter -= group_means.T @ group_means
+        n_samples += (len(indices) - present.sum()) * sums.shape[2]
+
+    cov = scatter / max(n_samples, 1)
+    mu = np.trace(cov) / n_features
+    cov = (1 - shrinkage) * cov + shrinkage * mu * np.eye(n_features)
+
+    eigval, eigvec = np.linalg.eigh(cov)
+
+    return (eigvec / np.sqrt(eigval)) @ eigvec.T
+
+
+def _write_distances(rdms: np.ndarray, times: slice, means: np.ndarray, metric: str,
+                     whitener: Union[None, np.ndarray], item_chunk: int):
+    """ Distances of the item means (n_folds, n_items, n_features, times) written in blocks of RDM rows """
+
+    n_folds, n_items, n_features, _ = means.shape
+    means = means.transpose(3, 0, 1, 2)  # (times, n_folds, n_items, n_features)
+
+    if metric == "correlation":
+        patterns = _standardize(means.mean(axis=1).reshape(-1, n_features)).reshape(-1, n_items, n_features)
+        patterns = [patterns / np.sqrt(n_features)]
+    elif metric == "euclidean":
+        patterns = [means.mean(axis=1)]
+    else:
+        means = means @ whitener
+        patterns = [means.sum(axis=1), means.transpose(0, 2, 1, 3).reshape(-1, n_items, n_folds * n_features)]
+
+    norms = [np.einsum("tip,tip->ti", pattern, pattern) for pattern in patterns]
+
+    for start in range(0, n_items - 1, item_chunk):
+        rows = np.arange(start, min(start + item_chunk, n_items - 1))
+        upper = np.arange(n_items) > rows[:, np.newaxis]  # pairs (row, column > row) in condensed order
+
+        blocks = []
+        for pattern, norm in zip(patterns, norms):
+            gram = pattern[:, rows] @ np.swapaxes(pattern, 1, 2)
+            if metric == "correlation":
+                blocks.append(1.0 - gram)
+            else:
+                blocks.append(norm[:, rows, np.newaxis] + norm[:, np.newaxis] - 2 * gram)
+
+        if metric == "correlation":
+            block = blocks[0]
+        elif metric == "euclidean":
+            block = np.sqrt(np.clip(blocks[0], 0.0, None))
+        else:
+            block = (blocks[0] - blocks[1]) / (n_folds * (n_folds - 1) * n_features)
+
+        first, last = rows[0], rows[-1] + 1
+        rdms[times, _pair_index(first, n_items):_pair_index(last, n_items)] = block[:, upper]
+
+
+def _pair_index(row: int, n_items: int) -> int:
+    """ Index of the first pair of a row of the RDM in condensed form """
+
+    return int(row * n_items - row * (row + 1) // 2)
@@ -0,0 +1,219 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import multiprocessing
+import os
+from pathlib import Path
+import tempfile
+from typing import List, Union
+
+import mne
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+from scipy.spatial import cKDTree
+from sklearn.model_selection import BaseCrossValidator
+
+from .linear import decision_function, fit_linear, score_decision
+from .time_resolved import Splits, get_labels, get_splits
+from ..io.source import DATA_FILE
+from ..utils.cache import atomic_path, hash_params
+from ..utils.logging import setup_logging
+from ..utils.parallel import limit_threads, split_cores
+
+logger = setup_logging(name="searchlight", level="info", mne_level="info")
+
+
+########################################################################################################################
+# Source-space searchlight                                                                                             #
+#                                                                                                                      #
+# The neighbourhood of each source is precomputed once per source space as a sparse (n_sources, n_sources) matrix and  #
+# cached: 'euclidean' with a KD-tree query of the source positions, 'geodesic' with the distances along the cortical   #
+# surface (Dijkstra on the full-resolution mesh limited to the radius, or the distances of the source space if they    #
+# were computed far enough), for surface source spaces. Neighbourhoods do not cross source spaces (hemispheres). Rows  #
+# are in the order of the stacked vertices, as in `io/source.py`.                                                      #
+#                                                                                                                      #
+# Centres are evaluated in chunks of consecutive sources in a process pool. Workers open the memory-mapped source      #
+# estimates themselves and read the union of the neighbourhoods of their chunk once; the classifier of each centre is  #
+# fitted for all time points at once (see `linear.py`) with splits shared by all centres.                              #
+########################################################################################################################
+
+
+METRICS = ["euclidean", "geodesic"]
+
+
+def get_neighbors(src: mne.SourceSpaces, radius: float, metric: str = "euclidean",
+                  vertices: Union[None, List[np.ndarray]] = None,
+                  cache_dir: Union[None, str, Path] = None) -> scipy.sparse.csr_matrix:
+    """
+    Neighbourhood index of the sources, read from the cache if possible
+    :param src: source spaces (e.g. `fwd['src']`)
+    :param radius: searchlight radius in meters
+    :param metric: 'euclidean' or 'geodesic' (surface source spaces only)
+    :param vertices: vertices of each source space in the source estimates, default the vertices in use
+    :param cache_dir: directory to cache the index in, None for no caching
+    :return:
+        boolean sparse matrix (n_sources, n_sources), row i are the neighbours of source i (including itself)
+    """
+
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric}")
+    if vertices is None:
+        vertices = [s["vertno"] for s in src]
+    if len(vertices) != len(src):
+        raise ValueError(f"Got vertices of {len(vertices)} source spaces for {len(src)} source spaces")
+
+    # Cached
+    file = None
+    if cache_dir is not None:
+        digest = hashlib.sha256()
+        for s, vertno in zip(src, vertices):
+            digest.update(np.ascontiguousarray(s["rr"][vertno]).tobytes())
+        key = hash_params(mne.__version__, float(radius), metric, digest.hexdigest())
+        file = Path(cache_dir) / f"searchlight-{key}.npz"
+        if file.exists():
+            logger.info(f"Reading searchlight neighbours from {file.name}")
+            return scipy.sparse.load_npz(file).tocsr()
+
+    blocks = []
+    for s, vertno in zip(src, vertices):
+        if metric == "euclidean":
+            blocks.append(_get_euclidean_neighbors(s["rr"][vertno], radius))
+        else:
+            blocks.append(_get_geodesic_neighbors(s, vertno, radius))
+    neighbors = scipy.sparse.block_diag(blocks, format="csr", dtype=bool)
+
+    n_neighbors = np.diff(neighbors.indptr)
+    logger.info(f"Searchlight neighbours of {neighbors.shape[0]} sources ({metric}, {radius * 1e3:g} mm): "
+                f"{n_neighbors.mean():.1f} on average, at most {n_neighbors.max()}")
+
+    if file is not None:
+        if not file.parent.exists():
+            os.makedirs(file.parent, exist_ok=True)
+        tmp = atomic_path(file)
+        with open(tmp, "wb") as f:
+            scipy.sparse.save_npz(f, neighbors)
+        os.replace(tmp, file)
+
+    return neighbors
+
+
+def _get_euclidean_neighbors(rr: np.ndarray, radius: float) -> scipy.sparse.csr_matrix:
+    """ Sources within the radius, KD-tree query of all sources at once """
+
+    rows = cKDTree(rr).query_ball_point(rr, radius, return_sorted=True)
+    indptr = np.concatenate([[0], np.cumsum([len(row) for row in rows])])
+    indices = np.concatenate(rows).astype(np.int64) if len(rows) else np.zeros(0, dtype=np.int64)
+
+    return scipy.sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=(len(rr), len(rr)))
+
+
+def _get_geodesic_neighbors(s: dict, vertno: np.ndarray, radius: float,
+                            chunk_size: int = 64) -> scipy.sparse.csr_matrix:
+    """ Sources within the radius along the surface, from the distances of the source space if computed as far """
+
+    if s["type"] != "surf":
+        raise ValueError(f"Geodesic neighbours need surface source spaces, got {s['type']}")
+
+    if s["dist"] is not None and s["dist_limit"] >= radius:
+        dist = scipy.sparse.coo_matrix(s["dist"].tocsr()[vertno][:, vertno])
+        within = dist.data <= radius
+        neighbors = scipy.sparse.csr_matrix((np.ones(within.sum(), dtype=bool), (dist.row[within], dist.col[within])),
+                                            shape=dist.shape)
+        return (neighbors + scipy.sparse.identity(len(vertno), dtype=bool, format="csr")).tocsr()
+
+    # Dijkstra on the full-resolution mesh, limited to the radius, for chunks of centres
+    adjacency = mne.surface.mesh_dist(s["tris"], s["rr"])
+    rows = []
+    for start in range(0, len(vertno), chunk_size):
+        dist = scipy.sparse.csgraph.dijkstra(adjacency, indices=vertno[start:start + chunk_size], limit=radius)
+        rows.append(scipy.sparse.csr_matrix(dist[:, vertno] <= radius))
+
+    return scipy.sparse.vstack(rows, format="csr")
+
+
+def searchlight(X: Union[np.ndarray, str, Path], y: np.ndarray, neighbors: scipy.sparse.csr_matrix,
+                model: str = "lda", alpha: Union[None, str, float] = None, scoring: str = "roc_auc",
+                cv: Union[int, BaseCrossValidator, Splits] = 5, groups: Union[None, np.ndarray] = None,
+                times: Union[None, slice] = None, chunk_size: int = 256, n_cores: Union[None, int] = None,
+                random_state: Union[None, int] = 0) -> np.ndarray:
+    """
+    Cross-validated time-resolved decoding in the neighbourhood of each source
+    :param X: directory of memory-mapped source estimates (see `io/source.py`), `.npy` file or array (n_epochs,
+        n_sources, n_times). Arrays are written to a temporary file shared by the workers
+    :param y: labels (n_epochs,)
+    :param neighbors: neighbourhood index, see `get_neighbors`
+    :param model: 'lda', 'ridge' or 'logistic' (see `linear.py`)
+    :param alpha: regularization of the model, None for its default
+    :param scoring: 'accuracy' or 'roc_auc' (two classes)
+    :param cv: number of stratified folds, scikit-learn splitter or list of (train, test) indices
+    :param groups: groups for the splitter
+    :param times: time points to decode, default all
+    :param chunk_size: number of centres per task
+    :param n_cores: total number of cores, default all
+    :param random_state: seed of the shuffling of stratified folds
+    :return:
+        mean scores over folds (n_sources, n_times)
+    """
+
+    if n_cores is None:
+        n_cores = os.cpu_count()
+    times = slice(None) if times is None else times
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        if isinstance(X, (str, Path)):
+            file = Path(X) / DATA_FILE if Path(X).is_dir() else Path(X)
+        else:
+            file = Path(tmp_dir) / DATA_FILE
+            np.save(file, X)
+        data = np.load(file, mmap_mode="r")
+
+        _, labels = get_labels(y)
+        if len(labels) != len(data):
+            raise ValueError(f"Got {len(labels)} labels for {len(data)} epochs")
+        if neighbors.shape[0] != data.shape[1]:
+            raise ValueError(f"Got neighbours of {neighbors.shape[0]} sources for {data.shape[1]} sources")
+
+        splits = get_splits(labels, cv, groups, random_state)
+        n_times = len(range(data.shape[2])[times])
+        del data
+
+        neighbors = neighbors.tocsr()
+        starts = list(range(0, neighbors.shape[0], chunk_size))
+        n_workers, n_jobs = split_cores(len(starts), n_cores)
+
+        # Spawned workers inherit the thread limits before numpy is imported
+        scores = np.empty((neighbors.shape[0], n_times))
+        with limit_threads(n_jobs), \
+                ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+
+            futures = {start: executor.submit(_score_chunk, file, neighbors[start:start + chunk_size], labels, splits,
+                                              model, alpha, scoring, times) for start in starts}
+            for start, future in futures.items():
+                scores[start:start + chunk_size] = future.result()
+
+    logger.info(f"Searchlight of {len(scores)} sources and {n_times} time points with {len(splits)} folds "
+                f"({model}), best mean {scoring} {scores.max():.3f}")
+
+    return scores
+
+
+def _score_chunk(file: Path, neighbors: scipy.sparse.csr_matrix, labels: np.ndarray, splits: Splits, model: str,
+                 alpha: Union[None, str, float], scoring: str, times: slice) -> np.ndarray:
+    """ Scores (n_centres, n_times) of a chunk of centres (executed in the worker processes) """
+
+    # Union of the neighbourhoods of the chunk, read once
+    union = np.unique(neighbors.indices)
+    data = np.load(file, mmap_mode="r")[:, union, times]
+    data = np.asarray(data, dtype=np.float64)
+
+    scores = np.zeros((neighbors.shape[0], data.shape[2]))
+    for train, test in splits:
+        train_data, test_data = data[train], data[test]
+        for centre in range(neighbors.shape[0]):
+            features = np.searchsorted(union, neighbors.indices[neighbors.indptr[centre]:neighbors.indptr[centre + 1]])
+            coef, intercept = fit_linear(train_data[:, features], labels[train], model, alpha)
+            scores[centre] += score_decision(labels[test], decision_function(test_data[:, features], coef, intercept),
+                                             scoring)
+
+    return scores / len(splits)
@@ -0,0 +1,136 @@
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import mne
+from mne.parallel import parallel_func
+import numpy as np
+from sklearn.model_selection import BaseCrossValidator, StratifiedKFold
+
+from .linear import decision_function, fit_linear, score_decision
+from ..io import epochs as epochs_mmap
+from ..io.source import read_source_mmap
+from ..utils.logging import setup_logging
+
+logger = setup_logging(name="time_resolved", level="info", mne_level="info")
+
+
+########################################################################################################################
+# Time-resolved decoding                                                                                               #
+#                                                                                                                      #
+# One classifier per time point, all time points of a fold are fitted at once with the batched models of `linear.py`.  #
+# The cross-validation splits are computed once and shared by all time points (and by temporal generalization and      #
+# permutation tests). Folds are run in parallel with joblib, memory-mapped inputs (e.g. source estimates of            #
+# `io/source.py`) are passed to the workers by reference and only the training/test epochs of a fold are read.         #
+########################################################################################################################
+
+
+Splits = List[Tuple[np.ndarray, np.ndarray]]
+
+
+def get_data(X: Union[np.ndarray, str, Path, mne.BaseEpochs]) -> np.ndarray:
+    """
+    Decoding data from the formats of this project
+    :param X: array (n_epochs, n_features, n_times) (may be memory-mapped), epochs (data channels are used) or
+        directory of memory-mapped epochs or source estimates (see `io/epochs.py` and `io/source.py`)
+    :return:
+        (n_epochs, n_features, n_times) array, memory-mapped epochs and source estimates are not read into memory
+    """
+
+    if isinstance(X, mne.BaseEpochs):
+        return X.get_data(picks="data")
+    if isinstance(X, (str, Path)):
+        if (Path(X) / epochs_mmap.META_FILE).exists():
+            return epochs_mmap.read_epochs_mmap(X)[0]
+        return read_source_mmap(X)[0]
+    if X.ndim != 3:
+        raise ValueError(f"Data should be (n_epochs, n_features, n_times), got shape {X.shape}")
+
+    return X
+
+
+def get_labels(y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encode labels as class indices
+    :param y: labels (n_epochs,) of any type
+    :return:
+        classes, indices (n_epochs,) into classes
+    """
+
+    classes, indices = np.unique(np.asarray(y), return_inverse=True)
+
+    return classes, indices
+
+
+def get_splits(y: np.ndarray, cv: Union[int, BaseCrossValidator, Splits] = 5, groups: Union[None, np.ndarray] = None,
+               random_state: Union[None, int] = 0) -> Splits:
+    """
+    Cross-validation splits, computed once and shared by all time points
+    :param y: labels (n_epochs,)
+    :param cv: number of stratified folds (shuffled), scikit-learn splitter or list of (train, test) indices
+    :param groups: groups for the splitter (e.g. sessions)
+    :param random_state: seed of the shuffling of stratified folds
+    :return:
+        [(train indices, test indices), ...]
+    """
+
+    if isinstance(cv, (int, np.integer)):
+        cv = StratifiedKFold(n_splits=int(cv), shuffle=True, random_state=random_state)
+    if hasattr(cv, "split"):
+        return [(np.asarray(train), np.asarray(test)) for train, test in cv.split(np.zeros(len(y)), y, groups)]
+
+    return [(np.asarray(train), np.asarray(test)) for train, test in cv]
+
+
+def decode_time(X: Union[np.ndarray, str, Path, mne.BaseEpochs], y: np.ndarray, model: str = "lda",
+                alpha: Union[None, str, float] = None, scoring: str = "roc_auc",
+                cv: Union[int, BaseCrossValidator, Splits] = 5, groups: Union[None, np.ndarray] = None,
+                chunk_size: Union[None, int] = None, n_jobs: int = 1,
+                random_state: Union[None, int] = 0) -> np.ndarray:
+    """
+    Cross-validated decoding at each time point
+    :param X: array (n_epochs, n_features, n_times) (may be memory-mapped), epochs or directory of memory-mapped
+        epochs or source estimates
+    :param y: labels (n_epochs,)
+    :param model: 'lda', 'ridge' or 'logistic' (see `linear.py`)
+    :param alpha: regularization of the model, None for its default
+    :param scoring: 'accuracy' or 'roc_auc' (two classes)
+    :param cv: number of stratified folds, scikit-learn splitter or list of (train, test) indices
+    :param groups: groups for the splitter
+    :param chunk_size: number of time points fitted at once, None for all (limits the memory of the covariances)
+    :param n_jobs: number of folds run in parallel
+    :param random_state: seed of the shuffling of stratified folds
+    :return:
+        scores (n_folds, n_times)
+    """
+
+    data = get_data(X)
+    _, labels = get_labels(y)
+    if len(labels) != len(data):
+        raise ValueError(f"Got {len(labels)} labels for {len(data)} epochs")
+
+    splits = get_splits(labels, cv, groups, random_state)
+    n_times = data.shape[2]
+    chunk_size = n_times if chunk_size is None else int(chunk_size)
+
+    parallel, run, _ = parallel_func(_score_fold, n_jobs, verbose=False)
+    scores = np.array(parallel(run(data, labels, train, test, model, alpha, scoring, chunk_size)
+                               for train, test in splits))
+
+    logger.info(f"Decoded {n_times} time points of {len(data)} epochs with {len(splits)} folds ({model}), "
+                f"best mean {scoring} {scores.mean(axis=0).max():.3f}")
+
+    return scores
+
+
+def _score_fold(data: np.ndarray, labels: np.ndarray, train: np.ndarray, test: np.ndarray, model: str,
+                alpha: Union[None, str, float], scoring: str, chunk_size: int) -> np.ndarray:
+    """ Fit on the training epochs and score the test epochs of one fold, time points in chunks """
+
+    scores = np.empty(data.shape[2])
+    for start in range(0, data.shape[2], chunk_size):
+        times = slice(start, start + chunk_size)
+        coef, intercept = fit_linear(data[train, :, times], labels[train], model, alpha)
+        scores[times] = score_decision(labels[test], decision_function(data[test, :, times], coef, intercept),
+                                       scoring)
+
+    return scores
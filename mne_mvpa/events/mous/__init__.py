@@ -0,0 +1,3 @@
+from .reformat import combine_visual
+from .batch import combine_visual_batch
+from .select import EventSelector, select_events
@@ -0,0 +1,150 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import mne
+import numpy as np
+import pandas as pd
+
+from .reformat import combine_visual
+from ...definitions import RawReader
+from ...utils.cache import atomic_path, hash_params, hash_path
+
+
+########################################################################################################################
+# Reformat events of many subjects at once                                                                             #
+#                                                                                                                      #
+# Results are stored as `{key}-events.{parquet/feather}` and `{key}-errors.{parquet/feather}` where `key` is a hash    #
+# of the input files and parameters. Subjects whose inputs did not change are not processed again.                     #
+# `type` and `value` of the events are stored as categorical columns.                                                  #
+########################################################################################################################
+
+
+FILE_FORMATS = ["parquet", "feather"]
+
+
+def combine_visual_batch(pairs: List[Tuple[Union[str, Path], Union[str, Path]]], dst_dir: Union[str, Path],
+                         tolerance: int = 2, raw_reader: Union[None, RawReader] = None,
+                         find_events_params: Union[None, dict] = None, file_format: str = "parquet",
+                         n_jobs: int = 1) -> List[Path]:
+    """
+    Run `combine_visual` on many (events, TSV) pairs in a process pool
+    :param pairs: list of (events, TSV file) pairs. Events are either a `.npy` file with the events array or a raw file
+        from which events are extracted with `mne.find_events()`
+    :param dst_dir: directory to store the results in
+    :param tolerance: max. tolerated number of sampling cycles to differ by, default = 2
+    :param raw_reader: dataset specific raw file reader, (path: str, preload: bool) -> mne.io.Raw. Required if any of
+        the events are given as raw files
+    :param find_events_params: other parameters for `mne.find_events()`
+    :param file_format: 'parquet' or 'feather'
+    :param n_jobs: number of worker processes
+    :return:
+        paths to the events file of each pair (errors are stored next to it)
+    """
+
+    if file_format not in FILE_FORMATS:
+        raise ValueError(f"Unknown file format {file_format}")
+    if find_events_params is None:
+        find_events_params = {}
+
+    dst_dir = Path(dst_dir)
+    if not dst_dir.exists():
+        os.makedirs(dst_dir)
+
+    # Find pairs which have not been processed yet
+    dst_files, jobs = [], []
+    for events_file, tsv_file in pairs:
+
+        if Path(events_file).suffix != ".npy" and raw_reader is None:
+            raise ValueError(f"`raw_reader` is required to read events from {events_file}")
+
+        key = hash_params(hash_path(events_file), hash_path(tsv_file), tolerance, find_events_params)
+        events_dst, errors_dst = get_batch_files(dst_dir, key, file_format)
+        dst_files.append(events_dst)
+
+        if not (events_dst.exists() and errors_dst.exists()):
+            jobs.append((events_file, tsv_file, events_dst, errors_dst))
+
+    # Process
+    if n_jobs == 1:
+        for job in jobs:
+            _combine_visual_file(*job, tolerance, raw_reader, find_events_params, file_format)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_combine_visual_file, *job, tolerance, raw_reader, find_events_params,
+                                       file_format) for job in jobs]
+            for future in futures:
+                future.result()  # raise errors from the workers
+
+    return dst_files
+
+
+def get_batch_files(dst_dir: Union[str, Path], key: str, file_format: str = "parquet") -> Tuple[Path, Path]:
+    """
+    Paths to the events and errors files of a `combine_visual_batch` result
+    :param dst_dir: directory the results are stored in
+    :param key: hash of the inputs
+    :param file_format: 'parquet' or 'feather'
+    :return:
+        events file, errors file
+    """
+
+    dst_dir = Path(dst_dir)
+
+    return dst_dir / f"{key}-events.{file_format}", dst_dir / f"{key}-errors.{file_format}"
+
+
+def read_batch_events(file: Union[str, Path]) -> pd.DataFrame:
+    """
+    Read events stored by `combine_visual_batch`
+    :param file: path to the events file
+    :return:
+        events_df: [sample, onset, duration, type, value, sentence, relative_clause, target]
+    """
+
+    file = Path(file)
+
+    if file.suffix == ".parquet":
+        return pd.read_parquet(file)
+    elif file.suffix == ".feather":
+        return pd.read_feather(file)
+    else:
+        raise ValueError(f"Unknown file format {file.suffix}")
+
+
+def _combine_visual_file(events_file: Union[str, Path], tsv_file: Union[str, Path], events_dst: Path,
+                         errors_dst: Path, tolerance: int, raw_reader: Union[None, RawReader],
+                         find_events_params: dict, file_format: str):
+    """
+    Run `combine_visual` on a single pair and store the results (executed in the worker processes)
+    :param events_file: `.npy` events file or raw file
+    :param tsv_file: TSV file provided with the MOUS data
+    :param events_dst: path to store the events to
+    :param errors_dst: path to store the errors to
+    :param tolerance: max. tolerated number of sampling cycles to differ by
+    :param raw_reader: dataset specific raw file reader
+    :param find_events_params: other parameters for `mne.find_events()`
+    :param file_format: 'parquet' or 'feather'
+    :return:
+    """
+
+    if Path(events_file).suffix == ".npy":
+        events = np.load(events_file)
+    else:
+        raw = raw_reader(str(events_file), preload=False)
+        events = mne.find_events(raw, **find_events_params)
+
+    df = pd.read_csv(tsv_file, sep="\t")
+    events_df, errors_df = combine_visual(events, df, tolerance=tolerance)
+
+    events_df = events_df.astype({"type": "category", "value": "category"})
+    errors_df = errors_df.astype(str)  # mixes numbers and strings in the same columns
+
+    for df, dst in [(events_df, events_dst), (errors_df, errors_dst)]:
+        tmp = atomic_path(dst)
+        if file_format == "parquet":
+            df.to_parquet(tmp)
+        else:
+            df.to_feather(tmp)
+        os.replace(tmp, dst)
@@ -28,8 +28,11 @@ import pandas as pd
 # `target`: true if it is the target word, false if not                                                                #
 ########################################################################################################################
 
+EVENTS_COLUMNS = ["sample", "onset", "duration", "type", "value", "sentence", "relative_clause", "target"]
 
-def combine_visual(events: np.array, df: pd.DataFrame, tolerance: int = 2) -> Tuple[pd.DataFrame, pd.DataFrame]:
+
+def combine_visual(events: np.array, df: pd.DataFrame, tolerance: int = 2,
+                   vectorized: bool = True) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Combine events array generated with MNE-python `mne.find_events()` with TSV file provided with the MOUS data.
     The two sets of events are compared and checked for inconsistencies. Inconsistent events are logged in dataframe
@@ -39,11 +42,38 @@ def combine_visual(events: np.array, df: pd.DataFrame, tolerance: int = 2) -> Tu
     :param events: events array provided by `mne.find_events()`
     :param df: dataframe from TSV file
     :param tolerance: max. tolerated number of sampling cycles to differ by, default = 2
+    :param vectorized: use the vectorized matching path (nearest sample lookup with `searchsorted` and table-driven
+        trigger dispatch), default True. The row-by-row path produces identical output and is kept for reference
     :return:
         events_df: [sample, onset, duration, type, value, sentence, relative_clause, target]
         error_df: [index, onset, sample, type, value]
     """
 
+    if vectorized:
+        events_list, error_list = _combine_visual_vectorized(events, df, tolerance)
+    else:
+        events_list, error_list = _combine_visual_iterative(events, df, tolerance)
+
+    events_df = pd.DataFrame(events_list, columns=EVENTS_COLUMNS)
+    errors_df = pd.DataFrame(error_list, columns=["index", "onset", "sample", "type", "value", "trigger_value"])
+
+    # Set dtypes
+    events_df["duration"] = events_df["duration"].astype(float)
+
+    return events_df, errors_df
+
+
+def _combine_visual_iterative(events: np.array, df: pd.DataFrame, tolerance: int) -> Tuple[list, list]:
+    """
+    Row-by-row matching of the TSV rows against the events array (see `combine_visual`)
+    :param events: events array provided by `mne.find_events()`
+    :param df: dataframe from TSV file
+    :param tolerance: max. tolerated number of sampling cycles to differ by
+    :return:
+        events_list: list of events [sample, onset, duration, type, value, sentence, relative_clause, target]
+        error_list: list of errors
+    """
+
     events_list = []    # [sample, onset, duration, type, value, sentence, relative_clause, target]
     error_list = []     # [index, onset, sample, type, value, trigger_value]
     for idx, row in df.iterrows():
@@ -117,14 +147,190 @@ def combine_visual(events: np.array, df: pd.DataFrame, tolerance: int = 2) -> Tu
         else:
             error_list.append([idx, row["sample"], row["onset"], row["type"], row["value"], value])
 
-    events_df = pd.DataFrame(events_list, columns=["sample", "onset", "duration", "type", "value", "sentence",
-                                                   "relative_clause", "target"])
-    errors_df = pd.DataFrame(error_list, columns=["index", "onset", "sample", "type", "value", "trigger_value"])
+    return events_list, error_list
 
-    # Set dtypes
-    events_df["duration"] = events_df["duration"].astype(float)
 
-    return events_df, errors_df
+########################################################################################################################
+# Vectorized matching                                                                                                  #
+########################################################################################################################
+
+
+# TSV rows which are not compared with the events array
+_IGNORED_TYPES = ["trial", "frontpanel trigger", "UPPT001", "UPPT002"]
+
+# Word triggers: trigger value -> (sentence, relative_clause, target), see `_handle_1_3` and `_handle_4_8`
+_WORD_CONDITIONS = {1: (True, True, False), 2: (True, True, True), 3: (False, True, False),
+                    4: (False, True, True), 5: (True, False, False), 6: (True, False, True),
+                    7: (False, False, False), 8: (False, False, True)}
+
+# Triggers matched on the exact TSV value: trigger value -> (TSV type, TSV value, event type, event value)
+# see `_handle_15`, `_handle_30`, `_handle_16` and `_handle_32`
+_EXACT_TRIGGERS = {15: ("Picture", "ISI", "ISI", "NA"), 30: ("Picture", "pause", "pause", "NA"),
+                   16: ("Response", "1", "response", "1"), 32: ("Response", "2", "response", "2")}
+
+_KNOWN_TRIGGERS = [*_WORD_CONDITIONS, 10, 15, 16, 20, 30, 32, 40, 128]
+
+# Word values, either sentence final e.g. '5 300' (`end`) or other words e.g. '5 gemene 300' (`word`, `duration`)
+_WORD_PATTERN = r"^\d\s*(?:(?P<end>\d+)|(?P<word>[\w.\']+)\s*(?P<duration>\d+))"
+
+
+def _combine_visual_vectorized(events: np.array, df: pd.DataFrame, tolerance: int) -> Tuple[Union[dict, list], list]:
+    """
+    Vectorized version of `_combine_visual_iterative`. Each TSV row is matched to the event with the nearest sample
+    with a binary search, and the `_handle_*` functions are replaced by boolean masks over all rows at once
+    :param events: events array provided by `mne.find_events()`
+    :param df: dataframe from TSV file
+    :param tolerance: max. tolerated number of sampling cycles to differ by
+    :return:
+        events: columns of the events dataframe (or empty list if there are no events)
+        error_list: list of errors, in the same order as `_combine_visual_iterative`
+    """
+
+    # Rows to be compared
+    keep = df["value"].apply(isinstance, args=(str,))  # skip NaN
+    keep &= ~df["type"].isin(_IGNORED_TYPES)
+    keep &= df["value"] != "blank"
+    rows = df[keep.to_numpy(dtype=bool)]
+
+    n_rows = len(rows)
+    if n_rows == 0:
+        return [], []
+    if len(events) == 0:
+        raise ValueError("The events array is empty")
+
+    sample = rows["sample"].to_numpy()
+    tsv_type = rows["type"].to_numpy(dtype=object)
+    tsv_value = rows["value"]
+
+    # Find events with the closest sample numbers
+    nearest_idx = _nearest_event(events[:, 0], sample)
+    diff = np.abs(events[nearest_idx, 0] - sample)
+    trigger = events[nearest_idx, 2]
+    trigger_str = trigger.astype(str).astype(object)
+
+    is_picture = tsv_type == "Picture"
+    is_response = tsv_type == "Response"
+    first_char = tsv_value.str[0].to_numpy(dtype=object)
+    str_value = tsv_value.to_numpy(dtype=object)
+
+    # Output columns
+    event_type = np.full(n_rows, None, dtype=object)
+    event_value = np.full(n_rows, None, dtype=object)
+    duration = rows["duration"].to_numpy(dtype=object).copy()
+    conditions = np.zeros((n_rows, 3), dtype=bool)  # sentence, relative_clause, target
+
+    # Words
+    mask = np.isin(trigger, list(_WORD_CONDITIONS)) & is_picture & (first_char == trigger_str)
+    parsed = tsv_value[mask].str.extract(_WORD_PATTERN)
+    end = parsed["end"].notna().to_numpy()
+    matched = end | parsed["word"].notna().to_numpy()
+    event_type[mask] = "word"
+    event_value[mask] = np.where(end, "<END>", parsed["word"].to_numpy(dtype=object))
+    duration[mask] = parsed["end"].fillna(parsed["duration"]).to_numpy(dtype=object)
+    condition_table = np.zeros((max(_WORD_CONDITIONS) + 1, 3), dtype=bool)
+    for value, condition in _WORD_CONDITIONS.items():
+        condition_table[value] = condition
+    conditions[mask] = condition_table[trigger[mask]]
+    word_error = np.flatnonzero(mask)[~matched]
+
+    # Response 1-3
+    mask = np.isin(trigger, [1, 2, 3]) & is_response & (first_char == trigger_str)
+    event_type[mask] = "response"
+    event_value[mask] = trigger_str[mask]
+
+    # Mini-block start
+    mask = (trigger == 10) & is_picture & np.isin(str_value, ["WOORDEN", "ZINNEN"])
+    event_type[mask] = "block"
+    event_value[mask] = str_value[mask]
+
+    # ISI, pause and responses 1-2
+    for value, (required_type, required_value, new_type, new_value) in _EXACT_TRIGGERS.items():
+        mask = (trigger == value) & (tsv_type == required_type) & (str_value == required_value)
+        event_type[mask] = new_type
+        event_value[mask] = new_value
+
+    # Fixation
+    mask = (trigger == 20) & is_picture & tsv_value.str.startswith("FIX").to_numpy(dtype=bool)
+    parsed = tsv_value[mask].str.extract(r"^FIX\s*(\d+)", expand=False)  # e.g. FIX 3948
+    event_type[mask] = "fixation"
+    event_value[mask] = "NA"
+    duration[mask] = parsed.to_numpy(dtype=object)
+    fixation_error = np.flatnonzero(mask)[parsed.isna().to_numpy()]
+
+    # Question
+    mask = (trigger == 40) & is_picture & tsv_value.str.startswith("QUESTION").to_numpy(dtype=bool)
+    parsed = tsv_value[mask].str.extract(r"^QUESTION\s*(\d+)", expand=False)  # e.g. QUESTION 341
+    event_type[mask] = "question"
+    event_value[mask] = parsed.to_numpy(dtype=object)
+    question_error = np.flatnonzero(mask)[parsed.isna().to_numpy()]
+
+    # Raise the error the row-by-row version would have raised first
+    unknown_error = np.flatnonzero(~np.isin(trigger, _KNOWN_TRIGGERS))
+    first_error = min([n_rows] + [int(errors[0]) for errors in
+                                  [word_error, fixation_error, question_error, unknown_error] if len(errors) > 0])
+    if first_error < n_rows:
+        value = str_value[first_error]
+        if first_error in unknown_error:
+            raise ValueError(f"Unknown trigger value {trigger[first_error]}")
+        elif first_error in word_error:
+            raise ValueError(f"The 'value' '{value}' is not matched. (should be of the format digit word duration")
+        elif first_error in fixation_error:
+            raise ValueError(f"The 'value' {value} is not matched. (should be of the format FIX duration")
+        else:
+            raise ValueError(f"The 'value' '{value}' is not matched. (should be of the format QUESTION duration")
+
+    # UDIO001 is ignored, other rows without a matching handler are errors
+    valid = event_type != None  # noqa: E711, elementwise comparison
+    ignored = (trigger == 128) & (tsv_type == "UDIO001")
+    mismatch = ~valid & ~ignored
+
+    # Errors, in row order with the sample difference first
+    index = rows.index.to_numpy()
+    error_sample = rows["sample"].to_numpy(dtype=object)
+    error_onset = rows["onset"].to_numpy(dtype=object)
+    error_list = []
+    for pos in np.flatnonzero((diff > tolerance) | mismatch):
+        if diff[pos] > tolerance:
+            error_list.append([index[pos], error_sample[pos], "sample_diff", diff[pos]])
+        if mismatch[pos]:
+            error_list.append([index[pos], error_sample[pos], error_onset[pos], tsv_type[pos], str_value[pos],
+                               trigger[pos]])
+
+    if not np.any(valid):
+        return [], error_list
+
+    events_columns = {"sample": sample[valid], "onset": rows["onset"].to_numpy()[valid], "duration": duration[valid],
+                      "type": event_type[valid], "value": event_value[valid], "sentence": conditions[valid, 0],
+                      "relative_clause": conditions[valid, 1], "target": conditions[valid, 2]}
+
+    return events_columns, error_list
+
+
+def _nearest_event(event_samples: np.array, samples: np.array) -> np.array:
+    """
+    Find the index of the event with the closest sample number for each sample. Ties are resolved like
+    `np.abs(event_samples - sample).argmin()`, i.e. the smallest index wins
+    :param event_samples: sample numbers of the events array (need not be sorted)
+    :param samples: sample numbers to look up
+    :return:
+        indices into `event_samples`
+    """
+
+    order = np.argsort(event_samples, kind="stable")
+    sorted_samples = event_samples[order]
+
+    # Candidates on either side, moved to the first of any run of identical sample numbers
+    pos = np.searchsorted(sorted_samples, samples, side="left")
+    left = np.searchsorted(sorted_samples, sorted_samples[np.maximum(pos - 1, 0)], side="left")
+    right = np.searchsorted(sorted_samples, sorted_samples[np.minimum(pos, len(sorted_samples) - 1)], side="left")
+
+    left_dist = np.abs(sorted_samples[left] - samples)
+    right_dist = np.abs(sorted_samples[right] - samples)
+    left_idx, right_idx = order[left], order[right]
+
+    use_left = (left_dist < right_dist) | ((left_dist == right_dist) & (left_idx < right_idx))
+
+    return np.where(use_left, left_idx, right_idx)
 
 
 def _handle_1_3(row: pd.Series, value: int) -> Union[None, Tuple[float, float, float, str, str, bool, bool, bool]]:
@@ -0,0 +1,210 @@
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import mne
+import numpy as np
+import pandas as pd
+
+from .batch import read_batch_events
+
+
+########################################################################################################################
+# Select events from the formatted events (see `reformat.py` for the format)                                           #
+#                                                                                                                      #
+# All columns used for selection are indexed once per subject, queries are combinations of boolean masks               #
+########################################################################################################################
+
+
+class EventSelector:
+    """
+    Indexed events of a single subject. Example, sentence words which are not targets and longer than 3 characters:
+    >>> selector = EventSelector.from_file("sub-V1001-events.csv")
+    >>> events, event_id = selector.get_events(selector.select(type="word", sentence=True, target=False, min_length=4))
+    """
+
+    def __init__(self, events_df: pd.DataFrame):
+        """
+        :param events_df: events_df from `combine_visual`
+            [sample, onset, duration, type, value, sentence, relative_clause, target]
+        """
+
+        self.samples = events_df["sample"].to_numpy(dtype=np.int64)
+        self.onsets = events_df["onset"].to_numpy(dtype=float)
+        self.durations = events_df["duration"].to_numpy(dtype=float)
+
+        # Categorical indexes
+        self.types = pd.Categorical(events_df["type"].astype(str))
+        self.values = pd.Categorical(events_df["value"].astype(str))
+
+        # Boolean indexes
+        self.sentence = events_df["sentence"].to_numpy(dtype=bool)
+        self.relative_clause = events_df["relative_clause"].to_numpy(dtype=bool)
+        self.target = events_df["target"].to_numpy(dtype=bool)
+
+        # Word length in characters, 0 for other events and sentence ends
+        is_word = (self.types == "word") & (self.values != "<END>")
+        value_lengths = np.array([len(value) for value in self.values.categories], dtype=int)
+        self.lengths = np.where(is_word, value_lengths[self.values.codes], 0)
+
+    @classmethod
+    def from_file(cls, file: Union[str, Path]) -> "EventSelector":
+        """
+        Read formatted events from CSV, Parquet or Feather file
+        :param file: path to the events file
+        :return:
+            EventSelector
+        """
+
+        if Path(file).suffix == ".csv":
+            # Keep 'NA' values and words such as 'null' as strings
+            events_df = pd.read_csv(file, keep_default_na=False, na_values={"onset": [""], "duration": [""]})
+        else:
+            events_df = read_batch_events(file)
+
+        return cls(events_df)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def select(self, type: Union[None, str, List[str]] = None, value: Union[None, str, List[str]] = None,
+               sentence: Union[None, bool] = None, relative_clause: Union[None, bool] = None,
+               target: Union[None, bool] = None, min_length: Union[None, int] = None,
+               max_length: Union[None, int] = None) -> np.ndarray:
+        """
+        Select events matching all given conditions, None means no condition
+        :param type: event type(s), e.g. 'word'
+        :param value: event value(s), e.g. word tokens
+        :param sentence: sentence (True) or word list (False)
+        :param relative_clause: with (True) or without (False) relative clause
+        :param target: target word (True) or not (False)
+        :param min_length: min. word length in characters (inclusive)
+        :param max_length: max. word length in characters (inclusive)
+        :return:
+            boolean mask over the events
+        """
+
+        mask = np.ones(len(self), dtype=bool)
+
+        if type is not None:
+            mask &= self._isin(self.types, type)
+        if value is not None:
+            mask &= self._isin(self.values, value)
+        if sentence is not None:
+            mask &= self.sentence == sentence
+        if relative_clause is not None:
+            mask &= self.relative_clause == relative_clause
+        if target is not None:
+            mask &= self.target == target
+        if min_length is not None:
+            mask &= self.lengths >= min_length
+        if max_length is not None:
+            mask &= self.lengths <= max_length
+
+        return mask
+
+    def get_events(self, mask: np.ndarray, name: str = "selected",
+                   by: Union[None, str] = None) -> Tuple[np.ndarray, Dict[str, int]]:
+        """
+        MNE events array of the selected events
+        :param mask: boolean mask from `select`
+        :param name: name of the events in `event_id`
+        :param by: column to split the events by ('type', 'value', 'sentence', 'relative_clause' or 'target'), the
+            events are then named `name/column value`. If None, all events are named `name`
+        :return:
+            events: (n, 3) events array
+            event_id: {name: event code}
+        """
+
+        if by is None:
+            labels = np.zeros(np.count_nonzero(mask), dtype=int)
+            names = [name]
+        else:
+            column = self._column(by)[mask]
+            unique, labels = np.unique(np.asarray(column, dtype=str), return_inverse=True)
+            names = [f"{name}/{label}" for label in unique]
+
+        events = np.zeros((len(labels), 3), dtype=np.int64)
+        events[:, 0] = self.samples[mask]
+        events[:, 2] = labels + 1
+        event_id = {label: code + 1 for code, label in enumerate(names)}
+
+        return events, event_id
+
+    def get_metadata(self, mask: np.ndarray) -> pd.DataFrame:
+        """
+        Formatted events of the selected events, in the order of `get_events` (e.g. metadata of epochs)
+        :param mask: boolean mask from `select`
+        :return:
+            data frame [sample, onset, duration, type, value, sentence, relative_clause, target]
+        """
+
+        return pd.DataFrame({"sample": self.samples[mask], "onset": self.onsets[mask],
+                             "duration": self.durations[mask], "type": np.asarray(self.types[mask], dtype=str),
+                             "value": np.asarray(self.values[mask], dtype=str), "sentence": self.sentence[mask],
+                             "relative_clause": self.relative_clause[mask], "target": self.target[mask]})
+
+    def get_contrast(self, masks: Dict[str, np.ndarray]) -> Tuple[np.ndarray, Dict[str, int]]:
+        """
+        Events array of several conditions, e.g. {'target': mask1, 'non-target': mask2}
+        :param masks: {condition name: boolean mask from `select`}, conditions should not overlap
+        :return:
+            events: (n, 3) events array sorted by sample
+            event_id: {condition name: event code}
+        """
+
+        event_id = {name: code + 1 for code, name in enumerate(masks)}
+
+        codes = np.zeros(len(self), dtype=np.int64)
+        for name, mask in masks.items():
+            if np.any(codes[mask] != 0):
+                raise ValueError(f"Condition {name} overlaps with another condition")
+            codes[mask] = event_id[name]
+
+        selected = np.flatnonzero(codes)
+        selected = selected[np.argsort(self.samples[selected], kind="stable")]
+        events = np.zeros((len(selected), 3), dtype=np.int64)
+        events[:, 0] = self.samples[selected]
+        events[:, 2] = codes[selected]
+
+        return events, event_id
+
+    def _column(self, by: str) -> np.ndarray:
+
+        if by == "type":
+            return np.asarray(self.types)
+        elif by == "value":
+            return np.asarray(self.values)
+        elif by in ["sentence", "relative_clause", "target"]:
+            return getattr(self, by)
+        else:
+            raise ValueError(f"Unknown column {by}")
+
+    @staticmethod
+    def _isin(column: pd.Categorical, values: Union[str, List[str]]) -> np.ndarray:
+        """ Compare category codes instead of strings """
+
+        if isinstance(values, str):
+            values = [values]
+        codes = [column.categories.get_loc(value) for value in values if value in column.categories]
+
+        return np.isin(column.codes, codes)
+
+
+def select_events(events_file: Union[str, Path], dst_file: Union[str, Path], by: Union[None, str] = None,
+                  **query) -> Dict[str, int]:
+    """
+    Select events from formatted events file and save them as FIF
+    :param events_file: path to the formatted events (CSV, Parquet or Feather)
+    :param dst_file: path to save the selected events to, should end with `-eve.fif`
+    :param by: column to split the events by (see `EventSelector.get_events`)
+    :param query: conditions (see `EventSelector.select`)
+    :return:
+        event_id: {name: event code}
+    """
+
+    selector = EventSelector.from_file(events_file)
+    events, event_id = selector.get_events(selector.select(**query), by=by)
+
+    mne.write_events(dst_file, events, overwrite=True)
+
+    return event_id
@@ -0,0 +1,114 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+from pathlib import Path
+import tempfile
+from typing import List, Tuple, Union
+
+import mne
+
+from .forward_solution import get_bem_solution, get_conductivity, get_forward_solution, get_source_space
+from ..utils.logging import setup_logging
+from ..utils.parallel import limit_threads, split_cores
+
+logger = setup_logging(name="forward_batch", level="info", mne_level="info")
+
+
+########################################################################################################################
+# Forward solutions of many runs                                                                                       #
+#                                                                                                                      #
+# Source spaces and BEM solutions only depend on the subject, so they are computed once per subject in a first pass    #
+# and stored in the cache (see `forward_solution.py`). The forward solutions of all runs are then computed from the    #
+# cached intermediates in a second pass. In both passes the core budget is split between the number of processes and   #
+# MNE's `n_jobs` within each process.                                                                                  #
+########################################################################################################################
+
+
+def get_forward_solution_batch(entries: List[Tuple[str, Union[str, Path, mne.Info], Union[str, Path, mne.Transform]]],
+                               dst_files: List[Union[str, Path]], subjects_dir: Union[str, Path], layers: int,
+                               spacing: str = "ico5", cache_dir: Union[None, str, Path] = None,
+                               n_cores: Union[None, int] = None) -> List[Path]:
+    """
+    Run `get_forward_solution` for many runs in a process pool and save the results
+    :param entries: list of (subject, info, trans). Info and trans are objects or paths to files
+    :param dst_files: path to save each forward solution to, should end with `-fwd.fif`
+    :param subjects_dir: path to freesurfer directory
+    :param layers: 1 or 3 layers (see `get_forward_solution`)
+    :param spacing: spacing of dipoles (see `get_forward_solution`)
+    :param cache_dir: directory to cache source spaces and BEM solutions in. If None, a temporary directory is used
+        for the duration of the batch
+    :param n_cores: total number of cores to use, default all
+    :return:
+        paths to the forward solutions
+    """
+
+    if len(entries) != len(dst_files):
+        raise ValueError(f"Got {len(entries)} entries and {len(dst_files)} destination files")
+    if n_cores is None:
+        n_cores = os.cpu_count()
+
+    conductivity = get_conductivity(layers)
+    subjects = list(dict.fromkeys(subject for subject, _, _ in entries))
+    dst_files = [Path(dst_file) for dst_file in dst_files]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        if cache_dir is None:
+            cache_dir = tmp_dir
+
+        # Source spaces and BEM solutions
+        logger.info(f"Preparing source spaces and BEM solutions of {len(subjects)} subjects")
+        _run_pool(_prepare_subject, [(subject, subjects_dir, spacing, conductivity, cache_dir)
+                                     for subject in subjects], n_cores)
+
+        # Forward solutions
+        logger.info(f"Computing {len(entries)} forward solutions")
+        _run_pool(_forward_file, [(subject, info, trans, dst_file, subjects_dir, layers, spacing, cache_dir)
+                                  for (subject, info, trans), dst_file in zip(entries, dst_files)], n_cores)
+
+    return dst_files
+
+
+def _run_pool(function, jobs: List[tuple], n_cores: int):
+    """
+    Run `function(*job, n_jobs)` for each job, splitting the core budget between processes and `n_jobs`
+    :param function: function executed in the worker processes
+    :param jobs: arguments of each call
+    :param n_cores: total number of cores
+    :return:
+    """
+
+    n_workers, n_jobs = split_cores(len(jobs), n_cores)
+
+    # Spawned workers inherit the thread limits before numpy is imported
+    with limit_threads(n_jobs), \
+            ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+
+        futures = {executor.submit(function, *job, n_jobs): job for job in jobs}
+        for future in as_completed(futures):
+            future.result()  # raise errors from the workers
+
+
+def _prepare_subject(subject: str, subjects_dir: Union[str, Path], spacing: str, conductivity: Tuple[float, ...],
+                     cache_dir: Union[str, Path], n_jobs: int):
+    """ Compute and cache the source space and BEM solution of a subject (executed in the worker processes) """
+
+    get_source_space(subject, subjects_dir, spacing=spacing, cache_dir=cache_dir, n_jobs=n_jobs)
+    get_bem_solution(subject, subjects_dir, conductivity, cache_dir=cache_dir)
+
+    logger.info(f"Prepared {subject}")
+
+
+def _forward_file(subject: str, info: Union[str, Path, mne.Info], trans: Union[str, Path, mne.Transform],
+                  dst_file: Path, subjects_dir: Union[str, Path], layers: int, spacing: str,
+                  cache_dir: Union[str, Path], n_jobs: int):
+    """ Compute and save a forward solution from the cached intermediates (executed in the worker processes) """
+
+    if not isinstance(info, mne.Info):
+        info = mne.io.read_info(info)
+
+    fwd = get_forward_solution(info, trans, subject, subjects_dir, layers, spacing=spacing, cache_dir=cache_dir,
+                               n_jobs=n_jobs)
+    mne.write_forward_solution(dst_file, fwd, overwrite=True)
+
+    logger.info(f"Computed {dst_file.name}")
@@ -1,9 +1,16 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import os
 from pathlib import Path
-from typing import Union
+import pickle
+import time
+from typing import List, Tuple, Union
 
 import mne
 import numpy as np
+import pandas as pd
 
+from ..utils.cache import atomic_path, hash_params, hash_path
 from ..utils.logging import setup_logging
 
 logger = setup_logging(name="coregistration", level="info", mne_level="info")
@@ -12,7 +19,8 @@ logger = setup_logging(name="coregistration", level="info", mne_level="info")
 def get_trans(info_file: Union[str, Path], dst_dir: Union[str, Path], subject: str, subjects_dir: Union[str, Path],
               fiducials: str = "auto",
               initial_n_iterations: int = 6, initial_nasion_weight: float = 2.0, distance: float = 5.0,
-              final_n_iterations: int = 20, final_nasion_weight: float = 10.0):
+              final_n_iterations: int = 20, final_nasion_weight: float = 10.0,
+              tolerance_angle: float = 0.2, tolerance_distance: float = 0.2, n_starts: int = 1, n_jobs: int = 1):
     """
     Perform automated coregistration
     See https://mne.tools/stable/auto_tutorials/forward/25_automated_coreg.html
@@ -27,15 +35,132 @@ def get_trans(info_file: Union[str, Path], dst_dir: Union[str, Path], subject: s
     :param distance: max. distance to determine outliers (see mne.coreg.Coregistration.html)
     :param final_n_iterations: number of iterations for the final ICP (see mne.coreg.Coregistration.html)
     :param final_nasion_weight: nasion weight for the final ICP (see mne.coreg.Coregistration.html)
+    :param tolerance_angle: an ICP stops when an iteration rotates less than this (degrees), see `fit_trans`
+    :param tolerance_distance: and moves less than this (mm)
+    :param n_starts: number of starting transforms, see `fit_trans`
+    :param n_jobs: number of starts fitted in parallel
     :return:
     """
 
+    trans, _, _ = fit_trans(info_file, subject, subjects_dir, fiducials=fiducials,
+                            initial_n_iterations=initial_n_iterations, initial_nasion_weight=initial_nasion_weight,
+                            distance=distance, final_n_iterations=final_n_iterations,
+                            final_nasion_weight=final_nasion_weight, tolerance_angle=tolerance_angle,
+                            tolerance_distance=tolerance_distance, n_starts=n_starts, n_jobs=n_jobs)
+
+    # Write result
+    mne.write_trans(Path(dst_dir) / f"{subject}-auto-trans.fif", trans=trans, overwrite=True)
+
+
+def fit_trans(info_file: Union[str, Path], subject: str, subjects_dir: Union[str, Path], fiducials: str = "auto",
+              initial_n_iterations: int = 6, initial_nasion_weight: float = 2.0, distance: float = 5.0,
+              final_n_iterations: int = 20, final_nasion_weight: float = 10.0,
+              tolerance_angle: float = 0.2, tolerance_distance: float = 0.2,
+              n_starts: int = 1, perturbation_angle: float = 5.0, perturbation_distance: float = 5.0,
+              seed: int = 0, n_jobs: int = 1, head_cache: Union[None, "HeadCache"] = None,
+              head_cache_dir: Union[None, str, Path] = None) -> Tuple[mne.transforms.Transform, np.ndarray, int]:
+    """
+    Automated coregistration as in `get_trans`, without writing the result. Each ICP stops early once an iteration
+    changes the transform by less than the tolerances. With `n_starts > 1` the ICPs are also run from randomly
+    perturbed copies of the fiducial-based transform and the result with the lowest mean distance of all head shape
+    points (including the omitted ones, so that the starts are compared on the same points) is kept
+    :param info_file: path to FIF file
+    :param subject: subject name
+    :param subjects_dir: path to FreeSurfer `subjects_dir`
+    :param fiducials: fiducials estimation (see `get_trans`)
+    :param initial_n_iterations: max. number of iterations for the first ICP
+    :param initial_nasion_weight: nasion weight for the first ICP
+    :param distance: max. distance to determine outliers
+    :param final_n_iterations: max. number of iterations for the final ICP
+    :param final_nasion_weight: nasion weight for the final ICP
+    :param tolerance_angle: rotation per iteration below which an ICP stops, in degrees
+    :param tolerance_distance: translation per iteration below which an ICP stops, in mm
+    :param n_starts: number of starting transforms, the first one is not perturbed
+    :param perturbation_angle: max. rotation of the perturbed starts around each axis, in degrees
+    :param perturbation_distance: max. translation of the perturbed starts along each axis, in mm
+    :param seed: random seed of the perturbations
+    :param n_jobs: number of starts fitted in parallel (processes), all processes share the head surfaces read here
+    :param head_cache: cache of head surfaces, None for `HEAD_CACHE`
+    :param head_cache_dir: on-disk cache directory of the head surfaces (see `HeadCache`), None for in-memory only
+    :return:
+        trans: head to MRI transform
+        dists: distances between the (not omitted) head shape points and the MRI head surface in mm
+        n_iterations: number of ICP iterations used by the kept start
+    """
+
+    params = {"fiducials": fiducials, "initial_n_iterations": initial_n_iterations,
+              "initial_nasion_weight": initial_nasion_weight, "distance": distance,
+              "final_n_iterations": final_n_iterations, "final_nasion_weight": final_nasion_weight,
+              "tolerance_angle": tolerance_angle, "tolerance_distance": tolerance_distance}
+    starts = get_starts(n_starts, perturbation_angle, perturbation_distance, seed=seed)
+
+    if head_cache is None:
+        head_cache = HEAD_CACHE
+
+    if n_jobs == 1 or n_starts == 1:
+        params.update(head_cache=head_cache, head_cache_dir=head_cache_dir)
+        results = [_fit_start(info_file, subject, subjects_dir, start, **params) for start in starts]
+    else:
+        # Read the head surfaces once, the workers get a copy with only this subject
+        params.update(head_cache=head_cache.share(subject, subjects_dir, head_cache_dir), head_cache_dir=None)
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_fit_start, info_file, subject, subjects_dir, start, **params)
+                       for start in starts]
+            results = [future.result() for future in futures]
+
+    best = int(np.argmin([score for _, _, _, score in results]))
+    trans, dists, n_iterations, _ = results[best]
+
+    # Result summary
+    if n_starts > 1:
+        logger.info(f"Kept start {best + 1}/{n_starts}, mean distance of all points "
+                    f"{', '.join(f'{score:.2f}' for _, _, _, score in results)} mm")
+    logger.info(f"Distance between HSP and MRI (mean/min/max): {np.mean(dists):.2f} mm "
+                f"/ {np.min(dists):.2f} mm / {np.max(dists):.2f} mm after {n_iterations} ICP iterations")
+
+    return trans, dists, n_iterations
+
+
+def get_starts(n_starts: int, perturbation_angle: float, perturbation_distance: float, seed: int = 0) -> np.ndarray:
+    """
+    Perturbations of the starting transform, uniformly distributed
+    :param n_starts: number of starts, the first one is not perturbed
+    :param perturbation_angle: max. rotation around each axis, in degrees
+    :param perturbation_distance: max. translation along each axis, in mm
+    :param seed: random seed
+    :return:
+        (n_starts, 6) rotations (radians) and translations (m)
+    """
+
+    rng = np.random.default_rng(seed)
+    scale = np.concatenate([np.full(3, np.deg2rad(perturbation_angle)), np.full(3, perturbation_distance / 1e3)])
+
+    starts = rng.uniform(-1.0, 1.0, size=(n_starts, 6)) * scale
+    starts[0] = 0.0
+
+    return starts
+
+
+def _fit_start(info_file: Union[str, Path], subject: str, subjects_dir: Union[str, Path], start: np.ndarray,
+               fiducials: str, initial_n_iterations: int, initial_nasion_weight: float, distance: float,
+               final_n_iterations: int, final_nasion_weight: float, tolerance_angle: float,
+               tolerance_distance: float, head_cache: "HeadCache",
+               head_cache_dir: Union[None, str, Path]) -> Tuple[mne.transforms.Transform, np.ndarray, int, float]:
+    """
+    Coregistration from a single start (executed in the worker processes if fitted in parallel)
+    :return:
+        trans, distances of the not omitted points (mm), number of ICP iterations, mean distance of all points (mm)
+    """
+
     # Setup
     info = mne.io.read_info(info_file)
-    coreg = mne.coreg.Coregistration(info, subject=subject, subjects_dir=subjects_dir, fiducials=fiducials)
+    coreg = CachedCoregistration(info, subject=subject, subjects_dir=subjects_dir, fiducials=fiducials,
+                                 head_cache=head_cache, head_cache_dir=head_cache_dir)
+    coreg.set_tolerance(angle=tolerance_angle, distance=tolerance_distance)
 
     # Initial fit
     coreg.fit_fiducials()
+    coreg.perturb(rotation=start[:3], translation=start[3:])
 
     # Refine with ICP
     coreg.fit_icp(n_iterations=initial_n_iterations, nasion_weight=initial_nasion_weight)
@@ -46,10 +171,340 @@ def get_trans(info_file: Union[str, Path], dst_dir: Union[str, Path], subject: s
     # Final ICP
     coreg.fit_icp(n_iterations=final_n_iterations, nasion_weight=final_nasion_weight)
 
-    # Result summary
     dists = coreg.compute_dig_mri_distances() * 1e3  # in mm
-    logger.info(f"Distance between HSP and MRI (mean/min/max): {np.mean(dists):.2f} mm "
-                f"/ {np.min(dists):.2f} mm / {np.max(dists):.2f} mm")
+    score = np.mean(coreg.compute_dig_mri_distances(omitted=True)) * 1e3
 
-    # Write result
-    mne.write_trans(dst_dir / f"{subject}-auto-trans.fif", trans=coreg.trans, overwrite=True)
+    return coreg.trans, dists, coreg.n_iterations, float(score)
+
+
+########################################################################################################################
+# Head surface cache                                                                                                   #
+#                                                                                                                      #
+# Reading the subject's head surfaces (and decimating the high resolution one if there is no low resolution surface)   #
+# is the same for every run of a subject. The surfaces are read with the public MNE readers, from the files MNE        #
+# searches for (in the same order), and cached in memory (LRU) and optionally on disk, keyed by the content of the     #
+# files and the MNE version. `CachedCoregistration` is built with the `mne.coreg.Coregistration` constructor and only  #
+# takes the surfaces from the cache, everything computed from them is left to MNE.                                     #
+########################################################################################################################
+
+
+# Relative to the subject directory, as searched by `mne.coreg.Coregistration`
+HIGH_RES_HEAD_FILES = ["bem/{subject}-head-dense.fif", "surf/lh.seghead", "surf/lh.smseghead"]
+LOW_RES_HEAD_FILES = ["bem/outer_skin.surf", "bem/{subject}-head-sparse.fif", "bem/{subject}-head.fif"]
+
+
+class HeadCache:
+    """
+    In-memory LRU cache of head surfaces with an optional on-disk cache shared between processes and runs
+    """
+
+    def __init__(self, max_size: int = 4):
+        """
+        :param max_size: max. number of subjects kept in memory
+        """
+
+        self.max_size = max_size
+        self._heads = OrderedDict()
+
+    def get(self, subject: str, subjects_dir: Union[str, Path], cache_dir: Union[None, str, Path] = None) -> dict:
+        """
+        Get the head surfaces of a subject, reading them if they are not cached
+        :param subject: subject name
+        :param subjects_dir: path to FreeSurfer `subjects_dir`
+        :param cache_dir: on-disk cache directory, None for in-memory cache only
+        :return:
+            {'high_res': high resolution surface, 'low_res': low resolution surface}
+        """
+
+        return self._get(*self._key(subject, subjects_dir), cache_dir)
+
+    def share(self, subject: str, subjects_dir: Union[str, Path],
+              cache_dir: Union[None, str, Path] = None) -> "HeadCache":
+        """
+        Cache with only the head surfaces of one subject, e.g. to send to worker processes
+        :param subject: subject name
+        :param subjects_dir: path to FreeSurfer `subjects_dir`
+        :param cache_dir: on-disk cache directory, None for in-memory cache only
+        :return:
+            cache of size 1
+        """
+
+        key, paths = self._key(subject, subjects_dir)
+
+        shared = HeadCache(max_size=1)
+        shared._heads[key] = self._get(key, paths, cache_dir)
+
+        return shared
+
+    def clear(self):
+        self._heads.clear()
+
+    def _get(self, key: str, paths: List[Union[None, Path]], cache_dir: Union[None, str, Path]) -> dict:
+
+        # In memory, also written to the disk cache for other processes
+        file = None if cache_dir is None else Path(cache_dir) / f"{key}-head.pkl"
+        if key in self._heads:
+            self._heads.move_to_end(key)
+            if file is not None and not file.exists():
+                self._write(file, self._heads[key])
+            return self._heads[key]
+
+        # On disk
+        if file is not None and file.exists():
+            with open(file, "rb") as f:
+                head = pickle.load(f)
+        else:
+            head = self._prepare(*paths)
+            if file is not None:
+                self._write(file, head)
+
+        self._heads[key] = head
+        if len(self._heads) > self.max_size:
+            self._heads.popitem(last=False)
+
+        return head
+
+    @staticmethod
+    def _key(subject: str, subjects_dir: Union[str, Path]) -> Tuple[str, List[Union[None, Path]]]:
+        """ Key of the content of the head surface files and the MNE version, and the high and low resolution files """
+
+        paths = [find_head_file(subject, subjects_dir, files) for files in [HIGH_RES_HEAD_FILES, LOW_RES_HEAD_FILES]]
+        if all(path is None for path in paths):
+            raise RuntimeError(f"No head surface was found for subject {subject} in {subjects_dir}")
+        key = hash_params(mne.__version__, subject, [None if path is None else hash_path(path) for path in paths])
+
+        return key, paths
+
+    @staticmethod
+    def _prepare(high_res_path: Union[None, Path], low_res_path: Union[None, Path]) -> dict:
+        """ Read the surfaces the same way as `mne.coreg.Coregistration` """
+
+        high_res = read_head_surface(low_res_path if high_res_path is None else high_res_path)
+        if low_res_path is None:
+            logger.warning(f"No low resolution head surface found, decimating {high_res_path}")
+            rr, tris = mne.decimate_surface(high_res["rr"], high_res["tris"], n_triangles=5120, verbose=False)
+            low_res = mne.surface.complete_surface_info({"rr": rr, "tris": tris}, copy=False, verbose=False)
+        else:
+            low_res = read_head_surface(low_res_path)
+
+        return {"high_res": high_res, "low_res": low_res}
+
+    @staticmethod
+    def _write(file: Path, head: dict):
+
+        if not file.parent.exists():
+            os.makedirs(file.parent, exist_ok=True)
+
+        tmp = atomic_path(file)
+        with open(tmp, "wb") as f:
+            pickle.dump(head, f)
+        os.replace(tmp, file)
+
+
+HEAD_CACHE = HeadCache()
+
+
+def find_head_file(subject: str, subjects_dir: Union[str, Path], files: List[str]) -> Union[None, Path]:
+    """
+    First existing head surface file
+    :param subject: subject name
+    :param subjects_dir: path to FreeSurfer `subjects_dir`
+    :param files: candidate files relative to the subject directory, e.g. `HIGH_RES_HEAD_FILES`
+    :return:
+        path, None if none of the files exists
+    """
+
+    for file in files:
+        path = Path(subjects_dir) / subject / file.format(subject=subject)
+        if path.exists():
+            return path
+
+    return None
+
+
+def read_head_surface(path: Path) -> dict:
+    """
+    Read a head surface from a BEM FIF file or a FreeSurfer surface file
+    :param path: path to the surface file
+    :return:
+        surface in m, with normals and neighbour information
+    """
+
+    if path.suffix == ".fif":
+        return mne.read_bem_surfaces(path, on_defects="raise", verbose=False)[0]
+
+    surf = mne.read_surface(path, return_dict=True, verbose=False)[2]
+    surf["rr"] *= 1e-3  # millimeter to meter
+
+    return mne.surface.complete_surface_info(surf, copy=False, verbose=False)
+
+
+class CachedCoregistration(mne.coreg.Coregistration):
+    """
+    `mne.coreg.Coregistration` which takes the head surfaces from a `HeadCache`. Also counts the ICP iterations
+    (`n_iterations`) and exposes the ICP stopping criterion (`set_tolerance`)
+    """
+
+    def __init__(self, info: mne.Info, subject: str, subjects_dir: Union[str, Path], fiducials="auto",
+                 head_cache: Union[None, HeadCache] = None, head_cache_dir: Union[None, str, Path] = None):
+        """
+        :param info: measurement info with the digitization
+        :param subject: subject name
+        :param subjects_dir: path to FreeSurfer `subjects_dir`
+        :param fiducials: see `mne.coreg.Coregistration`
+        :param head_cache: cache of head surfaces, None for `HEAD_CACHE`
+        :param head_cache_dir: on-disk cache directory, None for in-memory cache only
+        """
+
+        # Used by `_setup_bem` during `__init__`
+        self._head = (HEAD_CACHE if head_cache is None else head_cache).get(subject, subjects_dir, head_cache_dir)
+        super().__init__(info, subject=subject, subjects_dir=subjects_dir, fiducials=fiducials)
+
+        self.n_iterations = 0
+
+    def set_tolerance(self, angle: float = 0.2, distance: float = 0.2) -> "CachedCoregistration":
+        """
+        Stop an ICP once an iteration rotates less than `angle` (degrees) and moves less than `distance` (mm). The
+        defaults are the thresholds of MNE
+        """
+
+        # `Coregistration.fit_icp` unpacks `_changes` (translation in mm, rotation in degrees) as `angle, move`, so it
+        # compares the translation with `_icp_angle` and the rotation with `_icp_distance`
+        self._icp_angle, self._icp_distance = distance, angle
+
+        return self
+
+    def perturb(self, rotation: np.ndarray, translation: np.ndarray) -> "CachedCoregistration":
+        """
+        Add to the current rotation (radians) and translation (m)
+        """
+
+        self.set_rotation(self._rotation + rotation)
+        self.set_translation(self._translation + translation)
+
+        return self
+
+    def fit_icp(self, *args, callback=None, **kwargs) -> "CachedCoregistration":
+        """ `mne.coreg.Coregistration.fit_icp`, counting the iterations """
+
+        def count(iteration, n_iterations):
+            self.n_iterations += 1
+            if callback is not None:
+                callback(iteration, n_iterations)
+
+        return super().fit_icp(*args, callback=count, **kwargs)
+
+    def compute_dig_mri_distances(self, omitted: bool = False) -> np.ndarray:
+        """
+        Distances between the head shape points and the MRI head surface in m
+        :param omitted: if True, include the points omitted by `omit_head_shape_points`
+        :return:
+            distances
+        """
+
+        if not omitted:
+            return super().compute_dig_mri_distances()
+
+        extra_points_filter, self._extra_points_filter = self._extra_points_filter, None
+        try:
+            return super().compute_dig_mri_distances()
+        finally:
+            self._extra_points_filter = extra_points_filter
+
+    def _setup_bem(self):
+        """ Called by `mne.coreg.Coregistration.__init__` instead of reading the surfaces """
+
+        self._bem_high_res = self._head["high_res"]
+        self._bem_low_res = self._head["low_res"]
+
+
+########################################################################################################################
+# Coregistration of many runs                                                                                          #
+#                                                                                                                      #
+# The head surfaces of each subject are prepared once and cached on disk, then the runs are coregistered in a process  #
+# pool. Each transform is saved as `{info file name}-auto-trans.fif` and a summary of all runs as a CSV table.         #
+########################################################################################################################
+
+
+def get_trans_batch(pairs: List[Tuple[Union[str, Path], str]], dst_dir: Union[str, Path],
+                    subjects_dir: Union[str, Path], head_cache_dir: Union[None, str, Path] = None,
+                    summary_file: Union[None, str, Path] = None, n_jobs: int = 1, **params) -> pd.DataFrame:
+    """
+    Run the automated coregistration of `get_trans` on many (info file, subject) pairs in a process pool
+    :param pairs: list of (info file, subject) pairs
+    :param dst_dir: directory to save the trans files in
+    :param subjects_dir: path to FreeSurfer `subjects_dir`
+    :param head_cache_dir: directory to cache the prepared head surfaces in, default `dst_dir/head-cache`
+    :param summary_file: path to save the summary table to, default `dst_dir/coregistration.csv`
+    :param n_jobs: number of worker processes
+    :param params: other parameters of `fit_trans` (fiducials, ICP iterations, weights and tolerances, outlier
+        distance, multi-start; starts are fitted one after the other within each worker)
+    :return:
+        summary: [info_file, subject, trans_file, duration, mean_distance, min_distance, max_distance, n_points,
+            n_iterations], durations in seconds and distances in mm
+    """
+
+    dst_dir = Path(dst_dir)
+    if not dst_dir.exists():
+        os.makedirs(dst_dir)
+    if head_cache_dir is None:
+        head_cache_dir = dst_dir / "head-cache"
+    if summary_file is None:
+        summary_file = dst_dir / "coregistration.csv"
+
+    subjects = list(dict.fromkeys(subject for _, subject in pairs))
+    jobs = [(info_file, subject, dst_dir / f"{_strip_suffix(info_file)}-auto-trans.fif")
+            for info_file, subject in pairs]
+
+    if n_jobs == 1:
+        for subject in subjects:
+            HEAD_CACHE.get(subject, subjects_dir, head_cache_dir)
+        rows = [_get_trans_file(*job, subjects_dir, head_cache_dir, params) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # Prepare the head surfaces first so that runs of the same subject do not prepare them at the same time
+            for future in [executor.submit(_prepare_head, subject, subjects_dir, head_cache_dir)
+                           for subject in subjects]:
+                future.result()  # raise errors from the workers
+            futures = [executor.submit(_get_trans_file, *job, subjects_dir, head_cache_dir, params) for job in jobs]
+            rows = [future.result() for future in futures]
+
+    summary = pd.DataFrame(rows)
+    summary.to_csv(summary_file, index=False)
+
+    return summary
+
+
+def _prepare_head(subject: str, subjects_dir: Union[str, Path], head_cache_dir: Union[str, Path]):
+    """ Prepare and cache the head surfaces of a subject (executed in the worker processes) """
+
+    HEAD_CACHE.get(subject, subjects_dir, head_cache_dir)
+
+
+def _get_trans_file(info_file: Union[str, Path], subject: str, trans_file: Path, subjects_dir: Union[str, Path],
+                    head_cache_dir: Union[str, Path], params: dict) -> dict:
+    """
+    Coregister a single run and save the transform (executed in the worker processes)
+    :param info_file: path to FIF file
+    :param subject: subject name
+    :param trans_file: path to save the transform to
+    :param subjects_dir: path to FreeSurfer `subjects_dir`
+    :param head_cache_dir: on-disk cache directory of the head surfaces
+    :param params: other parameters of `fit_trans`
+    :return:
+        summary row
+    """
+
+    start = time.time()
+    trans, dists, n_iterations = fit_trans(info_file, subject, subjects_dir, head_cache_dir=head_cache_dir, **params)
+    mne.write_trans(trans_file, trans=trans, overwrite=True)
+
+    return {"info_file": str(info_file), "subject": subject, "trans_file": str(trans_file),
+            "duration": time.time() - start, "mean_distance": np.mean(dists), "min_distance": np.min(dists),
+            "max_distance": np.max(dists), "n_points": len(dists), "n_iterations": n_iterations}
+
+
+def _strip_suffix(file: Union[str, Path]) -> str:
+    """ File name without extension, e.g. `sub-01_meg` for `sub-01_meg.fif` or `sub-01_meg.ds` """
+
+    return Path(file).name.split(".")[0]
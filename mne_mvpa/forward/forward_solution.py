@@ -1,10 +1,19 @@
+import os
 from pathlib import Path
-from typing import Union
+import tempfile
+from typing import Callable, List, Tuple, Union
+
 import mne
 
+from ..utils.cache import hash_params, hash_path
+from ..utils.logging import setup_logging
+
+logger = setup_logging(name="forward_solution", level="info", mne_level="info")
+
 
 def get_forward_solution(info: mne.Info, trans: str, subject: str, subjects_dir: Union[str, Path], layers: int,
-                         spacing: str = "ico5") -> mne.Forward:
+                         spacing: str = "ico5", cache_dir: Union[None, str, Path] = None,
+                         n_jobs: int = 1) -> mne.Forward:
     """
     Get forward model specific for the subject. https://mne.tools/stable/auto_tutorials/forward/30_forward.html
     :param info: Info object about the data
@@ -19,11 +28,29 @@ def get_forward_solution(info: mne.Info, trans: str, subject: str, subjects_dir:
         'ico4'    |                   2562 |                 6.2  |                           39  |
         'oct6'    |                   4098 |                 4.9  |                           24  |
         'ico5'    |                  10242 |                 3.1  |                           9.8 |
+    :param cache_dir: directory to cache the source space, BEM model and BEM solution in, which only depend on the
+        subject's FreeSurfer surfaces and not on the run (see `get_source_space` and `get_bem_solution`). None to
+        compute them on every call
+    :param n_jobs: number of jobs for `mne.setup_source_space` and `mne.make_forward_solution`
     :return:
         Forward model
     """
 
-    src = mne.setup_source_space(subject, spacing=spacing, subjects_dir=subjects_dir)
+    src = get_source_space(subject, subjects_dir, spacing=spacing, cache_dir=cache_dir, n_jobs=n_jobs)
+    bem = get_bem_solution(subject, subjects_dir, get_conductivity(layers), cache_dir=cache_dir)
+
+    fwd = mne.make_forward_solution(info=info, trans=trans, src=src, bem=bem,
+                                    meg=True, eeg=False, mindist=5.0, n_jobs=n_jobs)
+    return fwd
+
+
+def get_conductivity(layers: int) -> Tuple[float, ...]:
+    """
+    Conductivity of the BEM layers
+    :param layers: 1 or 3 layers
+    :return:
+        conductivity for `mne.make_bem_model`
+    """
 
     if layers == 3:
         conductivity = (0.3, 0.006, 0.3)    # for three layers
@@ -32,10 +59,119 @@ def get_forward_solution(info: mne.Info, trans: str, subject: str, subjects_dir:
     else:
         raise ValueError(f"Invalid layer number \"{layers}\" was given")
 
-    model = mne.make_bem_model(subject=subject, ico=None, conductivity=conductivity, subjects_dir=subjects_dir)
-    bem = mne.make_bem_solution(model)
+    return conductivity
 
-    fwd = mne.make_forward_solution(info=info, trans=trans, src=src, bem=bem,
-                                    meg=True, eeg=False, mindist=5.0, n_jobs=1)
-    return fwd
 
+########################################################################################################################
+# Cache of the subject specific intermediates                                                                          #
+#                                                                                                                      #
+# Source space, BEM model and BEM solution are stored as `{key}-src.fif`, `{key}-bem.fif` and `{key}-bem-sol.fif`      #
+# where `key` is a hash of the subject, the parameters, the MNE version and the content of the FreeSurfer surfaces     #
+# they are computed from. Re-running FreeSurfer or the watershed algorithm therefore invalidates the cache.            #
+########################################################################################################################
+
+
+# FreeSurfer surfaces each intermediate is computed from, relative to `subjects_dir/subject`
+_SOURCE_SPACE_SURFACES = ["surf/lh.white", "surf/rh.white", "surf/lh.sphere", "surf/rh.sphere"]
+_BEM_SURFACES = ["bem/inner_skull.surf", "bem/outer_skull.surf", "bem/outer_skin.surf"]
+
+
+def get_source_space(subject: str, subjects_dir: Union[str, Path], spacing: str = "ico5",
+                     cache_dir: Union[None, str, Path] = None, n_jobs: int = 1) -> mne.SourceSpaces:
+    """
+    `mne.setup_source_space`, cached
+    :param subject: subject name
+    :param subjects_dir: path to freesurfer directory
+    :param spacing: spacing of dipoles (see `get_forward_solution`)
+    :param cache_dir: cache directory, None to not cache
+    :param n_jobs: number of jobs to compute the distances between sources with
+    :return:
+        source space
+    """
+
+    def compute():
+        return mne.setup_source_space(subject, spacing=spacing, subjects_dir=subjects_dir, n_jobs=n_jobs)
+
+    if cache_dir is None:
+        return compute()
+
+    key = get_cache_key(subject, subjects_dir, _SOURCE_SPACE_SURFACES, spacing)
+
+    return _cached(Path(cache_dir) / f"{key}-src.fif", compute, mne.write_source_spaces, mne.read_source_spaces)
+
+
+def get_bem_solution(subject: str, subjects_dir: Union[str, Path], conductivity: Tuple[float, ...],
+                     cache_dir: Union[None, str, Path] = None) -> mne.bem.ConductorModel:
+    """
+    `mne.make_bem_model` and `mne.make_bem_solution`, cached
+    :param subject: subject name
+    :param subjects_dir: path to freesurfer directory
+    :param conductivity: conductivity of the layers (see `get_conductivity`)
+    :param cache_dir: cache directory, None to not cache
+    :return:
+        BEM solution
+    """
+
+    def compute_model():
+        return mne.make_bem_model(subject=subject, ico=None, conductivity=conductivity, subjects_dir=subjects_dir)
+
+    if cache_dir is None:
+        return mne.make_bem_solution(compute_model())
+
+    key = get_cache_key(subject, subjects_dir, _BEM_SURFACES[:len(conductivity)], conductivity)
+    cache_dir = Path(cache_dir)
+
+    def compute_solution():
+        model = _cached(cache_dir / f"{key}-bem.fif", compute_model, mne.write_bem_surfaces, mne.read_bem_surfaces)
+        return mne.make_bem_solution(model)
+
+    return _cached(cache_dir / f"{key}-bem-sol.fif", compute_solution, mne.write_bem_solution,
+                   mne.read_bem_solution)
+
+
+def get_cache_key(subject: str, subjects_dir: Union[str, Path], surfaces: List[str], *params) -> str:
+    """
+    Cache key of a subject specific intermediate
+    :param subject: subject name
+    :param subjects_dir: path to freesurfer directory
+    :param surfaces: FreeSurfer surface files the intermediate is computed from, relative to `subjects_dir/subject`
+        (missing files are ignored, MNE raises an error when computing the intermediate)
+    :param params: other parameters, e.g. spacing or conductivity
+    :return:
+        hash
+    """
+
+    subject_dir = Path(subjects_dir) / subject
+    surface_hashes = {surface: hash_path(subject_dir / surface) for surface in surfaces
+                      if (subject_dir / surface).exists()}
+
+    return hash_params(mne.__version__, subject, surface_hashes, *params)
+
+
+def _cached(file: Path, compute: Callable, write: Callable, read: Callable):
+    """
+    Read `file` if it exists, otherwise compute and write it
+    :param file: cache file
+    :param compute: () -> object
+    :param write: (file, object, overwrite) -> None, e.g. `mne.write_source_spaces`
+    :param read: (file) -> object, e.g. `mne.read_source_spaces`
+    :return:
+        object
+    """
+
+    if file.exists():
+        logger.info(f"Reading cached {file.name}")
+        return read(file)
+
+    result = compute()
+
+    if not file.parent.exists():
+        os.makedirs(file.parent, exist_ok=True)
+
+    # Write under the final name (MNE checks the file name endings) in a temporary directory, then move in place
+    with tempfile.TemporaryDirectory(dir=file.parent) as tmp_dir:
+        tmp = Path(tmp_dir) / file.name
+        write(tmp, result, overwrite=True)
+        os.replace(tmp, file)
+
+    return result
@@ -0,0 +1,111 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Tuple, Union
+
+import mne
+import numpy as np
+import pandas as pd
+
+
+########################################################################################################################
+# Memory-mapped epochs                                                                                                 #
+#                                                                                                                      #
+# A directory containing                                                                                               #
+# `data.npy`: float32 array (n_epochs, n_channels, n_times) of calibrated data (SI units), opened with                 #
+#     `np.load(mmap_mode="r")`                                                                                         #
+# `epochs-info.fif`: measurement info (sampling frequency after decimation)                                            #
+# `events.npy`: events of the epochs                                                                                   #
+# `metadata.parquet`: one row per epoch (if any), e.g. the `combine_visual` columns of the events                      #
+# `epochs.json`: first time, event_id, indices of the kept events (`selection`) and the parameters                     #
+########################################################################################################################
+
+
+DATA_FILE = "data.npy"
+INFO_FILE = "epochs-info.fif"
+EVENTS_FILE = "events.npy"
+METADATA_FILE = "metadata.parquet"
+META_FILE = "epochs.json"
+
+
+def create_epochs_mmap(out_dir: Union[str, Path], info: mne.Info, events: np.ndarray, n_times: int, tmin: float,
+                       event_id: Union[None, Dict[str, int]] = None, metadata: Union[None, pd.DataFrame] = None,
+                       selection: Union[None, np.ndarray] = None, params: Union[None, dict] = None) -> np.memmap:
+    """
+    Create empty epochs in the memory-mapped format, to be filled incrementally
+    :param out_dir: directory to save the epochs in
+    :param info: measurement info of the epochs
+    :param events: events of the epochs (n_epochs, 3)
+    :param n_times: number of time points
+    :param tmin: time of the first sample in seconds
+    :param event_id: {name: event code}, default one name per code
+    :param metadata: one row per epoch
+    :param selection: indices of the epochs in the original events, default all
+    :param params: JSON serializable parameters stored with the epochs (e.g. baseline and decimation)
+    :return:
+        writable float32 memory map (n_epochs, n_channels, n_times)
+    """
+
+    out_dir = Path(out_dir)
+    if not out_dir.exists():
+        os.makedirs(out_dir)
+
+    if metadata is not None and len(metadata) != len(events):
+        raise ValueError(f"Got {len(metadata)} metadata rows for {len(events)} events")
+    if event_id is None:
+        event_id = {str(code): int(code) for code in np.unique(events[:, 2])}
+    if selection is None:
+        selection = np.arange(len(events))
+
+    mne.io.write_info(out_dir / INFO_FILE, info, overwrite=True)
+    np.save(out_dir / EVENTS_FILE, np.asarray(events, dtype=np.int64))
+    if metadata is not None:
+        metadata.reset_index(drop=True).to_parquet(out_dir / METADATA_FILE)
+    elif (out_dir / METADATA_FILE).exists():
+        os.remove(out_dir / METADATA_FILE)
+
+    with open(out_dir / META_FILE, "w") as f:
+        json.dump({"tmin": float(tmin), "event_id": {name: int(code) for name, code in event_id.items()},
+                   "selection": [int(idx) for idx in selection], "params": {} if params is None else params}, f)
+
+    return np.lib.format.open_memmap(out_dir / DATA_FILE, mode="w+", dtype=np.float32,
+                                     shape=(len(events), len(info["ch_names"]), int(n_times)))
+
+
+def read_epochs_mmap(in_dir: Union[str, Path], mmap_mode: Union[None, str] = "r") -> Tuple[np.ndarray, dict]:
+    """
+    Read epochs in the memory-mapped format
+    :param in_dir: directory the epochs were saved in
+    :param mmap_mode: memory-map mode of `np.load`, None to read the data into memory
+    :return:
+        data: float32 array (n_epochs, n_channels, n_times)
+        metadata: {'tmin', 'event_id', 'selection', 'params', 'info', 'events', 'metadata': data frame or None}
+    """
+
+    in_dir = Path(in_dir)
+
+    data = np.load(in_dir / DATA_FILE, mmap_mode=mmap_mode)
+
+    with open(in_dir / META_FILE) as f:
+        metadata = json.load(f)
+    metadata["selection"] = np.array(metadata["selection"], dtype=int)
+    metadata["info"] = mne.io.read_info(in_dir / INFO_FILE, verbose=False)
+    metadata["events"] = np.load(in_dir / EVENTS_FILE)
+    metadata["metadata"] = pd.read_parquet(in_dir / METADATA_FILE) if (in_dir / METADATA_FILE).exists() else None
+
+    return data, metadata
+
+
+def get_epochs(in_dir: Union[str, Path]) -> mne.EpochsArray:
+    """
+    Epochs in memory, e.g. for plotting or MNE functions which need `mne.Epochs`
+    :param in_dir: directory the epochs were saved in
+    :return:
+        epochs
+    """
+
+    data, metadata = read_epochs_mmap(in_dir)
+
+    return mne.EpochsArray(np.asarray(data, dtype=np.float64), metadata["info"], events=metadata["events"],
+                           tmin=metadata["tmin"], event_id=metadata["event_id"], metadata=metadata["metadata"],
+                           baseline=None, verbose=False)
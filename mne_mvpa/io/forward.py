@@ -0,0 +1,120 @@
+import json
+import os
+from pathlib import Path
+from typing import Tuple, Union
+
+import mne
+from mne.io.constants import FIFF
+import numpy as np
+
+
+########################################################################################################################
+# Memory-mapped forward format                                                                                         #
+#                                                                                                                      #
+# A directory containing                                                                                               #
+# `gain.npy`: float32 gain matrix (n_channels, n_sources) for fixed or (n_channels, 3 * n_sources) for free            #
+#     orientation, opened with `np.load(mmap_mode="r")` so that processes on one node share the page-cached matrix     #
+# `sources.npz`: source positions `rr`, orientations `nn` and the vertices of each source space (`vertices_{idx}`)     #
+# `fwd-info.fif`, `fwd-src.fif`, `fwd-trans.fif`: measurement info, source spaces and MRI to head transform            #
+# `fwd.json`: channel names, orientation and coordinate frame                                                          #
+#                                                                                                                      #
+# Fixed orientation is normal to the cortical surface, free orientation is stored in the original (XYZ) orientation.   #
+########################################################################################################################
+
+
+GAIN_FILE = "gain.npy"
+SOURCES_FILE = "sources.npz"
+INFO_FILE = "fwd-info.fif"
+SRC_FILE = "fwd-src.fif"
+TRANS_FILE = "fwd-trans.fif"
+META_FILE = "fwd.json"
+
+
+def save_forward_mmap(fwd: mne.Forward, out_dir: Union[str, Path], fixed: bool = True):
+    """
+    Save a forward solution in the memory-mapped format
+    :param fwd: forward solution
+    :param out_dir: directory to save the forward solution in
+    :param fixed: if True, only the orientation normal to the cortical surface is kept (3x smaller gain matrix). MNE
+        needs the free orientation for depth weighting, fixed orientation inverse operators are then made with
+        `depth=None`
+    :return:
+    """
+
+    out_dir = Path(out_dir)
+    if not out_dir.exists():
+        os.makedirs(out_dir)
+
+    if fixed:
+        fwd = mne.convert_forward_solution(fwd, surf_ori=True, force_fixed=True, copy=True, verbose=False)
+    else:
+        fwd = mne.convert_forward_solution(fwd, surf_ori=False, force_fixed=False, copy=True, verbose=False)
+
+    gain = np.lib.format.open_memmap(out_dir / GAIN_FILE, mode="w+", dtype=np.float32,
+                                     shape=tuple(int(n) for n in fwd["sol"]["data"].shape))
+    gain[:] = fwd["sol"]["data"]
+    gain.flush()
+    del gain
+
+    vertices = {f"vertices_{idx}": src["vertno"] for idx, src in enumerate(fwd["src"])}
+    np.savez(out_dir / SOURCES_FILE, rr=fwd["source_rr"], nn=fwd["source_nn"], **vertices)
+
+    # The info of a forward solution only has the channel and transform fields, `sfreq` is not used
+    info = mne.create_info(fwd["info"]["ch_names"], sfreq=1.0)
+    with info._unlock():
+        for key in ["chs", "dev_head_t", "bads", "custom_ref_applied"]:
+            if key in fwd["info"]:
+                info[key] = fwd["info"][key]
+    mne.io.write_info(out_dir / INFO_FILE, info, overwrite=True)
+    mne.write_source_spaces(out_dir / SRC_FILE, fwd["src"], overwrite=True, verbose=False)
+    mne.write_trans(out_dir / TRANS_FILE, fwd["mri_head_t"], overwrite=True)
+
+    with open(out_dir / META_FILE, "w") as f:
+        json.dump({"ch_names": fwd["sol"]["row_names"], "fixed": fixed, "coord_frame": int(fwd["coord_frame"])}, f)
+
+
+def read_gain_mmap(in_dir: Union[str, Path], mmap_mode: Union[None, str] = "r") -> Tuple[np.ndarray, dict]:
+    """
+    Read the gain matrix and the source metadata only
+    :param in_dir: directory of the memory-mapped forward solution
+    :param mmap_mode: memory-map mode of `np.load`, None to read the gain matrix into memory
+    :return:
+        gain: float32 gain matrix (n_channels, n_sources) or (n_channels, 3 * n_sources)
+        metadata: {'ch_names', 'fixed', 'coord_frame', 'rr', 'nn', 'vertices': list of vertices of each source space}
+    """
+
+    in_dir = Path(in_dir)
+
+    gain = np.load(in_dir / GAIN_FILE, mmap_mode=mmap_mode)
+
+    with open(in_dir / META_FILE) as f:
+        metadata = json.load(f)
+    with np.load(in_dir / SOURCES_FILE) as npz:
+        n_src = len([key for key in npz.files if key.startswith("vertices_")])
+        metadata.update(rr=npz["rr"], nn=npz["nn"], vertices=[npz[f"vertices_{idx}"] for idx in range(n_src)])
+
+    return gain, metadata
+
+
+def read_forward_mmap(in_dir: Union[str, Path], mmap_mode: Union[None, str] = "r") -> mne.Forward:
+    """
+    Read a forward solution saved with `save_forward_mmap`, e.g. to make inverse operators
+    :param in_dir: directory of the memory-mapped forward solution
+    :param mmap_mode: memory-map mode of `np.load`, None to read the gain matrix into memory
+    :return:
+        forward solution whose gain matrix is the (read-only) memory map
+    """
+
+    in_dir = Path(in_dir)
+    gain, metadata = read_gain_mmap(in_dir, mmap_mode=mmap_mode)
+    source_ori = FIFF.FIFFV_MNE_FIXED_ORI if metadata["fixed"] else FIFF.FIFFV_MNE_FREE_ORI
+
+    sol = {"data": gain, "nrow": gain.shape[0], "ncol": gain.shape[1], "row_names": metadata["ch_names"],
+           "col_names": []}
+
+    return mne.Forward(sol=sol, _orig_sol=gain, sol_grad=None, source_ori=source_ori, _orig_source_ori=source_ori,
+                       surf_ori=metadata["fixed"], coord_frame=metadata["coord_frame"], nsource=len(metadata["rr"]),
+                       nchan=gain.shape[0], source_rr=metadata["rr"], source_nn=metadata["nn"],
+                       info=mne.io.read_info(in_dir / INFO_FILE, verbose=False),
+                       src=mne.read_source_spaces(in_dir / SRC_FILE, verbose=False),
+                       mri_head_t=mne.read_trans(in_dir / TRANS_FILE))
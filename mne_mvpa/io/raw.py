@@ -0,0 +1,137 @@
+import json
+import os
+from pathlib import Path
+from typing import Union
+
+import mne
+import numpy as np
+
+
+########################################################################################################################
+# Memory-mapped raw format                                                                                             #
+#                                                                                                                      #
+# A directory containing                                                                                               #
+# `data.npy`: float32 array (n_channels, n_times) of calibrated data (SI units), opened with `np.load(mmap_mode="r")`  #
+# `raw-info.fif`: measurement info (original calibration of the channels)                                              #
+# `raw-annot.fif`: annotations (if any)                                                                                #
+# `raw.json`: first sample                                                                                             #
+########################################################################################################################
+
+
+DATA_FILE = "data.npy"
+INFO_FILE = "raw-info.fif"
+ANNOT_FILE = "raw-annot.fif"
+META_FILE = "raw.json"
+
+
+def save_raw_mmap(raw: mne.io.BaseRaw, out_dir: Union[str, Path], chunk_duration: float = 60.0):
+    """
+    Save raw in the memory-mapped format, reading it in chunks if it is not preloaded
+    :param raw: raw object
+    :param out_dir: directory to save the data in
+    :param chunk_duration: length of the chunks copied at a time in seconds
+    :return:
+    """
+
+    data = create_raw_mmap(raw.info, raw.n_times, out_dir, first_samp=raw.first_samp, annotations=raw.annotations)
+
+    chunk_size = max(int(round(chunk_duration * raw.info["sfreq"])), 1)
+    for start in range(0, raw.n_times, chunk_size):
+        stop = min(start + chunk_size, raw.n_times)
+        data[:, start:stop] = raw.get_data(start=start, stop=stop)
+
+    data.flush()
+
+
+def create_raw_mmap(info: mne.Info, n_times: int, out_dir: Union[str, Path], first_samp: int = 0,
+                    annotations: Union[None, mne.Annotations] = None) -> np.memmap:
+    """
+    Create an empty raw in the memory-mapped format, to be filled incrementally
+    :param info: measurement info
+    :param n_times: number of samples
+    :param out_dir: directory to save the data in
+    :param first_samp: first sample of the data
+    :param annotations: annotations to save with the data
+    :return:
+        writable float32 memory map (n_channels, n_times)
+    """
+
+    out_dir = Path(out_dir)
+    if not out_dir.exists():
+        os.makedirs(out_dir)
+
+    # Data is stored calibrated, the info keeps the original calibration (see `RawMmap`)
+    mne.io.write_info(out_dir / INFO_FILE, info, overwrite=True)
+
+    if annotations is not None and len(annotations) > 0:
+        annotations.save(out_dir / ANNOT_FILE, overwrite=True)
+    elif (out_dir / ANNOT_FILE).exists():
+        os.remove(out_dir / ANNOT_FILE)
+
+    with open(out_dir / META_FILE, "w") as f:
+        json.dump({"first_samp": int(first_samp)}, f)
+
+    return np.lib.format.open_memmap(out_dir / DATA_FILE, mode="w+", dtype=np.float32,
+                                     shape=(len(info["ch_names"]), int(n_times)))
+
+
+class RawMmap(mne.io.BaseRaw):
+    """
+    Raw in the memory-mapped format. Without preloading, only the requested spans are read from disk. The float32 data
+    can also be accessed without copying through `mmap`
+    """
+
+    def __init__(self, fname: Union[str, Path], preload: bool = False, verbose=None):
+        """
+        :param fname: directory the data was saved in with `save_raw_mmap`
+        :param preload: load all data into memory
+        :param verbose: MNE verbosity
+        """
+
+        fname = Path(fname)
+        info = mne.io.read_info(fname / INFO_FILE, verbose=False)
+        with open(fname / META_FILE, "r") as f:
+            first_samp = json.load(f)["first_samp"]
+
+        n_times = np.load(fname / DATA_FILE, mmap_mode="r").shape[1]
+
+        # Calibration of the channels, already applied to the stored data
+        cals = np.array([ch["cal"] * ch["range"] for ch in info["chs"]])
+
+        super().__init__(info, preload, first_samps=[first_samp], last_samps=[first_samp + n_times - 1],
+                         filenames=[fname], raw_extras=[{"first_samp": first_samp, "cals": cals}],
+                         orig_format="single", verbose=verbose)
+
+        if (fname / ANNOT_FILE).exists():
+            self.set_annotations(mne.read_annotations(fname / ANNOT_FILE))
+
+    @property
+    def mmap(self) -> np.memmap:
+        """ Read-only float32 memory map (n_channels, n_times) of the data on disk """
+
+        return np.load(Path(self.filenames[0]) / DATA_FILE, mmap_mode="r")
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        """
+        Read a chunk of data, see `mne.io.BaseRaw._read_segment_file` (`start` and `stop` include `first_samp`). The
+        stored data is calibrated, so `cals` are not applied and are divided out of `mult`
+        """
+
+        first_samp = self._raw_extras[fi]["first_samp"]
+        one = np.load(Path(self._filenames[fi]) / DATA_FILE, mmap_mode="r")[:, start - first_samp:stop - first_samp]
+        if mult is not None:
+            data[:] = mult @ (one[idx] / self._raw_extras[fi]["cals"][idx, np.newaxis])
+        else:
+            data[:] = one[idx]
+
+
+def read_raw_mmap(file: str, preload: bool) -> RawMmap:
+    """
+    Read raw in the memory-mapped format, satisfies `RawReader`
+    :param file: directory the data was saved in with `save_raw_mmap`
+    :param preload: load all data into memory
+    :return:
+        RawMmap
+    """
+
+    return RawMmap(file, preload=preload)
@@ -0,0 +1,112 @@
+import json
+import os
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import mne
+import numpy as np
+
+
+########################################################################################################################
+# Memory-mapped source estimates                                                                                       #
+#                                                                                                                      #
+# A directory containing                                                                                               #
+# `data.npy`: float32 array (n_epochs, n_sources, n_times) of the source estimates of all epochs (or of the summary    #
+#     time courses of labels, `n_sources` is then the number of labels), opened with `np.load(mmap_mode="r")`          #
+# `sources.npz`: vertices of each source space (`vertices_{idx}`)                                                      #
+# `events.npy`: events of the epochs (if any)                                                                          #
+# `stc.json`: first time, time step, subject and the parameters the estimates were computed with                       #
+########################################################################################################################
+
+
+DATA_FILE = "data.npy"
+SOURCES_FILE = "sources.npz"
+EVENTS_FILE = "events.npy"
+META_FILE = "stc.json"
+
+
+def create_source_mmap(out_dir: Union[str, Path], n_epochs: int, vertices: List[np.ndarray], n_times: int,
+                       tmin: float, tstep: float, subject: Union[None, str] = None, src_type: str = "surface",
+                       events: Union[None, np.ndarray] = None, n_sources: Union[None, int] = None,
+                       params: Union[None, dict] = None) -> np.memmap:
+    """
+    Create empty source estimates in the memory-mapped format, to be filled incrementally
+    :param out_dir: directory to save the estimates in
+    :param n_epochs: number of epochs
+    :param vertices: vertices of each source space
+    :param n_times: number of time points
+    :param tmin: time of the first sample in seconds
+    :param tstep: time step in seconds
+    :param subject: subject name
+    :param src_type: 'surface', 'volume', 'mixed' or 'discrete'
+    :param events: events of the epochs (n_epochs, 3)
+    :param n_sources: number of rows per epoch, default the number of vertices (e.g. number of labels for summary
+        time courses)
+    :param params: JSON serializable parameters stored with the estimates (e.g. method and lambda2)
+    :return:
+        writable float32 memory map (n_epochs, n_sources, n_times)
+    """
+
+    out_dir = Path(out_dir)
+    if not out_dir.exists():
+        os.makedirs(out_dir)
+
+    if n_sources is None:
+        n_sources = sum(len(vertno) for vertno in vertices)
+    if events is not None and len(events) != n_epochs:
+        raise ValueError(f"Got {len(events)} events for {n_epochs} epochs")
+
+    np.savez(out_dir / SOURCES_FILE, **{f"vertices_{idx}": vertno for idx, vertno in enumerate(vertices)})
+    if events is not None:
+        np.save(out_dir / EVENTS_FILE, events)
+    elif (out_dir / EVENTS_FILE).exists():
+        os.remove(out_dir / EVENTS_FILE)
+
+    with open(out_dir / META_FILE, "w") as f:
+        json.dump({"tmin": float(tmin), "tstep": float(tstep), "subject": subject, "src_type": src_type,
+                   "params": {} if params is None else params}, f)
+
+    return np.lib.format.open_memmap(out_dir / DATA_FILE, mode="w+", dtype=np.float32,
+                                     shape=(int(n_epochs), int(n_sources), int(n_times)))
+
+
+def read_source_mmap(in_dir: Union[str, Path], mmap_mode: Union[None, str] = "r") -> Tuple[np.ndarray, dict]:
+    """
+    Read source estimates in the memory-mapped format
+    :param in_dir: directory the estimates were saved in
+    :param mmap_mode: memory-map mode of `np.load`, None to read the data into memory
+    :return:
+        data: float32 array (n_epochs, n_sources, n_times)
+        metadata: {'tmin', 'tstep', 'subject', 'src_type', 'params', 'vertices': list of vertices of each source space,
+            'events': events or None}
+    """
+
+    in_dir = Path(in_dir)
+
+    data = np.load(in_dir / DATA_FILE, mmap_mode=mmap_mode)
+
+    with open(in_dir / META_FILE) as f:
+        metadata = json.load(f)
+    with np.load(in_dir / SOURCES_FILE) as npz:
+        metadata["vertices"] = [npz[f"vertices_{idx}"] for idx in range(len(npz.files))]
+    metadata["events"] = np.load(in_dir / EVENTS_FILE) if (in_dir / EVENTS_FILE).exists() else None
+
+    return data, metadata
+
+
+def get_source_estimate(in_dir: Union[str, Path], idx: int) -> mne.SourceEstimate:
+    """
+    Source estimate of a single epoch, e.g. for plotting
+    :param in_dir: directory the estimates were saved in
+    :param idx: index of the epoch
+    :return:
+        source estimate of the type of the source spaces
+    """
+
+    data, metadata = read_source_mmap(in_dir)
+    if data.shape[1] != sum(len(vertno) for vertno in metadata["vertices"]):
+        raise ValueError("The estimates are not of single vertices (e.g. label time courses)")
+
+    return mne.source_estimate._make_stc(np.array(data[idx]), metadata["vertices"], src_type=metadata["src_type"],
+                                         tmin=metadata["tmin"], tstep=metadata["tstep"],
+                                         subject=metadata["subject"])
@@ -0,0 +1,127 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import multiprocessing
+import os
+from pathlib import Path
+import tempfile
+import time
+from typing import List, Tuple, Union
+
+from .filter import filter
+from ..definitions import RawReader
+from ..utils.logging import setup_logging
+from ..utils.parallel import limit_threads, split_cores
+
+logger = setup_logging(name="filter_batch", level="info", mne_level="info")
+
+
+########################################################################################################################
+# Filter many raw files                                                                                                #
+#                                                                                                                      #
+# Files are distributed over a process pool. The core budget is split between the number of files filtered at the      #
+# same time and `n_jobs` within each file, and files are only started while their estimated memory usage fits in the   #
+# memory limit (largest files first).                                                                                  #
+########################################################################################################################
+
+
+def filter_batch(manifest: List[Tuple[Union[str, Path], Union[str, Path]]], l_freq: float, h_freq: float,
+                 raw_reader: RawReader, filter_params: Union[None, dict] = None,
+                 notch: Union[None, List[float], float] = None, notch_max: float = 250.0,
+                 notch_params: Union[None, dict] = None, chunk_duration: Union[None, float] = None,
+                 fused: bool = False, kernel_cache_dir: Union[None, str, Path] = None,
+                 n_cores: Union[None, int] = None, n_workers: Union[None, int] = None,
+                 memory_limit: Union[None, float] = None, memory_factor: float = 4.0, out_format: str = "fif",
+                 target_sfreq: Union[None, float] = None):
+    """
+    Run `filter` on many files in parallel
+    :param manifest: list of (raw file, output file) pairs
+    :param l_freq: high-pass frequency
+    :param h_freq: low-pass frequency
+    :param raw_reader: dataset specific raw file reader, (path: str, preload: bool) -> mne.io.Raw. Must be picklable
+    :param filter_params: other parameters for filter function (`n_jobs` is set by the core budget)
+    :param notch: either powerline frequency (float), list of notch frequencies (List[float]) or no notch filter (None)
+    :param notch_max: maximum frequency for notch filter, only used if powerline frequency is provided
+    :param notch_params: other parameters for notch_filter function (`n_jobs` is set by the core budget)
+    :param chunk_duration: chunk length in seconds for streaming mode, None to preload (see `filter`)
+    :param fused: apply band-pass and notch filters as a single kernel (see `filter`)
+    :param kernel_cache_dir: directory to cache designed filters in. If None, a temporary directory is shared by the
+        workers for the duration of the batch
+    :param n_cores: total number of cores to use, default all
+    :param n_workers: number of files filtered at the same time, default determined by `split_cores`
+    :param memory_limit: max. total estimated memory in bytes, None for no limit
+    :param memory_factor: estimated memory usage as a multiple of the file size (see `estimate_memory`)
+    :param out_format: 'fif' or 'mmap' (see `filter`)
+    :param target_sfreq: sampling frequency to decimate to (see `filter`)
+    :return:
+    """
+
+    if n_cores is None:
+        n_cores = os.cpu_count()
+    n_workers, n_jobs = split_cores(len(manifest), n_cores, n_workers=n_workers)
+
+    filter_params = {**(filter_params or {}), "n_jobs": n_jobs}
+    notch_params = {**(notch_params or {}), "n_jobs": n_jobs}
+
+    # Largest files first
+    jobs = [(raw_file, out_file, estimate_memory(raw_file, memory_factor)) for raw_file, out_file in manifest]
+    pending = sorted(jobs, key=lambda job: job[2], reverse=True)
+
+    logger.info(f"Filtering {len(manifest)} files with {n_workers} workers x {n_jobs} jobs")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        if kernel_cache_dir is None:
+            kernel_cache_dir = tmp_dir
+
+        # Spawned workers inherit the thread limits before numpy is imported
+        with limit_threads(n_jobs), \
+                ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+
+            running = {}  # future -> (raw file, estimated memory, start time)
+            while pending or running:
+
+                # Start files which fit in the memory limit (a file is always started if nothing else is running)
+                for job in list(pending):
+                    raw_file, out_file, memory = job
+                    used = sum(estimate for _, estimate, _ in running.values())
+                    if len(running) >= n_workers:
+                        break
+                    if memory_limit is not None and running and used + memory > memory_limit:
+                        continue
+                    if memory_limit is not None and memory > memory_limit:
+                        logger.warning(f"{raw_file} is estimated to exceed the memory limit on its own")
+
+                    future = executor.submit(filter, raw_file=raw_file, out_file=out_file, l_freq=l_freq,
+                                             h_freq=h_freq, raw_reader=raw_reader, filter_params=filter_params,
+                                             notch=notch, notch_max=notch_max, notch_params=notch_params,
+                                             chunk_duration=chunk_duration, fused=fused,
+                                             kernel_cache_dir=kernel_cache_dir, out_format=out_format,
+                                             target_sfreq=target_sfreq)
+                    running[future] = (raw_file, memory, time.time())
+                    pending.remove(job)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    raw_file, _, start = running.pop(future)
+                    future.result()  # raise errors from the workers
+                    logger.info(f"Filtered {raw_file} in {time.time() - start:.1f} s")
+
+
+def estimate_memory(raw_file: Union[str, Path], memory_factor: float = 4.0) -> float:
+    """
+    Estimate the memory needed to filter a file from its size on disk. The default factor assumes data stored as
+    32-bit values (loaded as 64-bit) and a working copy during filtering. Use a lower factor in streaming mode
+    :param raw_file: path to the raw file or directory (e.g. CTF `.ds`)
+    :param memory_factor: memory usage as a multiple of the file size
+    :return:
+        estimated memory in bytes
+    """
+
+    raw_file = Path(raw_file)
+
+    if raw_file.is_dir():
+        size = sum(file.stat().st_size for file in raw_file.rglob("*") if file.is_file())
+    else:
+        size = raw_file.stat().st_size
+
+    return size * memory_factor
+
@@ -0,0 +1,142 @@
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import mne
+from mne._fiff.pick import _pick_data_channels, _picks_to_idx
+from mne.annotations import _sync_onset
+from mne.utils.mixin import _check_decim
+import numpy as np
+import pandas as pd
+
+from ..definitions import RawReader
+from ..io.epochs import create_epochs_mmap
+from ..utils.logging import setup_logging
+
+logger = setup_logging(name="epoch", level="info", mne_level="info")
+
+
+########################################################################################################################
+# Streaming epoching                                                                                                   #
+#                                                                                                                      #
+# Epochs are cut from the raw file without preloading it: the windows are sorted and grouped into spans of at most     #
+# `chunk_duration` seconds, each span is read once and the windows in it are extracted, baseline corrected and         #
+# decimated in batches before being written to a preallocated memory map (see `io/epochs.py`). The result is the same  #
+# as `mne.Epochs(..., preload=True)`: windows outside of the data or overlapping 'bad' annotations are dropped, the    #
+# baseline is subtracted before decimation and decimation keeps the sample at time 0.                                  #
+########################################################################################################################
+
+
+def epoch(raw_file: Union[str, Path], out_dir: Union[str, Path], events: np.ndarray, raw_reader: RawReader,
+          tmin: float = -0.2, tmax: float = 0.5, baseline: Union[None, Tuple[Union[None, float], Union[None, float]]]
+          = (None, 0), decim: int = 1, picks: Union[str, List[str]] = "data",
+          event_id: Union[None, Dict[str, int]] = None, metadata: Union[None, pd.DataFrame] = None,
+          reject_by_annotation: bool = True, chunk_duration: float = 60.0, batch_size: int = 64) -> Path:
+    """
+    Cut epochs from a (filtered) raw file into memory-mapped epochs
+    :param raw_file: path to the raw file
+    :param out_dir: directory to save the epochs in (see `io/epochs.py`)
+    :param events: selected events (n, 3), samples of the raw file (see `resample_events` for decimated raw files)
+    :param raw_reader: dataset specific raw file reader, (path: str, preload: bool) -> mne.io.Raw
+    :param tmin: start of the epochs in seconds
+    :param tmax: end of the epochs in seconds (inclusive)
+    :param baseline: baseline interval (see `mne.Epochs`), None for no baseline correction
+    :param decim: decimation factor, the raw file should be low-passed accordingly
+    :param picks: channels to keep (see `mne.Epochs`)
+    :param event_id: {name: event code}, default one name per code
+    :param metadata: one row per event, e.g. the `combine_visual` columns of the selected events (see
+        `EventSelector.get_metadata`). Rows of dropped events are dropped
+    :param reject_by_annotation: whether to drop epochs overlapping annotations starting with 'bad'
+    :param chunk_duration: max. length of the spans of data read at a time in seconds
+    :param batch_size: number of epochs processed at a time
+    :return:
+        path to the epochs
+    """
+
+    events = np.asarray(events, dtype=np.int64)
+    if metadata is not None and len(metadata) != len(events):
+        raise ValueError(f"Got {len(metadata)} metadata rows for {len(events)} events")
+
+    raw = raw_reader(str(raw_file), preload=False)
+    sfreq = raw.info["sfreq"]
+
+    # Samples of the epochs relative to the events
+    start_offset, stop_offset = int(round(tmin * sfreq)), int(round(tmax * sfreq)) + 1
+    n_raw_times = stop_offset - start_offset
+    raw_times = np.arange(start_offset, stop_offset) / sfreq
+
+    picks = _picks_to_idx(raw.info, picks, "all", exclude=())
+    info = mne.pick_info(raw.info, picks)
+    baseline_picks = _pick_data_channels(info, exclude=())
+    if baseline is not None:
+        baseline = mne.baseline._check_baseline(baseline, times=raw_times, sfreq=sfreq)
+
+    # Decimation keeps the sample at time 0 (as MNE)
+    decim, _, new_sfreq = _check_decim(info, decim, 0)
+    decim_slice = slice(-start_offset % decim, None, decim)
+    times = raw_times[decim_slice]
+    with info._unlock():
+        info["sfreq"] = new_sfreq
+
+    # Windows in the data and not overlapping bad segments
+    starts = events[:, 0] - raw.first_samp + start_offset
+    keep = (starts >= 0) & (starts + n_raw_times <= raw.n_times)
+    if reject_by_annotation:
+        keep &= ~_overlaps_bad(raw, starts, starts + n_raw_times)
+    selection = np.flatnonzero(keep)
+
+    if len(selection) == 0:
+        raise ValueError(f"No epochs left of {len(events)} events")
+
+    data = create_epochs_mmap(out_dir, info, events[selection], len(times), times[0], event_id=event_id,
+                              metadata=None if metadata is None else metadata.iloc[selection],
+                              selection=selection,
+                              params={"raw_file": str(raw_file), "tmax": float(tmax), "decim": int(decim),
+                                      "baseline": None if baseline is None else list(baseline),
+                                      "reject_by_annotation": reject_by_annotation})
+
+    # Spans of sorted windows, each span is read once
+    order = np.argsort(starts[selection], kind="stable")
+    sorted_starts = starts[selection][order]
+    max_span = max(int(round(chunk_duration * sfreq)), n_raw_times)
+    n_spans = 0
+    span_begin = 0
+    while span_begin < len(order):
+
+        span_start = sorted_starts[span_begin]
+        span_end = int(np.searchsorted(sorted_starts, span_start + max_span - n_raw_times, side="right"))
+        rows = order[span_begin:span_end]
+        span_stop = sorted_starts[span_end - 1] + n_raw_times
+        span = raw.get_data(picks=picks, start=int(span_start), stop=int(span_stop))
+
+        for batch in range(0, len(rows), batch_size):
+            batch_rows = rows[batch:batch + batch_size]
+            offsets = starts[selection[batch_rows]] - span_start
+            windows = span[:, offsets[:, np.newaxis] + np.arange(n_raw_times)].transpose(1, 0, 2)
+            if baseline is not None:
+                windows = mne.baseline.rescale(windows, raw_times, baseline, mode="mean", copy=False,
+                                               picks=baseline_picks, verbose=False)
+            data[np.sort(batch_rows)] = windows[np.argsort(batch_rows)][..., decim_slice]
+
+        span_begin = span_end
+        n_spans += 1
+
+    data.flush()
+    logger.info(f"Epoched {len(selection)} of {len(events)} events from {Path(raw_file).name} in {n_spans} spans "
+                f"({len(events) - len(selection)} dropped)")
+
+    return Path(out_dir)
+
+
+def _overlaps_bad(raw: mne.io.BaseRaw, starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """ Windows [start, stop) (data samples) overlapping annotations starting with 'bad', as `mne.Epochs` """
+
+    annotations = raw.annotations
+    bad = np.array([description.lower().startswith("bad") for description in annotations.description], dtype=bool)
+    if not bad.any():
+        return np.zeros(len(starts), dtype=bool)
+
+    onsets = _sync_onset(raw, annotations.onset[bad])
+    ends = onsets + annotations.duration[bad]
+    sfreq = raw.info["sfreq"]
+
+    return ((onsets < stops[:, np.newaxis] / sfreq) & (ends > starts[:, np.newaxis] / sfreq)).any(axis=1)
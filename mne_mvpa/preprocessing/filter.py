@@ -1,9 +1,20 @@
+from collections import OrderedDict
+import os
 from pathlib import Path
-from typing import Union, List
+import tempfile
+from typing import Union, List, Tuple
 
+import mne
+from mne.annotations import _annotations_starts_stops
+from mne.filter import _filt_check_picks
+from mne.parallel import parallel_func
 import numpy as np
+import pandas as pd
+import scipy.signal
 
 from ..definitions import RawReader
+from ..io.raw import create_raw_mmap, read_raw_mmap, save_raw_mmap
+from ..utils.cache import atomic_path, hash_params
 
 
 ########################################################################################################################
@@ -11,11 +22,17 @@ from ..definitions import RawReader
 ########################################################################################################################
 
 
+OUT_FORMATS = ["fif", "mmap"]
+
+
 def filter(raw_file: Union[str, Path], out_file: Union[str, Path],
            l_freq: float, h_freq: float, raw_reader: RawReader,
            filter_params: Union[None, dict] = None,
            notch: Union[None, List[float], float] = None, notch_max: float = 250.0,
-           notch_params: Union[None, dict] = None):
+           notch_params: Union[None, dict] = None,
+           chunk_duration: Union[None, float] = None, fused: bool = False,
+           kernel_cache_dir: Union[None, str, Path] = None, out_format: str = "fif",
+           target_sfreq: Union[None, float] = None):
     """
     A wrapper around `filter` and `notch_filter`
     :param raw_file: path to the raw file
@@ -29,25 +46,794 @@ def filter(raw_file: Union[str, Path], out_file: Union[str, Path],
     :param notch_max: maximum frequency for notch filter, only used if powerline frequency is provided. e.g., if
         notch = 50.0, and notch_max = 250, then notch filter will be applied at 50, 100, 150, 200 Hz
     :param notch_params: other parameters for notch_filter function
+    :param chunk_duration: if given, the raw file is not preloaded but filtered in chunks of `chunk_duration` seconds
+        (streaming mode, FIR filters only). Peak memory is then bounded by the chunk size, see `filter_streaming`
+    :param fused: if True, band-pass and notch filters are combined into a single kernel (FIR) or SOS cascade (IIR)
+        applied in one pass over the data, see `get_fused_filter`. Zero-phase filters only, `picks` and
+        `skip_by_annotation` must be the same for both filters and `pad` must be 'reflect_limited'
+    :param kernel_cache_dir: directory to cache designed filters in, shared between runs (see `KernelCache`). Designs
+        are always cached in memory
+    :param out_format: 'fif' or 'mmap'. 'mmap' saves `out_file` as a directory with float32 data which can be
+        memory-mapped, read with `mne_mvpa.io.raw.read_raw_mmap`
+    :param target_sfreq: if given, the data is decimated to this sampling frequency in the same pass as the band-pass
+        (the low-pass is the anti-aliasing filter), see `get_decimation_factor`. Implies `fused`. Event samples of the
+        original data can be converted with `resample_events`
     :return:
     """
 
     raw_file, out_file = str(raw_file), str(out_file)
 
-    raw = raw_reader(raw_file, preload=True)
-
-    # Filter
+    if out_format not in OUT_FORMATS:
+        raise ValueError(f"Unknown output format {out_format}")
     if filter_params is None:
         filter_params = {}
-    raw = raw.filter(l_freq, h_freq, **filter_params)
+    if notch_params is None:
+        notch_params = {}
+    notch = get_notch_freqs(notch, notch_max)
+
+    if chunk_duration is not None:
+        filter_streaming(raw_file, out_file, l_freq, h_freq, raw_reader, filter_params=filter_params, notch=notch,
+                         notch_params=notch_params, chunk_duration=chunk_duration, fused=fused,
+                         kernel_cache_dir=kernel_cache_dir, out_format=out_format, target_sfreq=target_sfreq)
+        return
+
+    raw = raw_reader(raw_file, preload=True)
+
+    designed_filter = None
+    if fused or target_sfreq is not None:
+        designed_filter = get_fused_filter(raw.info["sfreq"], l_freq, h_freq, filter_params, notch, notch_params,
+                                           kernel_cache_dir=kernel_cache_dir)
+    elif all(params.get("method", "fir") == "fir" for params in [filter_params, notch_params]):
+        designed_filter = _get_kernel_filter(get_filter_kernels(raw.info["sfreq"], l_freq, h_freq, filter_params,
+                                                                notch, notch_params,
+                                                                kernel_cache_dir=kernel_cache_dir),
+                                             filter_params, notch, notch_params)
+    if target_sfreq is not None:
+        designed_filter = _add_decimation(designed_filter, raw.info["sfreq"], target_sfreq, h_freq)
+    raw = _apply_filters(raw, l_freq, h_freq, filter_params, notch, notch_params, designed_filter=designed_filter)
+
+    if out_format == "mmap":
+        save_raw_mmap(raw, out_file)
+    else:
+        raw.save(out_file)
+
+
+def get_notch_freqs(notch: Union[None, List[float], float], notch_max: float) -> Union[None, List[float], np.ndarray]:
+    """
+    Notch frequencies
+    :param notch: either powerline frequency (float), list of notch frequencies (List[float]) or no notch filter (None)
+    :param notch_max: maximum frequency for notch filter, only used if powerline frequency is provided
+    :return:
+        notch frequencies or None
+    """
 
-    # Notch filter
     if isinstance(notch, float):
         notch = np.arange(0, notch_max, notch)[1:]  # first is 0 Hz
 
+    return notch
+
+
+def _apply_filters(raw: mne.io.BaseRaw, l_freq: float, h_freq: float, filter_params: dict,
+                   notch: Union[None, List[float], np.ndarray], notch_params: dict,
+                   designed_filter: Union[None, dict] = None) -> mne.io.BaseRaw:
+    """
+    Apply band-pass and notch filter in place
+    :param raw: preloaded raw
+    :param l_freq: high-pass frequency
+    :param h_freq: low-pass frequency
+    :param filter_params: other parameters for filter function
+    :param notch: notch frequencies or None
+    :param notch_params: other parameters for notch_filter function
+    :param designed_filter: filter designed in this module (see `_apply_designed_filter`), applied instead of
+        `raw.filter` and `raw.notch_filter` if given
+    :return:
+        filtered raw (a new, decimated raw if `designed_filter` decimates)
+    """
+
+    if designed_filter is not None:
+        apply_params = _get_apply_params(designed_filter["method"], filter_params, notch, notch_params)
+        apply = _apply_decimating_filter if designed_filter.get("down", 1) > 1 else _apply_designed_filter
+        return apply(raw, designed_filter, l_freq, h_freq, picks=apply_params["picks"],
+                     skip_by_annotation=apply_params["skip_by_annotation"], n_jobs=filter_params.get("n_jobs", None))
+
+    # Filter
+    raw = raw.filter(l_freq, h_freq, **filter_params)
+
+    # Notch filter
     if notch is not None:
-        if notch_params is None:
-            notch_params = {}
         raw = raw.notch_filter(notch, **notch_params)
 
-    raw.save(out_file)
+    return raw
+
+
+########################################################################################################################
+# Streaming mode                                                                                                       #
+#                                                                                                                      #
+# The raw file is read in chunks extended by a margin on both sides. The margin is the number of samples the output    #
+# of the FIR filters depends on, so after cropping the margin each chunk is identical to the preloaded result. At the  #
+# beginning and the end of the recording the chunk reaches the edge of the data, and MNE pads it the same way as it    #
+# pads the whole recording.                                                                                            #
+########################################################################################################################
+
+
+# Parameters of `raw.filter` which affect the design of the filter
+_DESIGN_PARAMS = ["filter_length", "l_trans_bandwidth", "h_trans_bandwidth", "method", "iir_params", "phase",
+                  "fir_window", "fir_design"]
+
+# Parameters of `raw.filter` and `raw.notch_filter` which affect how designed filters are applied, and their defaults
+_APPLY_PARAMS = {"picks": None, "skip_by_annotation": ("edge", "bad_acq_skip"), "pad": "reflect_limited"}
+
+
+def filter_streaming(raw_file: Union[str, Path], out_file: Union[str, Path], l_freq: float, h_freq: float,
+                     raw_reader: RawReader, filter_params: Union[None, dict] = None,
+                     notch: Union[None, List[float], np.ndarray] = None, notch_params: Union[None, dict] = None,
+                     chunk_duration: float = 60.0, fused: bool = False,
+                     kernel_cache_dir: Union[None, str, Path] = None, out_format: str = "fif",
+                     target_sfreq: Union[None, float] = None):
+    """
+    Same as `filter` with a bounded memory usage. Filtered chunks are written to a memory-mapped file (`out_file` for
+    the 'mmap' format, a temporary file next to `out_file` which is then saved as FIF otherwise). Only FIR filters are
+    supported. Segments separated by annotations (`skip_by_annotation` of `filter_params`) are streamed and filtered
+    separately and the annotated spans are left unfiltered, as in `raw.filter` (not supported with decimation).
+    Zero-phase kernels are designed once and applied to every chunk directly, other filters are redesigned by
+    `raw.filter` for every chunk
+    :param raw_file: path to the raw file
+    :param out_file: path to save the filtered file to
+    :param l_freq: high-pass frequency
+    :param h_freq: low-pass frequency
+    :param raw_reader: dataset specific raw file reader, (path: str, preload: bool) -> mne.io.Raw
+    :param filter_params: other parameters for filter function
+    :param notch: list of notch frequencies or None
+    :param notch_params: other parameters for notch_filter function
+    :param chunk_duration: length of the chunks in seconds (extended to the filter length if shorter)
+    :param fused: apply band-pass and notch filters as a single kernel, see `get_fused_filter`
+    :param kernel_cache_dir: directory to cache designed filters in (see `KernelCache`)
+    :param out_format: 'fif' or 'mmap' (see `filter`)
+    :param target_sfreq: sampling frequency to decimate to, implies `fused` (see `filter`)
+    :return:
+    """
+
+    if filter_params is None:
+        filter_params = {}
+    if notch_params is None:
+        notch_params = {}
+
+    raw = raw_reader(str(raw_file), preload=False)
+    sfreq, n_times = raw.info["sfreq"], raw.n_times
+
+    down = 1
+    if fused or target_sfreq is not None:
+        designed_filter = get_fused_filter(sfreq, l_freq, h_freq, filter_params, notch, notch_params,
+                                           kernel_cache_dir=kernel_cache_dir)
+        if designed_filter["method"] != "fir":
+            raise ValueError("Only FIR filters are supported in streaming mode")
+        if target_sfreq is not None:
+            designed_filter = _add_decimation(designed_filter, sfreq, target_sfreq, h_freq)
+            down = designed_filter["down"]
+        kernels = [(h, "zero") for h in designed_filter["kernels"]]
+    else:
+        kernels = get_filter_kernels(sfreq, l_freq, h_freq, filter_params, notch, notch_params,
+                                     kernel_cache_dir=kernel_cache_dir)
+        designed_filter = _get_kernel_filter(kernels, filter_params, notch, notch_params)
+    margin = sum(_get_margin(h, phase) for h, phase in kernels)
+    chunk_size = max([int(round(chunk_duration * sfreq))] + [len(h) for h, _ in kernels])
+
+    # Chunks and margins start on the decimated grid
+    margin, chunk_size = _round_up(margin, down), _round_up(chunk_size, down)
+
+    # Segments filtered separately (see `_apply_designed_filter`), chunks and margins do not cross their edges
+    skip_by_annotation = filter_params.get("skip_by_annotation", _APPLY_PARAMS["skip_by_annotation"])
+    onsets, ends = _annotations_starts_stops(raw, skip_by_annotation, invert=True)
+    if down > 1 and (len(onsets) != 1 or onsets[0] != 0 or ends[0] != n_times):
+        raise ValueError(f"Decimation does not support data split by annotations ({skip_by_annotation})")
+
+    with tempfile.TemporaryDirectory(dir=Path(out_file).parent) as tmp_dir:
+
+        mmap_dir = Path(out_file) if out_format == "mmap" else Path(tmp_dir) / "filtered"
+
+        data = None
+        for start, stop, seg_start, seg_stop in _get_chunks(onsets, ends, chunk_size):
+
+            read_start, read_stop = max(start - margin, seg_start), min(stop + margin, seg_stop)
+
+            chunk = mne.io.RawArray(raw.get_data(start=read_start, stop=read_stop), raw.info, verbose=False)
+            chunk = _apply_filters(chunk, l_freq, h_freq, filter_params, notch, notch_params,
+                                   designed_filter=designed_filter)
+
+            if data is None:  # info of the filtered chunk has updated highpass, lowpass and sfreq
+                data = create_raw_mmap(chunk.info, _n_decimated(n_times, down), mmap_dir,
+                                       first_samp=int(_decimate_samples(raw.first_samp, down)),
+                                       annotations=raw.annotations)
+            out_start, out_stop = start // down, _n_decimated(stop, down)
+            data[:, out_start:out_stop] = chunk.get_data(start=out_start - read_start // down,
+                                                         stop=out_stop - read_start // down)
+
+        # Annotated spans are not filtered
+        if data is None:
+            data = create_raw_mmap(raw.info, n_times, mmap_dir, first_samp=raw.first_samp,
+                                   annotations=raw.annotations)
+        for start, stop in zip(np.concatenate([[0], ends]), np.concatenate([onsets, [n_times]])):
+            for chunk_start in range(start, stop, chunk_size):
+                chunk_stop = min(chunk_start + chunk_size, stop)
+                data[:, chunk_start:chunk_stop] = raw.get_data(start=chunk_start, stop=chunk_stop)
+
+        data.flush()
+        del data
+
+        if out_format == "fif":
+            read_raw_mmap(str(mmap_dir), preload=False).save(str(out_file), overwrite=True)
+
+
+def _get_chunks(onsets: np.ndarray, ends: np.ndarray, chunk_size: int) -> List[Tuple[int, int, int, int]]:
+    """
+    Chunks of the segments which are filtered separately
+    :param onsets: first samples of the segments
+    :param ends: last samples (exclusive) of the segments
+    :param chunk_size: max. number of samples of a chunk
+    :return:
+        [(start, stop, segment start, segment stop), ...]
+    """
+
+    return [(start, min(start + chunk_size, seg_stop), seg_start, seg_stop)
+            for seg_start, seg_stop in zip(onsets, ends) for start in range(seg_start, seg_stop, chunk_size)]
+
+
+def get_filter_kernels(sfreq: float, l_freq: float, h_freq: float, filter_params: Union[None, dict] = None,
+                       notch: Union[None, List[float], np.ndarray] = None,
+                       notch_params: Union[None, dict] = None,
+                       kernel_cache_dir: Union[None, str, Path] = None) -> List[Tuple[np.ndarray, str]]:
+    """
+    FIR kernels applied by `raw.filter` and `raw.notch_filter` with the same parameters
+    :param sfreq: sampling frequency
+    :param l_freq: high-pass frequency
+    :param h_freq: low-pass frequency
+    :param filter_params: other parameters for filter function
+    :param notch: list of notch frequencies or None
+    :param notch_params: other parameters for notch_filter function
+    :param kernel_cache_dir: directory to cache designed filters in (see `KernelCache`)
+    :return:
+        list of (kernel, phase)
+    """
+
+    if filter_params is None:
+        filter_params = {}
+    if notch_params is None:
+        notch_params = {}
+
+    for params in [filter_params, notch_params]:
+        if params.get("method", "fir") != "fir":
+            raise ValueError(f"Only FIR filters are supported, got method \"{params['method']}\"")
+
+    design_params = {key: value for key, value in filter_params.items() if key in _DESIGN_PARAMS}
+    kernels = [(_create_filter(sfreq, l_freq, h_freq, design_params, kernel_cache_dir),
+                design_params.get("phase", "zero"))]
+
+    if notch is not None:
+        lows, highs, design_params = _get_notch_bands(notch, notch_params)
+        kernels.append((_create_filter(sfreq, highs, lows, design_params, kernel_cache_dir),
+                        design_params.get("phase", "zero")))
+
+    return kernels
+
+
+def _get_kernel_filter(kernels: List[Tuple[np.ndarray, str]], filter_params: dict,
+                       notch: Union[None, List[float], np.ndarray], notch_params: dict) -> Union[None, dict]:
+    """
+    Cached kernels applied one after the other, the same as `raw.filter` followed by `raw.notch_filter`
+    :param kernels: kernels from `get_filter_kernels`
+    :param filter_params: other parameters for filter function
+    :param notch: notch frequencies or None
+    :param notch_params: other parameters for notch_filter function
+    :return:
+        {'method': 'fir', 'kernels': kernels}, None if the filters have to be applied by MNE (phases other than 'zero',
+        padding other than 'reflect_limited', or channels or segments which differ between the two filters)
+    """
+
+    if any(phase != "zero" for _, phase in kernels):
+        return None
+
+    all_params = [filter_params, notch_params] if notch is not None else [filter_params]
+    for key, default in _APPLY_PARAMS.items():
+        if any(hash_params(params.get(key, default)) != hash_params(filter_params.get(key, default))
+               for params in all_params):
+            return None
+    if filter_params.get("pad", _APPLY_PARAMS["pad"]) != _APPLY_PARAMS["pad"]:
+        return None
+
+    return {"method": "fir", "kernels": [h for h, _ in kernels]}
+
+
+def _get_notch_bands(notch: Union[List[float], np.ndarray], notch_params: dict) -> Tuple[list, list, dict]:
+    """
+    Stop-bands designed the same way as `mne.filter.notch_filter`
+    :param notch: list of notch frequencies
+    :param notch_params: other parameters for notch_filter function
+    :return:
+        lower edges, upper edges, parameters for `mne.filter.create_filter`
+    """
+
+    freqs = np.atleast_1d(notch).astype(float)
+    widths = notch_params.get("notch_widths", None)
+    widths = freqs / 200.0 if widths is None else np.broadcast_to(np.atleast_1d(widths), freqs.shape)
+    trans_bandwidth = notch_params.get("trans_bandwidth", 1.0) / 2.0
+
+    lows = [freq - width / 2.0 - trans_bandwidth for freq, width in zip(freqs, widths)]
+    highs = [freq + width / 2.0 + trans_bandwidth for freq, width in zip(freqs, widths)]
+
+    design_params = {key: value for key, value in notch_params.items() if key in _DESIGN_PARAMS}
+    design_params.update(l_trans_bandwidth=trans_bandwidth, h_trans_bandwidth=trans_bandwidth)
+
+    return lows, highs, design_params
+
+
+def _get_margin(h: np.ndarray, phase: str) -> int:
+    """
+    Number of samples on either side the output of a FIR filter depends on
+    :param h: kernel
+    :param phase: phase of the filter (see `mne.filter.create_filter`)
+    :return:
+        margin
+    """
+
+    if phase == "zero":
+        return (len(h) - 1) // 2 + 1
+    else:
+        return len(h)  # 'zero-double' filters twice, 'minimum' is causal
+
+
+########################################################################################################################
+# Fused filtering                                                                                                      #
+#                                                                                                                      #
+# Convolving the band-pass kernel with the notch kernel gives a single kernel with the same frequency response as      #
+# applying them one after the other, so the data is transformed only once. Away from the edges of the recording the    #
+# result is the same as the separate filters, at the edges it differs slightly because the data is padded once         #
+# instead of twice.                                                                                                    #
+########################################################################################################################
+
+
+def get_fused_filter(sfreq: float, l_freq: float, h_freq: float, filter_params: Union[None, dict] = None,
+                     notch: Union[None, List[float], np.ndarray] = None,
+                     notch_params: Union[None, dict] = None, kernel_cache_dir: Union[None, str, Path] = None) -> dict:
+    """
+    Combine band-pass and notch filters into a single zero-phase filter
+    :param sfreq: sampling frequency
+    :param l_freq: high-pass frequency
+    :param h_freq: low-pass frequency
+    :param filter_params: other parameters for filter function
+    :param notch: list of notch frequencies or None
+    :param notch_params: other parameters for notch_filter function
+    :param kernel_cache_dir: directory to cache designed filters in (see `KernelCache`)
+    :return:
+        {'method': 'fir', 'kernels': [kernel]} or
+        {'method': 'iir', 'sos': second-order sections, 'padlen': padding length}
+    """
+
+    if filter_params is None:
+        filter_params = {}
+    if notch_params is None:
+        notch_params = {}
+
+    method = filter_params.get("method", "fir")
+    if notch is not None and notch_params.get("method", "fir") != method:
+        raise ValueError("Band-pass and notch filters must use the same method to be fused")
+    for params in [filter_params, notch_params]:
+        if params.get("phase", "zero") != "zero":
+            raise ValueError(f"Only zero-phase filters can be fused, got phase \"{params['phase']}\"")
+
+    # FIR, convolve the kernels
+    if method == "fir":
+        h = np.ones(1)
+        for kernel, _ in get_filter_kernels(sfreq, l_freq, h_freq, filter_params, notch, notch_params,
+                                            kernel_cache_dir=kernel_cache_dir):
+            h = np.convolve(h, kernel)
+        return {"method": "fir", "kernels": [h]}
+
+    # IIR, cascade the second-order sections
+    elif method == "iir":
+        design_params = {key: value for key, value in filter_params.items() if key in _DESIGN_PARAMS}
+        designs = [_create_filter(sfreq, l_freq, h_freq, design_params, kernel_cache_dir)]
+
+        if notch is not None:
+            lows, highs, design_params = _get_notch_bands(notch, notch_params)
+            for low, high in zip(lows, highs):  # MNE designs IIR band-stop filters one at a time
+                designs.append(_create_filter(sfreq, high, low, design_params, kernel_cache_dir))
+
+        for design in designs:
+            if "sos" not in design:
+                raise ValueError("IIR filters must be designed with output='sos' to be fused")
+
+        return {"method": "iir", "sos": np.concatenate([design["sos"] for design in designs]),
+                "padlen": int(sum(design["padlen"] for design in designs))}
+
+    else:
+        raise ValueError(f"Unknown filter method \"{method}\"")
+
+
+def _get_apply_params(method: str, filter_params: dict, notch: Union[None, List[float], np.ndarray],
+                      notch_params: dict) -> dict:
+    """
+    Parameters of `raw.filter` and `raw.notch_filter` honoured by designed filters. Fused filters are applied once, so
+    band-pass and notch filters must agree on them
+    :param method: 'fir' or 'iir'
+    :param filter_params: other parameters for filter function
+    :param notch: notch frequencies or None
+    :param notch_params: other parameters for notch_filter function
+    :return:
+        {'picks', 'skip_by_annotation', 'pad'}
+    """
+
+    apply_params = {}
+    for key, default in _APPLY_PARAMS.items():
+        values = [params.get(key, default) for params in ([filter_params, notch_params] if notch is not None
+                                                          else [filter_params])]
+        if any(hash_params(value) != hash_params(values[0]) for value in values):
+            raise ValueError(f"Band-pass and notch filters must use the same {key} to be applied together")
+        apply_params[key] = values[0]
+
+    # Designed FIR filters pad as 'reflect_limited', IIR filters do not use `pad`
+    if method == "fir" and apply_params["pad"] != _APPLY_PARAMS["pad"]:
+        raise ValueError(f"Only \"{_APPLY_PARAMS['pad']}\" padding is supported, got \"{apply_params['pad']}\"")
+
+    return apply_params
+
+
+def _apply_designed_filter(raw: mne.io.BaseRaw, designed_filter: dict, l_freq: float, h_freq: float,
+                           picks: Union[None, str, List[str], np.ndarray] = None,
+                           skip_by_annotation: Union[str, List[str], Tuple[str, ...]] = ("edge", "bad_acq_skip"),
+                           n_jobs: Union[None, int] = None) -> mne.io.BaseRaw:
+    """
+    Apply a designed filter in place, one channel at a time, to the same channels and segments as `raw.filter`
+    :param raw: preloaded raw
+    :param designed_filter: {'method': 'fir', 'kernels': zero-phase kernels applied one after the other} or IIR filter
+        from `get_fused_filter`
+    :param l_freq: high-pass frequency
+    :param h_freq: low-pass frequency
+    :param picks: channels to filter, default the data channels (see `raw.filter`)
+    :param skip_by_annotation: segments separated by annotations starting with these are filtered separately
+    :param n_jobs: number of channels filtered in parallel
+    :return:
+        filtered raw
+    """
+
+    update_info, picks = _filt_check_picks(raw.info, picks, h_freq, l_freq)
+    if designed_filter["method"] == "fir":
+        fun, kwargs = _fir_filter, {"kernels": designed_filter["kernels"]}
+    else:
+        fun, kwargs = _iir_filter, {"sos": designed_filter["sos"], "padlen": designed_filter["padlen"]}
+
+    parallel, run, _ = parallel_func(fun, n_jobs, verbose=False)
+    for start, stop in zip(*_annotations_starts_stops(raw, skip_by_annotation, invert=True)):
+        for pick, x in zip(picks, parallel(run(raw.get_data(picks=[pick], start=start, stop=stop)[0], **kwargs)
+                                           for pick in picks)):
+            raw[pick, start:stop] = x
+
+    if update_info:
+        _set_filter_info(raw.info, l_freq, h_freq)
+
+    return raw
+
+
+def _set_filter_info(info: mne.Info, l_freq: float, h_freq: float):
+    """ Update highpass and lowpass in place the same way as `raw.filter` (if all data channels are filtered) """
+
+    with info._unlock():
+        if h_freq is not None and (l_freq is None or l_freq < h_freq) and \
+                (info["lowpass"] is None or h_freq < info["lowpass"]):
+            info["lowpass"] = float(h_freq)
+        if l_freq is not None and (h_freq is None or l_freq < h_freq) and \
+                (info["highpass"] is None or l_freq > info["highpass"]):
+            info["highpass"] = float(l_freq)
+
+
+def _fir_filter(x: np.ndarray, kernels: List[np.ndarray]) -> np.ndarray:
+    """
+    Zero-phase FIR filters with odd reflection padding (as 'reflect_limited' in MNE) and overlap-add convolution
+    :param x: signal
+    :param kernels: symmetric kernels of odd length, applied one after the other
+    :return:
+        filtered signal
+    """
+
+    for h in kernels:
+        n_edge = min(len(h), len(x)) - 1
+        x_ext = np.pad(x, n_edge, mode="reflect", reflect_type="odd")
+        x = scipy.signal.oaconvolve(x_ext, h, mode="same")[n_edge:n_edge + len(x)]
+
+    return x
+
+
+def _iir_filter(x: np.ndarray, sos: np.ndarray, padlen: int) -> np.ndarray:
+    """
+    Zero-phase IIR filter (forward-backward)
+    :param x: signal
+    :param sos: second-order sections
+    :param padlen: padding length
+    :return:
+        filtered signal
+    """
+
+    return scipy.signal.sosfiltfilt(sos, x, padlen=min(padlen, len(x) - 1))
+
+
+########################################################################################################################
+# Decimation                                                                                                           #
+#                                                                                                                      #
+# The fused kernel removes everything above the low-pass, so it doubles as the anti-aliasing filter of a polyphase     #
+# decimation: only every `down`-th output sample is computed, in the same pass as the band-pass. Output sample `j` is  #
+# at input sample `j * down`, and input sample `s` maps to output sample `round(s / down)` (halves rounded up). Stim   #
+# channels are not filtered, each output sample is the max. over the input samples mapped to it, so that triggers      #
+# shorter than `down` samples are kept, at the samples `resample_events` gives.                                        #
+########################################################################################################################
+
+
+def get_decimation_factor(sfreq: float, target_sfreq: float) -> int:
+    """
+    Decimation factor from `sfreq` to `target_sfreq`, only integer factors are supported
+    :param sfreq: original sampling frequency
+    :param target_sfreq: target sampling frequency
+    :return:
+        decimation factor
+    """
+
+    down = sfreq / target_sfreq if target_sfreq > 0 else 0.0
+    if down < 1 or not np.isclose(down, round(down)):
+        raise ValueError(f"Sampling frequency {sfreq} Hz is not an integer multiple of {target_sfreq} Hz")
+
+    return int(round(down))
+
+
+def resample_events(events: Union[np.ndarray, pd.DataFrame], sfreq: float, target_sfreq: float,
+                    first_samp: int = 0) -> Union[np.ndarray, pd.DataFrame]:
+    """
+    Convert event samples to the sampling frequency of data decimated by `filter(..., target_sfreq=...)`
+    :param events: (n, 3) events array, or events_df from `combine_visual` (the `sample` column is converted)
+    :param sfreq: original sampling frequency
+    :param target_sfreq: target sampling frequency
+    :param first_samp: `first_samp` of the original raw, the event samples include it
+    :return:
+        copy of the events with converted samples
+    """
+
+    down = get_decimation_factor(sfreq, target_sfreq)
+    first_samp_out = _decimate_samples(first_samp, down)
+
+    if isinstance(events, pd.DataFrame):
+        events = events.copy()
+        events["sample"] = first_samp_out + _decimate_samples(events["sample"].to_numpy() - first_samp, down)
+    else:
+        events = np.array(events, copy=True)
+        events[:, 0] = first_samp_out + _decimate_samples(events[:, 0] - first_samp, down)
+
+    return events
+
+
+def _add_decimation(designed_filter: dict, sfreq: float, target_sfreq: float, h_freq: float) -> dict:
+    """
+    Decimate with a fused filter (see `_apply_decimating_filter`)
+    :param designed_filter: filter from `get_fused_filter`
+    :param sfreq: original sampling frequency
+    :param target_sfreq: target sampling frequency
+    :param h_freq: low-pass frequency, the anti-aliasing filter
+    :return:
+        {'method': 'fir', 'kernels': [kernel], 'down': decimation factor}
+    """
+
+    if designed_filter["method"] != "fir":
+        raise ValueError("Only FIR filters can be combined with decimation")
+    if h_freq is None or h_freq >= target_sfreq / 2:
+        raise ValueError(f"Low-pass frequency must be below the target Nyquist frequency ({target_sfreq / 2} Hz)")
+
+    return {**designed_filter, "down": get_decimation_factor(sfreq, target_sfreq)}
+
+
+def _apply_decimating_filter(raw: mne.io.BaseRaw, designed_filter: dict, l_freq: float, h_freq: float,
+                             picks: Union[None, str, List[str], np.ndarray] = None,
+                             skip_by_annotation: Union[str, List[str], Tuple[str, ...]] = ("edge", "bad_acq_skip"),
+                             n_jobs: Union[None, int] = None) -> mne.io.BaseRaw:
+    """
+    Filter and decimate the picked channels, decimate the stim channels (max. per output sample) and other channels
+    (`scipy.signal.resample_poly`)
+    :param raw: preloaded raw
+    :param designed_filter: filter from `_add_decimation`
+    :param l_freq: high-pass frequency
+    :param h_freq: low-pass frequency
+    :param picks: channels to filter, default the data channels (see `raw.filter`)
+    :param skip_by_annotation: annotations which split the data into separately filtered segments, not supported
+    :param n_jobs: number of channels filtered in parallel
+    :return:
+        new, decimated raw
+    """
+
+    onsets, ends = _annotations_starts_stops(raw, skip_by_annotation, invert=True)
+    if len(onsets) != 1 or onsets[0] != 0 or ends[0] != raw.n_times:
+        raise ValueError(f"Decimation does not support data split by annotations ({skip_by_annotation})")
+
+    down = designed_filter["down"]
+
+    # Same channels as `raw.filter`, reference channels and bad channels included
+    update_info, data_picks = _filt_check_picks(raw.info, picks, h_freq, l_freq)
+
+    info = raw.info.copy()
+    with info._unlock():
+        info["sfreq"] = raw.info["sfreq"] / down
+    if update_info:
+        _set_filter_info(info, l_freq, h_freq)
+    stim_picks = mne.pick_types(info, meg=False, stim=True, exclude=[])
+
+    data = np.empty((len(info.ch_names), _n_decimated(raw.n_times, down)))
+    parallel, run, _ = parallel_func(_fir_decimate, n_jobs, verbose=False)
+    for pick, x in zip(data_picks, parallel(run(raw.get_data(picks=[pick])[0], designed_filter["kernels"], down)
+                                            for pick in data_picks)):
+        data[pick] = x
+
+    for pick in np.setdiff1d(np.arange(len(info.ch_names)), data_picks):
+        x = raw.get_data(picks=[pick])[0]
+        data[pick] = _decimate_stim(x, down) if pick in stim_picks else scipy.signal.resample_poly(x, 1, down)
+
+    decimated = mne.io.RawArray(data, info, first_samp=int(_decimate_samples(raw.first_samp, down)), verbose=False)
+    decimated.set_annotations(raw.annotations)
+
+    return decimated
+
+
+def _fir_decimate(x: np.ndarray, kernels: List[np.ndarray], down: int) -> np.ndarray:
+    """
+    Same as `_fir_filter` followed by taking every `down`-th sample, the last kernel is applied as a polyphase filter
+    :param x: signal
+    :param kernels: symmetric kernels of odd length, the last one must be a low-pass below the target Nyquist frequency
+    :param down: decimation factor
+    :return:
+        filtered and decimated signal
+    """
+
+    x = _fir_filter(x, kernels[:-1])
+    h = kernels[-1]
+
+    n_edge = _round_up(min(len(h), len(x)) - 1, down)  # the padding must not shift the decimated grid
+    x_ext = np.pad(x, n_edge, mode="reflect", reflect_type="odd")
+    y = scipy.signal.resample_poly(x_ext, 1, down, window=h)
+
+    return y[n_edge // down:n_edge // down + _n_decimated(len(x), down)]
+
+
+def _decimate_stim(x: np.ndarray, down: int) -> np.ndarray:
+    """ Max. over the input samples mapped to each output sample """
+
+    starts = np.maximum(np.arange(_n_decimated(len(x), down)) * down - down // 2, 0)
+
+    return np.maximum.reduceat(x, starts)
+
+
+def _decimate_samples(samples: Union[int, np.ndarray], down: int) -> Union[int, np.ndarray]:
+    """ Output sample of each input sample, `round(samples / down)` with halves rounded up """
+
+    return (2 * samples + down) // (2 * down)
+
+
+def _n_decimated(n_times: int, down: int) -> int:
+    """ Number of samples after decimation """
+
+    return -(-n_times // down)
+
+
+def _round_up(n: int, down: int) -> int:
+    """ Round up to a multiple of `down` """
+
+    return _n_decimated(n, down) * down
+
+
+########################################################################################################################
+# Filter design cache                                                                                                  #
+#                                                                                                                      #
+# Filters are designed with `mne.filter.create_filter` and cached in memory (LRU) and optionally on disk, keyed by     #
+# the sampling frequency, the pass/stop-bands, all design parameters and the MNE version.                              #
+########################################################################################################################
+
+
+class KernelCache:
+    """
+    In-memory LRU cache of filter designs with an optional on-disk cache shared between processes and runs
+    """
+
+    def __init__(self, max_size: int = 32, max_disk_size: int = 256):
+        """
+        :param max_size: max. number of designs kept in memory
+        :param max_disk_size: max. number of designs kept in each on-disk cache directory, least recently used designs
+            are removed first
+        """
+
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size
+        self._designs = OrderedDict()
+
+    def get(self, sfreq: float, l_freq, h_freq, design_params: dict,
+            cache_dir: Union[None, str, Path] = None) -> Union[np.ndarray, dict]:
+        """
+        Get a filter design, designing it if it is not cached
+        :param sfreq: sampling frequency
+        :param l_freq: `l_freq` of `mne.filter.create_filter`
+        :param h_freq: `h_freq` of `mne.filter.create_filter`
+        :param design_params: other parameters for `mne.filter.create_filter`
+        :param cache_dir: on-disk cache directory, None for in-memory cache only
+        :return:
+            FIR kernel or IIR parameters, see `mne.filter.create_filter`
+        """
+
+        key = hash_params(mne.__version__, sfreq, l_freq, h_freq, design_params)
+
+        # In memory
+        if key in self._designs:
+            self._designs.move_to_end(key)
+            return self._designs[key]
+
+        # On disk
+        design = None
+        if cache_dir is not None:
+            design = self._read(Path(cache_dir) / f"{key}.npz")
+
+        if design is None:
+            design = mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose=False, **design_params)
+            if isinstance(design, dict):
+                design = {key: value for key, value in design.items() if value is not None}
+            if cache_dir is not None:
+                self._write(Path(cache_dir), key, design)
+
+        if isinstance(design, np.ndarray):
+            design.setflags(write=False)  # shared between callers
+
+        self._designs[key] = design
+        if len(self._designs) > self.max_size:
+            self._designs.popitem(last=False)
+
+        return design
+
+    def clear(self):
+        self._designs.clear()
+
+    @staticmethod
+    def _read(file: Path) -> Union[None, np.ndarray, dict]:
+
+        if not file.exists():
+            return None
+
+        with np.load(file) as npz:
+            if "h" in npz.files:
+                design = npz["h"]
+            else:
+                design = {key: npz[key] if npz[key].ndim > 0 else npz[key].item() for key in npz.files}
+
+        os.utime(file)  # mark as recently used
+
+        return design
+
+    def _write(self, cache_dir: Path, key: str, design: Union[np.ndarray, dict]):
+
+        if not cache_dir.exists():
+            os.makedirs(cache_dir, exist_ok=True)
+
+        file = cache_dir / f"{key}.npz"
+        tmp = atomic_path(file)
+        with open(tmp, "wb") as f:
+            if isinstance(design, dict):
+                np.savez(f, **design)
+            else:
+                np.savez(f, h=design)
+        os.replace(tmp, file)
+
+        # Remove least recently used designs
+        files = sorted((other for other in cache_dir.glob("*.npz") if other != file), key=os.path.getmtime)
+        for old_file in files[:max(len(files) + 1 - self.max_disk_size, 0)]:
+            try:
+                os.remove(old_file)
+            except FileNotFoundError:  # removed by another process
+                pass
+
+
+KERNEL_CACHE = KernelCache()
+
+
+def _create_filter(sfreq: float, l_freq, h_freq, design_params: dict,
+                   cache_dir: Union[None, str, Path] = None) -> Union[np.ndarray, dict]:
+    """ `mne.filter.create_filter` through `KERNEL_CACHE` """
+
+    return KERNEL_CACHE.get(sfreq, l_freq, h_freq, design_params, cache_dir=cache_dir)
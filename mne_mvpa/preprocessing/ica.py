@@ -0,0 +1,176 @@
+import os
+from pathlib import Path
+import tempfile
+from typing import List, Tuple, Union
+
+import mne
+import numpy as np
+
+from ..definitions import RawReader
+from ..io.raw import create_raw_mmap, read_raw_mmap
+from ..utils.cache import atomic_path, hash_params, hash_path
+from ..utils.logging import setup_logging
+from .filter import OUT_FORMATS, filter_streaming
+
+logger = setup_logging(name="ica", level="info", mne_level="info")
+
+
+########################################################################################################################
+# Artefact removal with ICA                                                                                            #
+#                                                                                                                      #
+# Fitting and reconstruction are separate steps. `fit_ica` fits on a reduced copy of the (filtered) raw file:          #
+# decimated in one streaming pass (see `filter_streaming`), then high-passed in memory and subsampled in time, which   #
+# is all ICA needs. The fitted decomposition is cached as `{key}-ica.fif`, `key` is a hash of the raw file and the     #
+# parameters.                                                                                                          #
+#                                                                                                                      #
+# `apply_ica` removes the excluded components from the full data in one streaming pass. Removing components is an      #
+# affine map of the channels (see `get_reconstruction`), computed once and applied to every chunk with one matrix      #
+# product. The excluded components are not part of the cache key, so changing them never triggers a refit.             #
+########################################################################################################################
+
+
+def fit_ica(raw_file: Union[str, Path], raw_reader: RawReader, n_components: Union[None, int, float] = None,
+            method: str = "fastica", ica_params: Union[None, dict] = None, l_freq: Union[None, float] = 1.0,
+            h_freq: Union[None, float] = None, target_sfreq: Union[None, float] = None,
+            max_samples: Union[None, int] = None, reject: Union[None, dict] = None, reject_by_annotation: bool = True,
+            random_state: Union[None, int] = 0, chunk_duration: float = 60.0,
+            cache_dir: Union[None, str, Path] = None) -> mne.preprocessing.ICA:
+    """
+    Fit ICA on a reduced copy of a raw file, or read it from the cache
+    :param raw_file: path to the (filtered) raw file
+    :param raw_reader: dataset specific raw file reader, (path: str, preload: bool) -> mne.io.Raw
+    :param n_components: number of components (see `mne.preprocessing.ICA`)
+    :param method: 'fastica', 'infomax' or 'picard'
+    :param ica_params: other parameters for `mne.preprocessing.ICA`
+    :param l_freq: high-pass frequency of the copy, None for no high-pass
+    :param h_freq: low-pass frequency of the copy, default a third of `target_sfreq` if decimating, else no low-pass
+    :param target_sfreq: sampling frequency of the copy (integer decimation, see `filter`), None for no decimation
+    :param max_samples: max. number of samples fitted on, the copy is subsampled evenly in time, None for all
+    :param reject: peak-to-peak rejection of segments (see `ICA.fit`)
+    :param reject_by_annotation: whether to omit segments annotated as 'bad'
+    :param random_state: seed of the ICA
+    :param chunk_duration: length of the chunks the copy is filtered in, in seconds
+    :param cache_dir: directory to cache the decomposition in, None for no caching
+    :return:
+        fitted ICA
+    """
+
+    if ica_params is None:
+        ica_params = {}
+    if target_sfreq is not None and h_freq is None:
+        h_freq = target_sfreq / 3
+
+    # Cached
+    file = None
+    if cache_dir is not None:
+        key = hash_params(mne.__version__, hash_path(raw_file), n_components, method, ica_params, l_freq, h_freq,
+                          target_sfreq, max_samples, reject, reject_by_annotation, random_state)
+        file = Path(cache_dir) / f"{key}-ica.fif"
+        if file.exists():
+            logger.info(f"Reading ICA of {Path(raw_file).name} from {file.name}")
+            return mne.preprocessing.read_ica(file, verbose=False)
+        if not file.parent.exists():
+            os.makedirs(file.parent, exist_ok=True)
+
+    ica = mne.preprocessing.ICA(n_components=n_components, method=method, random_state=random_state, **ica_params)
+
+    with tempfile.TemporaryDirectory(dir=cache_dir) as tmp_dir:
+
+        # Reduced copy, in memory. The long high-pass kernel is applied after decimation
+        if h_freq is None and target_sfreq is None:
+            raw = raw_reader(str(raw_file), preload=True)
+        else:
+            filter_streaming(raw_file, Path(tmp_dir) / "ica-raw", None, h_freq, raw_reader,
+                             chunk_duration=chunk_duration, out_format="mmap", target_sfreq=target_sfreq)
+            raw = read_raw_mmap(str(Path(tmp_dir) / "ica-raw"), preload=True)
+        if l_freq is not None:
+            raw.filter(l_freq, None, verbose=False)
+
+        decim = None if max_samples is None else max(int(np.ceil(raw.n_times / max_samples)), 1)
+        ica.fit(raw, decim=decim, reject=reject, reject_by_annotation=reject_by_annotation, verbose=False)
+
+    logger.info(f"Fitted {ica.n_components_} components of {Path(raw_file).name} on {ica.n_samples_} samples at "
+                f"{raw.info['sfreq']:g} Hz")
+
+    if file is not None:
+        tmp = atomic_path(file)
+        tmp = tmp.with_name(f"{tmp.name}-ica.fif")  # MNE naming convention
+        ica.save(tmp, overwrite=True, verbose=False)
+        os.replace(tmp, file)
+
+    return ica
+
+
+def get_reconstruction(ica: mne.preprocessing.ICA, exclude: Union[None, List[int]] = None,
+                       n_pca_components: Union[None, int, float] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Removing components is an affine map of the channels, the same as `ICA.apply` (projectors, pre-whitening, PCA
+    mean and residual PCA components included)
+    :param ica: fitted ICA
+    :param exclude: components to remove, default `ica.exclude`
+    :param n_pca_components: number of PCA components used for the reconstruction (see `ICA.apply`)
+    :return:
+        operator (n_channels, n_channels), offset (n_channels,), channels in the order of `ica.ch_names`
+    """
+
+    if exclude is None:
+        exclude = ica.exclude
+
+    # Images of the origin and of the unit vectors
+    n_channels = len(ica.ch_names)
+    with mne.utils.use_log_level("warning"):
+        offset = ica._pick_sources(np.zeros((n_channels, 1)), None, list(exclude), n_pca_components)[:, 0]
+        operator = ica._pick_sources(np.eye(n_channels), None, list(exclude), n_pca_components) - offset[:, np.newaxis]
+
+    return operator, offset
+
+
+def apply_ica(raw_file: Union[str, Path], out_file: Union[str, Path], raw_reader: RawReader,
+              ica: mne.preprocessing.ICA, exclude: Union[None, List[int]] = None,
+              n_pca_components: Union[None, int, float] = None, chunk_duration: float = 60.0,
+              out_format: str = "fif"):
+    """
+    Remove components from the full raw file in a streaming pass, the ICA may have been fitted on a reduced copy
+    :param raw_file: path to the raw file (the one ICA was fitted on, before reduction)
+    :param out_file: path to save the reconstructed file to
+    :param raw_reader: dataset specific raw file reader, (path: str, preload: bool) -> mne.io.Raw
+    :param ica: fitted ICA, e.g. from `fit_ica`
+    :param exclude: components to remove, default `ica.exclude`
+    :param n_pca_components: number of PCA components used for the reconstruction (see `ICA.apply`)
+    :param chunk_duration: length of the chunks in seconds
+    :param out_format: 'fif' or 'mmap' (see `filter`)
+    :return:
+    """
+
+    if out_format not in OUT_FORMATS:
+        raise ValueError(f"Unknown output format {out_format}")
+
+    raw = raw_reader(str(raw_file), preload=False)
+    missing = [name for name in ica.ch_names if name not in raw.ch_names]
+    if len(missing) > 0:
+        raise ValueError(f"Channels {missing} of the ICA are not in {Path(raw_file).name}")
+
+    picks = mne.pick_channels(raw.ch_names, ica.ch_names, ordered=True)
+    operator, offset = get_reconstruction(ica, exclude, n_pca_components)
+
+    with tempfile.TemporaryDirectory(dir=Path(out_file).parent) as tmp_dir:
+
+        mmap_dir = Path(out_file) if out_format == "mmap" else Path(tmp_dir) / "reconstructed"
+        data = create_raw_mmap(raw.info, raw.n_times, mmap_dir, first_samp=raw.first_samp,
+                               annotations=raw.annotations)
+
+        chunk_size = max(int(round(chunk_duration * raw.info["sfreq"])), 1)
+        for start in range(0, raw.n_times, chunk_size):
+            stop = min(start + chunk_size, raw.n_times)
+            chunk = raw.get_data(start=start, stop=stop)
+            chunk[picks] = operator @ chunk[picks] + offset[:, np.newaxis]
+            data[:, start:stop] = chunk
+
+        data.flush()
+        del data
+
+        if out_format == "fif":
+            read_raw_mmap(str(mmap_dir), preload=False).save(str(out_file), overwrite=True)
+
+    logger.info(f"Removed {len(ica.exclude if exclude is None else exclude)} of {ica.n_components_} components from "
+                f"{Path(raw_file).name}")
@@ -0,0 +1,456 @@
+import itertools
+import os
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
+
+import mne
+from mne.utils import _time_mask
+import numpy as np
+
+from ..definitions import RawReader
+from ..utils.cache import atomic_path, hash_params, hash_path
+from ..utils.logging import setup_logging
+
+logger = setup_logging(name="covariance", level="info", mne_level="info")
+
+
+########################################################################################################################
+# Incremental noise covariance                                                                                         #
+#                                                                                                                      #
+# `CovarianceAccumulator` keeps the number of samples, the sum and the sum of outer products of the data channels, so  #
+# that epochs or raw segments can be fed in chunks straight from disk. The statistics are kept separately for a few    #
+# folds (epochs and raw segments are assigned round-robin), which is enough to cross-validate the shrinkage of the     #
+# covariance afterwards without another pass over the data. As in `mne.compute_covariance`, shrinkage is applied after #
+# scaling the channel types to comparable units, and the shrinkage of each channel type is selected separately.        #
+#                                                                                                                      #
+# Statistics are cached per subject as `{subject}-{key}-cov-stats.npz`, `key` is a hash of the input files and the     #
+# parameters.                                                                                                          #
+########################################################################################################################
+
+
+SCALINGS = {"mag": 1e15, "grad": 1e13, "eeg": 1e6}
+SHRINKAGE = np.logspace(-4, 0, 30)
+
+
+class CovarianceAccumulator:
+    """
+    Streaming sums and outer products of the data channels, see `add`, `add_epochs` and `add_raw`
+    """
+
+    def __init__(self, info: mne.Info, n_folds: int = 5):
+        """
+        :param info: measurement info, the statistics are accumulated for the data channels (including bads)
+        :param n_folds: number of folds used to select the shrinkage
+        """
+
+        if n_folds < 1:
+            raise ValueError(f"`n_folds` should be at least 1, got {n_folds}")
+
+        picks = mne.pick_types(info, meg=True, ref_meg=False, eeg=True, seeg=True, ecog=True, dbs=True, fnirs=True,
+                               exclude=[])
+        self.info = mne.pick_info(info, picks)
+        self.n_folds = n_folds
+
+        n_channels = len(picks)
+        self.n = np.zeros(n_folds, dtype=np.int64)
+        self.sums = np.zeros((n_folds, n_channels))
+        self.products = np.zeros((n_folds, n_channels, n_channels))
+        self._n_added = 0  # epochs or segments added, for the fold assignment
+
+    @property
+    def ch_names(self) -> List[str]:
+        return self.info["ch_names"]
+
+    @property
+    def n_samples(self) -> int:
+        return int(self.n.sum())
+
+    def add(self, data: np.ndarray) -> "CovarianceAccumulator":
+        """
+        Add data of the channels in `ch_names`
+        :param data: a segment (n_channels, n_times) or epochs (n_epochs, n_channels, n_times)
+        :return:
+        """
+
+        data = np.asarray(data, dtype=np.float64)
+        if data.ndim == 2:
+            data = data[np.newaxis]
+        if data.ndim != 3 or data.shape[1] != len(self.ch_names):
+            raise ValueError(f"Expected data with {len(self.ch_names)} channels, got shape {data.shape}")
+
+        folds = (self._n_added + np.arange(len(data))) % self.n_folds
+        for fold in np.unique(folds):
+            one = data[folds == fold].transpose(1, 0, 2).reshape(data.shape[1], -1)
+            self.n[fold] += one.shape[1]
+            self.sums[fold] += one.sum(axis=1)
+            self.products[fold] += one @ one.T
+
+        self._n_added += len(data)
+
+        return self
+
+    def add_epochs(self, epochs: mne.BaseEpochs, tmin: Union[None, float] = None, tmax: Union[None, float] = None,
+                   chunk_size: int = 64) -> "CovarianceAccumulator":
+        """
+        Add epochs, reading `chunk_size` epochs at a time if they are not preloaded
+        :param epochs: epochs
+        :param tmin: start of the window within the epochs, None for the first sample
+        :param tmax: end of the window within the epochs (e.g. 0.0 for the baseline), None for the last sample
+        :param chunk_size: number of epochs read at a time
+        :return:
+        """
+
+        # Same samples as `mne.compute_covariance`
+        mask = _time_mask(epochs.times, tmin, tmax, sfreq=epochs.info["sfreq"])
+
+        for start in range(0, len(epochs), chunk_size):
+            stop = min(start + chunk_size, len(epochs))
+            self.add(epochs[start:stop].get_data(picks=self.ch_names)[..., mask])
+
+        return self
+
+    def add_raw(self, raw: mne.io.BaseRaw, tmin: Union[None, float] = None, tmax: Union[None, float] = None,
+                segment_duration: float = 10.0, reject_by_annotation: bool = True) -> "CovarianceAccumulator":
+        """
+        Add raw data (e.g. empty room recordings or rest periods) in segments, which are read one at a time if the raw
+        is not preloaded
+        :param raw: raw
+        :param tmin: start of the data in seconds (relative to the first sample), None for the first sample
+        :param tmax: end of the data in seconds, None for the last sample
+        :param segment_duration: length of the segments in seconds, segments are the units assigned to the folds
+        :param reject_by_annotation: if True, spans annotated as bad are omitted
+        :return:
+        """
+
+        start = 0 if tmin is None else raw.time_as_index(tmin)[0]
+        stop = raw.n_times if tmax is None else min(raw.time_as_index(tmax)[0] + 1, raw.n_times)
+        segment_size = max(int(round(segment_duration * raw.info["sfreq"])), 1)
+
+        for seg_start in range(start, stop, segment_size):
+            data = raw.get_data(picks=self.ch_names, start=seg_start, stop=min(seg_start + segment_size, stop),
+                                reject_by_annotation="omit" if reject_by_annotation else None)
+            if data.shape[1] > 0:
+                self.add(data)
+
+        return self
+
+    def get_covariance(self, method: Union[str, Sequence[str]] = ("shrunk", "empirical"),
+                       shrinkage: Union[float, np.ndarray] = SHRINKAGE, assume_centered: bool = True) -> mne.Covariance:
+        """
+        Noise covariance from the accumulated statistics, without another pass over the data
+        :param method: 'empirical', 'shrunk' or several of them, in which case the one with the highest cross-validated
+            log-likelihood is returned (as `mne.compute_covariance`)
+        :param shrinkage: shrinkage of each channel type towards a scaled identity of the 'shrunk' method. A single
+            value is used as is, the best of several values is selected for each channel type by cross-validation over
+            the folds. The blocks between channel types are shrunk accordingly, and set to zero between EEG and other
+            types (as `mne.compute_covariance`)
+        :param assume_centered: if True, the data is assumed to have zero mean (e.g. baseline corrected epochs), as
+            in `mne.compute_covariance`. If False, the mean of all samples is removed
+        :return:
+            noise covariance, `loglik` is the cross-validated log-likelihood per sample (if computed)
+        """
+
+        methods = [method] if isinstance(method, str) else list(method)
+        for one in methods:
+            if one not in ["empirical", "shrunk"]:
+                raise ValueError(f"Unknown method {one}")
+        if self.n_samples < 2:
+            raise ValueError(f"At least 2 samples are needed, got {self.n_samples}")
+
+        # Shrinkage of each channel type, None for the empirical covariance
+        scale = self._get_scale()
+        shrinkage = np.atleast_1d(shrinkage)
+        candidates = {}
+        if "shrunk" in methods:
+            candidates["shrunk"] = []
+            for ch_type, picks in self._get_ch_type_picks():
+                value = shrinkage[0]
+                if len(shrinkage) > 1:
+                    value = shrinkage[int(np.argmax(self.get_log_likelihood(shrinkage, scale=scale,
+                                                                            assume_centered=assume_centered,
+                                                                            picks=picks)))]
+                candidates["shrunk"].append((ch_type, float(value), picks))
+        if "empirical" in methods:
+            candidates["empirical"] = None
+
+        loglik = None
+        if len(candidates) > 1:
+            logliks = {name: self._get_cv_log_likelihood(shrinkages, scale, assume_centered)
+                       for name, shrinkages in candidates.items()}
+            name = max(logliks, key=logliks.get)
+            loglik = logliks[name]
+            if candidates[name] is None:
+                logger.info(f"Selected empirical covariance, log-likelihood {loglik:.3f}")
+            else:
+                values = ", ".join(f"{ch_type} {value:.2e}" for ch_type, value, _ in candidates[name])
+                logger.info(f"Selected shrunk covariance (shrinkage {values}), log-likelihood {loglik:.3f}")
+        else:
+            name = next(iter(candidates))
+
+        data = self._get_scatter(assume_centered) / (self.n_samples - 1)
+        if candidates[name] is not None:
+            data = _shrink(data, candidates[name], scale)
+
+        return mne.Covariance(data, self.ch_names, bads=list(self.info["bads"]), projs=list(self.info["projs"]),
+                              nfree=self.n_samples - 1, method=name, loglik=loglik)
+
+    def get_log_likelihood(self, shrinkage: np.ndarray, scale: Union[None, np.ndarray] = None,
+                           assume_centered: bool = True, picks: Union[None, np.ndarray] = None) -> np.ndarray:
+        """
+        Cross-validated log-likelihood (per sample) of shrunk covariances, each fold is held out once. The
+        eigendecomposition of each training covariance is shared by all shrinkage values
+        :param shrinkage: shrinkage values
+        :param scale: channel scaling, default `SCALINGS` by channel type
+        :param assume_centered: if True, the data is assumed to have zero mean, otherwise the training mean is removed
+        :param picks: indices of the channels (e.g. of one channel type), None for all channels
+        :return:
+            log-likelihood of each shrinkage value
+        """
+
+        if scale is None:
+            scale = self._get_scale()
+        if picks is None:
+            picks = np.arange(len(self.ch_names))
+        shrinkage = np.atleast_1d(shrinkage)
+
+        n_channels = len(picks)
+        loglik = np.zeros(len(shrinkage))
+        for fold, train, test in self._get_folds(scale, assume_centered):
+
+            train, test = train[np.ix_(picks, picks)], test[np.ix_(picks, picks)]
+            eigval, eigvec = np.linalg.eigh(train)
+            eigval = (1 - shrinkage[:, np.newaxis]) * eigval + shrinkage[:, np.newaxis] * eigval.mean()
+            projected = np.einsum("ij,ik,kj->j", eigvec, test, eigvec)  # diagonal of V^T T V
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                one = -0.5 * (self.n[fold] * (n_channels * np.log(2 * np.pi) + np.log(eigval).sum(axis=1))
+                              + (projected / eigval).sum(axis=1))
+            loglik += np.where((eigval > 0).all(axis=1), one, -np.inf)
+
+        # Undo the scaling, so that the likelihood is of the data in SI units
+        return loglik / self.n_samples + np.log(scale[picks]).sum()
+
+    def merge(self, other: "CovarianceAccumulator") -> "CovarianceAccumulator":
+        """
+        Add the statistics of another accumulator of the same channels (e.g. accumulated in another process)
+        """
+
+        if other.ch_names != self.ch_names or other.n_folds != self.n_folds:
+            raise ValueError("Accumulators of different channels or numbers of folds can't be merged")
+
+        self.n += other.n
+        self.sums += other.sums
+        self.products += other.products
+        self._n_added += other._n_added
+
+        return self
+
+    def save(self, file: Union[str, Path]):
+        """
+        Save the statistics, the channel info is saved next to it as `{file stem}-info.fif`
+        :param file: `.npz` file
+        :return:
+        """
+
+        file = Path(file)
+        mne.io.write_info(_info_file(file), self.info, overwrite=True)
+        with open(file, "wb") as f:
+            np.savez(f, n=self.n, sums=self.sums, products=self.products, n_added=self._n_added)
+
+    @classmethod
+    def load(cls, file: Union[str, Path]) -> "CovarianceAccumulator":
+        """
+        Load statistics saved with `save`
+        :param file: `.npz` file
+        :return:
+            accumulator
+        """
+
+        file = Path(file)
+        with np.load(file) as npz:
+            accumulator = cls(mne.io.read_info(_info_file(file), verbose=False), n_folds=len(npz["n"]))
+            accumulator.n, accumulator.sums, accumulator.products = npz["n"], npz["sums"], npz["products"]
+            accumulator._n_added = int(npz["n_added"])
+
+        return accumulator
+
+    def _get_scatter(self, assume_centered: bool) -> np.ndarray:
+        """ Sum of outer products, around the mean of all samples if not `assume_centered` """
+
+        if assume_centered:
+            return self.products.sum(axis=0)
+
+        total = self.sums.sum(axis=0)
+
+        return self.products.sum(axis=0) - np.outer(total, total) / self.n_samples
+
+    def _get_scale(self) -> np.ndarray:
+        return np.array([SCALINGS.get(ch_type, 1.0) for ch_type in self.info.get_channel_types()])
+
+    def _get_ch_type_picks(self) -> List[Tuple[str, np.ndarray]]:
+        """ Channel types with the indices of their channels, in order of appearance """
+
+        ch_types = np.array(self.info.get_channel_types())
+
+        return [(ch_type, np.flatnonzero(ch_types == ch_type)) for ch_type in dict.fromkeys(ch_types)]
+
+    def _get_folds(self, scale: np.ndarray, assume_centered: bool):
+        """
+        Training covariance (maximum likelihood) and scatter of the held out fold around the training mean, in scaled
+        units, for each fold with data
+        """
+
+        folds = np.flatnonzero(self.n > 0)
+        if len(folds) < 2:
+            raise ValueError(f"Data of at least 2 folds are needed to select the shrinkage, got {len(folds)}")
+
+        outer = np.outer(scale, scale)
+        for fold in folds:
+
+            n_train = self.n_samples - self.n[fold]
+            mean = np.zeros(len(scale)) if assume_centered else (self.sums.sum(axis=0) - self.sums[fold]) / n_train
+            train = ((self.products.sum(axis=0) - self.products[fold]) / n_train - np.outer(mean, mean)) * outer
+            test = (self.products[fold] - np.outer(mean, self.sums[fold]) - np.outer(self.sums[fold], mean)
+                    + self.n[fold] * np.outer(mean, mean)) * outer
+
+            yield fold, train, test
+
+    def _get_cv_log_likelihood(self, shrinkages: Union[None, List[Tuple[str, float, np.ndarray]]],
+                               scale: np.ndarray, assume_centered: bool) -> float:
+        """
+        Cross-validated log-likelihood (per sample) of the covariance shrunk per channel type (see `_shrink`), None
+        for the empirical covariance. The blocks set to zero are also ignored in the held out scatter, as in
+        `mne.compute_covariance`
+        """
+
+        n_channels = len(self.ch_names)
+        zero = np.zeros((n_channels, n_channels), dtype=bool) if shrinkages is None else _get_zero_blocks(shrinkages)
+
+        loglik = 0.0
+        for fold, train, test in self._get_folds(scale, assume_centered):
+
+            if shrinkages is not None:
+                train = _shrink(train, shrinkages, np.ones(n_channels))
+            test[zero] = 0.0
+
+            sign, logdet = np.linalg.slogdet(train)
+            if sign <= 0:
+                return -np.inf
+            loglik += -0.5 * (self.n[fold] * (n_channels * np.log(2 * np.pi) + logdet)
+                              + np.trace(np.linalg.solve(train, test)))
+
+        # Undo the scaling, so that the likelihood is of the data in SI units
+        return float(loglik / self.n_samples + np.log(scale).sum())
+
+
+def get_covariance_statistics(subject: str, files: List[Union[str, Path]], cache_dir: Union[None, str, Path] = None,
+                              raw_reader: Union[None, RawReader] = None, tmin: Union[None, float] = None,
+                              tmax: Union[None, float] = None, n_folds: int = 5, chunk_size: int = 64,
+                              segment_duration: float = 10.0) -> CovarianceAccumulator:
+    """
+    Accumulate the covariance statistics of a subject in one pass over its files, or read them from the cache. The
+    covariance (with any shrinkage) is then obtained with `CovarianceAccumulator.get_covariance`
+    :param subject: subject name
+    :param files: epochs files (`-epo.fif`), or raw files if `raw_reader` is given
+    :param cache_dir: directory to cache the statistics in, None for no caching
+    :param raw_reader: dataset specific raw file reader, (path: str, preload: bool) -> mne.io.Raw. If None, `files` are
+        read as epochs
+    :param tmin: start of the data within each epoch or raw file (see `add_epochs` and `add_raw`)
+    :param tmax: end of the data within each epoch or raw file, e.g. 0.0 for the baseline of epochs
+    :param n_folds: number of folds to select the shrinkage with
+    :param chunk_size: number of epochs read at a time
+    :param segment_duration: length of raw segments in seconds
+    :return:
+        accumulator
+    """
+
+    if len(files) == 0:
+        raise ValueError(f"No files given for subject {subject}")
+
+    # Cached
+    file = None
+    if cache_dir is not None:
+        key = hash_params(mne.__version__, subject, [hash_path(one) for one in files], raw_reader is None, tmin, tmax,
+                          n_folds, segment_duration)
+        file = Path(cache_dir) / f"{subject}-{key}-cov-stats.npz"
+        if file.exists():
+            logger.info(f"Reading covariance statistics of {subject} from {file.name}")
+            return CovarianceAccumulator.load(file)
+
+    accumulator = None
+    for one in files:
+
+        if raw_reader is None:
+            data = mne.read_epochs(one, preload=False, verbose=False)
+        else:
+            data = raw_reader(str(one), preload=False)
+
+        if accumulator is None:
+            accumulator = CovarianceAccumulator(data.info, n_folds=n_folds)
+
+        if raw_reader is None:
+            accumulator.add_epochs(data, tmin=tmin, tmax=tmax, chunk_size=chunk_size)
+        else:
+            accumulator.add_raw(data, tmin=tmin, tmax=tmax, segment_duration=segment_duration)
+
+    logger.info(f"Accumulated {accumulator.n_samples} samples of {subject} from {len(files)} files")
+
+    if file is not None:
+        _write(file, accumulator)
+
+    return accumulator
+
+
+def _shrink(cov: np.ndarray, shrinkages: List[Tuple[str, float, np.ndarray]], scale: np.ndarray) -> np.ndarray:
+    """
+    Shrink the block of each channel type towards a scaled identity in scaled units, the blocks between two types by
+    the geometric mean of their (1 - shrinkage) and those between EEG and other types to zero (as
+    `mne.compute_covariance`)
+    :param cov: covariance
+    :param shrinkages: [(channel type, shrinkage, indices of the channels), ...]
+    :param scale: channel scaling
+    :return:
+        shrunk covariance
+    """
+
+    outer = np.outer(scale, scale)
+    shrunk = cov * outer
+
+    for _, value, picks in shrinkages:
+        block = shrunk[np.ix_(picks, picks)]
+        shrunk[np.ix_(picks, picks)] = (1 - value) * block + value * np.trace(block) / len(block) * np.eye(len(block))
+    for (_, value_i, picks_i), (_, value_j, picks_j) in itertools.combinations(shrinkages, 2):
+        factor = np.sqrt((1 - value_i) * (1 - value_j))
+        shrunk[np.ix_(picks_i, picks_j)] *= factor
+        shrunk[np.ix_(picks_j, picks_i)] *= factor
+    shrunk[_get_zero_blocks(shrinkages)] = 0.0
+
+    return shrunk / outer
+
+
+def _get_zero_blocks(shrinkages: List[Tuple[str, float, np.ndarray]]) -> np.ndarray:
+    """ Mask of the blocks between EEG and other channel types, which are set to zero by shrinkage """
+
+    n_channels = sum(len(picks) for _, _, picks in shrinkages)
+    zero = np.zeros((n_channels, n_channels), dtype=bool)
+    for (type_i, _, picks_i), (type_j, _, picks_j) in itertools.combinations(shrinkages, 2):
+        if "eeg" in (type_i, type_j):
+            zero[np.ix_(picks_i, picks_j)] = zero[np.ix_(picks_j, picks_i)] = True
+
+    return zero
+
+
+def _info_file(file: Path) -> Path:
+    return file.with_name(f"{file.name[:-len(file.suffix)]}-info.fif")
+
+
+def _write(file: Path, accumulator: CovarianceAccumulator):
+    """ Write statistics in the cache (both files are moved in place once complete) """
+
+    if not file.parent.exists():
+        os.makedirs(file.parent, exist_ok=True)
+
+    tmp = atomic_path(file)
+    accumulator.save(tmp)
+    os.replace(_info_file(tmp), _info_file(file))
+    os.replace(tmp, file)
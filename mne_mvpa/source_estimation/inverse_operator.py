@@ -1,15 +1,29 @@
+from copy import deepcopy
+import itertools
+import os
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
+
 import mne
+from mne.io.constants import FIFF
+from mne.minimum_norm.inverse import InverseOperator, _check_depth, _prepare_forward
+import numpy as np
 
+from ..utils.logging import setup_logging
 
-def get_inverse_operator(epochs, fwd, cov_params=None, inv_params=None):
+logger = setup_logging(name="inverse_operator", level="info", mne_level="info")
 
-    # Compute noise covariance
-    if cov_params is None:
-        tmax, method, rank = 0.0, ("shrunk", "empirical"), None
-        noise_cov = mne.compute_covariance(epochs, tmax=tmax, method=method, rank=rank)
-    else:
-        noise_cov = mne.compute_covariance(epochs, tmax=cov_params["tmax"], method=cov_params["method"],
-                                           rank=cov_params["rank"])
+
+def get_inverse_operator(epochs, fwd, cov_params=None, inv_params=None, noise_cov=None):
+
+    # Compute noise covariance, unless it was accumulated beforehand (see `covariance.py`)
+    if noise_cov is None:
+        if cov_params is None:
+            tmax, method, rank = 0.0, ("shrunk", "empirical"), None
+            noise_cov = mne.compute_covariance(epochs, tmax=tmax, method=method, rank=rank)
+        else:
+            noise_cov = mne.compute_covariance(epochs, tmax=cov_params["tmax"], method=cov_params["method"],
+                                               rank=cov_params["rank"])
 
     if inv_params is None:
         inv = mne.minimum_norm.make_inverse_operator(info=epochs.info, forward=fwd, noise_cov=noise_cov,
@@ -19,3 +33,165 @@ def get_inverse_operator(epochs, fwd, cov_params=None, inv_params=None):
                                                      loose=inv_params["loose"], depth=inv_params["depth"])
 
     return inv
+
+
+########################################################################################################################
+# Parameter sweep                                                                                                      #
+#                                                                                                                      #
+# The channel selection, whitener and whitened gain matrix G do not depend on loose or depth and are computed once.    #
+# For each depth, the source covariance R is diagonal, so G R G' is split into the normal and tangential parts G_n R_n #
+# G_n' + loose * G_t R_t G_t', which are computed with one pass over the gain matrix. Each loose value then only needs #
+# the eigendecomposition of a (n_channels, n_channels) matrix instead of the SVD of the weighted gain matrix, the      #
+# eigen leads follow from one product with G. SNR does not change the operator, only `lambda2`.                        #
+########################################################################################################################
+
+
+def get_inverse_grid(loose: Sequence[float] = (0.2,), depth: Sequence[Union[None, float]] = (0.8,),
+                     snr: Sequence[float] = (3.0,)) -> List[dict]:
+    """
+    All combinations of inverse parameters, for `get_inverse_operator_sweep`
+    :param loose: loose orientation constraints
+    :param depth: depth weighting exponents (None for no depth weighting)
+    :param snr: signal to noise ratios
+    :return:
+        [{'loose': loose, 'depth': depth, 'snr': snr}, ...]
+    """
+
+    return [{"loose": one_loose, "depth": one_depth, "snr": one_snr}
+            for one_loose, one_depth, one_snr in itertools.product(loose, depth, snr)]
+
+
+def get_inverse_operator_sweep(info: mne.Info, fwd: mne.Forward, noise_cov: mne.Covariance, grid: List[dict],
+                               rank: Union[None, str, dict] = None,
+                               dst_dir: Union[None, str, Path] = None
+                               ) -> List[Tuple[Union[InverseOperator, Path], float]]:
+    """
+    Inverse operators for a grid of parameters, sharing the computations which don't depend on them. The operators are
+    the same as those of `mne.minimum_norm.make_inverse_operator` (up to the signs of the eigen fields and leads),
+    except that the source orientation is always the surface orientation if any `loose < 1`
+    :param info: measurement info
+    :param fwd: free orientation forward solution
+    :param noise_cov: noise covariance
+    :param grid: list of {'loose', 'depth', 'snr' (optional, default 3)}, see `get_inverse_grid`. loose should be in
+        (0, 1], fixed orientation operators are made with `get_inverse_operator`
+    :param rank: rank of the noise covariance (see `mne.minimum_norm.make_inverse_operator`)
+    :param dst_dir: if given, the operators are written to this directory as `loose-{loose}_depth-{depth}-inv.fif`
+        instead of being kept in memory
+    :return:
+        (inverse operator or path to it, lambda2) of each entry of the grid. Entries which only differ in SNR share the
+        same operator
+    """
+
+    params = list(dict.fromkeys((float(entry["loose"]), _get_exp(entry["depth"])) for entry in grid))
+    for loose, _ in params:
+        if not 0.0 < loose <= 1.0:
+            raise ValueError(f"loose should be in (0, 1] for a sweep, got {loose}")
+    if dst_dir is not None and not Path(dst_dir).exists():
+        os.makedirs(dst_dir)
+
+    # Shared: forward in surface orientation (if loose < 1), selected channels and whitener
+    min_loose = min(loose for loose, _ in params)
+    forward, gain_info, _, _, _, _, _, prepared_cov, whitener = _prepare_forward(
+        fwd, info, noise_cov, False, min_loose, rank, pca="white", use_cps=True, exp=None, limit_depth_chs=True,
+        combine_xyz="spectral", allow_fixed_depth=False, limit=None)
+    gain = whitener @ forward["sol"]["data"]
+    n_nzero = (prepared_cov["eig"] > 0).sum()
+
+    if min_loose < 1.0:
+        tangential = mne.forward.compute_orient_prior(forward, loose=0.5, verbose=False) < 1.0
+    else:
+        tangential = np.zeros(gain.shape[1], dtype=bool)
+
+    operators = {}
+    for exp in dict.fromkeys(exp for _, exp in params):
+
+        # Normal and tangential parts of G R G' for this depth
+        depth_prior = _get_depth_prior(forward, gain_info, noise_cov, exp, rank)
+        normal_part = (gain[:, ~tangential] * depth_prior[~tangential]) @ gain[:, ~tangential].T
+        tangential_part = (gain[:, tangential] * depth_prior[tangential]) @ gain[:, tangential].T
+
+        for loose in [loose for loose, one_exp in params if one_exp == exp]:
+
+            orient_prior = mne.forward.compute_orient_prior(forward, loose=loose, verbose=False)
+            grgt = normal_part + loose * tangential_part
+
+            # Scale the source covariance so that the trace of G R G' is the number of channels (as MNE)
+            scale = np.sqrt(n_nzero / np.trace(grgt))
+            source_std = np.sqrt(depth_prior * orient_prior) * scale
+
+            eigval, eigen_fields = np.linalg.eigh(grgt * scale ** 2)
+            eigval, eigen_fields = eigval[::-1], eigen_fields[:, ::-1]
+            sing = np.sqrt(np.clip(eigval, 0.0, None))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                eigen_leads = np.where(sing > 0, source_std[:, np.newaxis] * (gain.T @ eigen_fields) / sing, 0.0)
+
+            inv = _make_inverse(forward, gain_info, info, prepared_cov, eigen_fields, sing, eigen_leads,
+                                None if exp is None else depth_prior, orient_prior, source_std)
+            logger.info(f"Inverse operator loose={loose}, depth={exp}: largest singular value {sing[0]:g}")
+
+            if dst_dir is not None:
+                file = Path(dst_dir) / f"loose-{loose}_depth-{exp}-inv.fif"
+                mne.minimum_norm.write_inverse_operator(file, inv, overwrite=True, verbose=False)
+                inv = file
+            operators[(loose, exp)] = inv
+
+    return [(operators[(float(entry["loose"]), _get_exp(entry["depth"]))], 1.0 / entry.get("snr", 3.0) ** 2)
+            for entry in grid]
+
+
+def _get_exp(depth: Union[None, float]) -> Union[None, float]:
+    """ Depth weighting exponent, 0 is no depth weighting (as MNE) """
+
+    return None if depth is None or float(depth) == 0.0 else float(depth)
+
+
+def _get_depth_prior(forward: mne.Forward, gain_info: mne.Info, noise_cov: mne.Covariance,
+                     exp: Union[None, float], rank: Union[None, str, dict]) -> np.ndarray:
+    """ Depth prior with the default options of `mne.minimum_norm.make_inverse_operator`, ones if `exp` is None """
+
+    if exp is None:
+        return np.ones(forward["sol"]["data"].shape[1])
+
+    depth = _check_depth(exp, "depth_mne")
+
+    return mne.forward.compute_depth_prior(forward, gain_info, exp=exp, limit_depth_chs=depth["limit_depth_chs"],
+                                           combine_xyz=depth["combine_xyz"], limit=depth["limit"],
+                                           noise_cov=noise_cov, rank=rank, verbose=False)
+
+
+def _make_inverse(forward: mne.Forward, gain_info: mne.Info, info: mne.Info, noise_cov: mne.Covariance,
+                  eigen_fields: np.ndarray, sing: np.ndarray, eigen_leads: np.ndarray,
+                  depth_prior: Union[None, np.ndarray], orient_prior: np.ndarray,
+                  source_std: np.ndarray) -> InverseOperator:
+    """ Inverse operator from the decomposition, same fields as `mne.minimum_norm.make_inverse_operator` """
+
+    def diagonal_cov(data, kind):
+        return dict(data=data, kind=kind, bads=[], diag=True, names=[], eig=None, eigvec=None, dim=data.size,
+                    nfree=1, projs=[])
+
+    inv = dict(projs=deepcopy(gain_info["projs"]), eigen_leads_weighted=False, source_ori=forward["source_ori"],
+               mri_head_t=forward["mri_head_t"], nsource=forward["nsource"], units="Am",
+               coord_frame=forward["coord_frame"], source_nn=forward["source_nn"], src=forward["src"],
+               fmri_prior=None, info=deepcopy(forward["info"]))
+    inv["info"]["bads"] = [bad for bad in info["bads"] if bad in forward["info"]["ch_names"]]
+    inv["info"]._check_consistency()
+
+    ch_types = gain_info.get_channel_types()
+    has_meg, has_eeg = any(ch_type in ["mag", "grad"] for ch_type in ch_types), "eeg" in ch_types
+    if has_meg and has_eeg:
+        methods = FIFF.FIFFV_MNE_MEG_EEG
+    elif has_meg:
+        methods = FIFF.FIFFV_MNE_MEG
+    else:
+        methods = FIFF.FIFFV_MNE_EEG
+
+    inv.update(eigen_fields=dict(data=eigen_fields.T, col_names=gain_info["ch_names"], row_names=[],
+                                 nrow=eigen_fields.shape[1], ncol=eigen_fields.shape[0]),
+               eigen_leads=dict(data=eigen_leads, nrow=eigen_leads.shape[0], ncol=eigen_leads.shape[1], row_names=[],
+                                col_names=[]),
+               sing=sing, nave=1.0, noise_cov=noise_cov, methods=methods,
+               depth_prior=None if depth_prior is None else diagonal_cov(depth_prior, FIFF.FIFFV_MNE_DEPTH_PRIOR_COV),
+               orient_prior=diagonal_cov(orient_prior, FIFF.FIFFV_MNE_ORIENT_PRIOR_COV),
+               source_cov=diagonal_cov(source_std * source_std, FIFF.FIFFV_MNE_SOURCE_COV))
+
+    return InverseOperator(inv)
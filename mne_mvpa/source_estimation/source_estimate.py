@@ -0,0 +1,290 @@
+import functools
+import operator
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import mne
+from mne.minimum_norm.inverse import (INVERSE_METHODS, _assemble_kernel, _check_ch_names, _check_ori,
+                                      _check_reference, _get_src_type, _pick_channels_inverse_operator,
+                                      _subject_from_inverse)
+from mne.source_space._source_space import label_src_vertno_sel
+import numpy as np
+import scipy.sparse
+
+from ..io.source import create_source_mmap
+from ..utils.logging import setup_logging
+
+logger = setup_logging(name="source_estimate", level="info", mne_level="info")
+
+
+########################################################################################################################
+# Source estimates of many epochs                                                                                      #
+#                                                                                                                      #
+# `mne.minimum_norm.apply_inverse_epochs` returns a `SourceEstimate` per epoch, which does not fit into memory for     #
+# thousands of epochs of a whole source space. Here the inverse kernel is assembled once, and blocks of epochs are     #
+# projected with a single matrix multiplication (channels x (epochs * times)) and written to a memory-mapped           #
+# (epochs, sources, times) array (see `io/source.py`).                                                                 #
+########################################################################################################################
+
+
+def get_inverse_kernel(inv: mne.minimum_norm.InverseOperator, info: mne.Info, lambda2: float = 1.0 / 9.0,
+                       method: str = "dSPM", pick_ori: Union[None, str] = None, nave: int = 1,
+                       label: Union[None, mne.Label, mne.BiHemiLabel] = None
+                       ) -> Tuple[np.ndarray, Union[None, np.ndarray], int, List[np.ndarray], List[int]]:
+    """
+    Assemble the inverse kernel once, as `mne.minimum_norm.apply_inverse_epochs`
+    :param inv: inverse operator
+    :param info: measurement info of the data
+    :param lambda2: regularization parameter, 1 / SNR ** 2
+    :param method: 'MNE', 'dSPM', 'sLORETA' or 'eLORETA'
+    :param pick_ori: None (norm of the current components for free and loose orientations) or 'normal'
+    :param nave: number of averages of the data
+    :param label: if given, only the rows of the vertices in the label are assembled
+    :return:
+        kernel: (n_sources * n_orient, n_channels), noise normalization is included if the estimates are linear
+        noise_norm: (n_sources, 1) noise normalization applied after combining the orientations, or None
+        n_orient: number of current components combined per source (3 or 1)
+        vertices: vertices of each source space
+        picks: indices of the channels of the kernel in `info`
+    """
+
+    if method not in INVERSE_METHODS:
+        raise ValueError(f"Unknown method {method}")
+    if pick_ori not in [None, "normal"]:
+        raise ValueError(f"pick_ori should be None or 'normal', got {pick_ori}")
+    _check_ori(pick_ori, inv["source_ori"], inv["src"])
+    _check_ch_names(inv, info)
+
+    prepared = mne.minimum_norm.prepare_inverse_operator(inv, nave, lambda2, method, verbose=False)
+    picks = _pick_channels_inverse_operator(info["ch_names"], prepared)
+    kernel, noise_norm, vertices, _ = _assemble_kernel(prepared, label, method, pick_ori, verbose=False)
+
+    # Linear estimates: the noise normalization is part of the kernel
+    n_orient = 1 if mne.forward.is_fixed_orient(inv) or pick_ori == "normal" else 3
+    if n_orient == 1 and noise_norm is not None:
+        kernel, noise_norm = kernel * noise_norm, None
+
+    return kernel, noise_norm, n_orient, vertices, picks
+
+
+def apply_kernel(kernel: np.ndarray, noise_norm: Union[None, np.ndarray], n_orient: int,
+                 data: np.ndarray) -> np.ndarray:
+    """
+    Project epochs with a kernel from `get_inverse_kernel` in a single matrix multiplication
+    :param kernel: (n_sources * n_orient, n_channels)
+    :param noise_norm: (n_sources, 1) or None
+    :param n_orient: number of current components combined per source
+    :param data: epochs (n_epochs, n_channels, n_times) of the channels of the kernel
+    :return:
+        source estimates (n_epochs, n_sources, n_times)
+    """
+
+    n_epochs, n_channels, n_times = data.shape
+
+    sol = kernel @ data.transpose(1, 0, 2).reshape(n_channels, n_epochs * n_times)
+    if n_orient > 1:
+        sol = np.sqrt((sol.reshape(-1, n_orient, sol.shape[1]) ** 2).sum(axis=1))  # norm of the current components
+    if noise_norm is not None:
+        sol *= noise_norm
+
+    return sol.reshape(-1, n_epochs, n_times).transpose(1, 0, 2)
+
+
+def apply_inverse_epochs_mmap(epochs: mne.BaseEpochs, inv: mne.minimum_norm.InverseOperator,
+                              out_dir: Union[str, Path], lambda2: float = 1.0 / 9.0, method: str = "dSPM",
+                              pick_ori: Union[None, str] = None, nave: int = 1, chunk_size: int = 64) -> Path:
+    """
+    Source estimates of all epochs, written to the memory-mapped format (read with
+    `mne_mvpa.io.source.read_source_mmap`). Epochs which are not preloaded are read `chunk_size` at a time, so that
+    memory is bounded by the chunk size. Bad epochs are dropped first (see `get_good_epochs`)
+    :param epochs: epochs, not modified
+    :param inv: inverse operator
+    :param out_dir: directory to save the estimates in
+    :param lambda2: regularization parameter, 1 / SNR ** 2
+    :param method: 'MNE', 'dSPM', 'sLORETA' or 'eLORETA'
+    :param pick_ori: None or 'normal' (see `get_inverse_kernel`)
+    :param nave: number of averages of the data
+    :param chunk_size: number of epochs projected at a time
+    :return:
+        path to the estimates
+    """
+
+    _check_reference(epochs, inv["info"]["ch_names"])
+    kernel, noise_norm, n_orient, vertices, picks = get_inverse_kernel(inv, epochs.info, lambda2=lambda2,
+                                                                        method=method, pick_ori=pick_ori, nave=nave)
+
+    epochs = get_good_epochs(epochs)
+    data = create_source_mmap(out_dir, len(epochs), vertices, len(epochs.times), tmin=epochs.times[0],
+                              tstep=1.0 / epochs.info["sfreq"], subject=_subject_from_inverse(inv),
+                              src_type=_get_src_type(inv["src"], vertices), events=epochs.events,
+                              params={"method": method, "lambda2": lambda2, "pick_ori": pick_ori, "nave": nave})
+
+    for start in range(0, len(epochs), chunk_size):
+        stop = min(start + chunk_size, len(epochs))
+        data[start:stop] = apply_kernel(kernel, noise_norm, n_orient, epochs[start:stop].get_data(picks=picks))
+
+    data.flush()
+    logger.info(f"Projected {len(epochs)} epochs to {data.shape[1]} sources")
+
+    return Path(out_dir)
+
+
+def get_good_epochs(epochs: mne.BaseEpochs) -> mne.BaseEpochs:
+    """
+    Epochs without the bad ones, without modifying `epochs`. Epochs which are not preloaded are copied (which does not
+    copy any data) before dropping, preloaded epochs have no bad epochs left and are returned as is
+    :param epochs: epochs
+    :return:
+        good epochs
+    """
+
+    if epochs.preload:
+        return epochs
+
+    return epochs.copy().drop_bad(verbose=False)
+
+
+########################################################################################################################
+# Source estimates of labels                                                                                           #
+#                                                                                                                      #
+# Only the kernel rows of the vertices in the labels are assembled. Summary time courses which are linear in the       #
+# estimates ('mean' and 'mean_flip' of linear estimates) are folded into the kernel, so that epochs are projected to   #
+# one row per label. Otherwise the estimates of the label vertices are summarized after the projection. Summaries are  #
+# the same as `mne.extract_label_time_course`.                                                                         #
+########################################################################################################################
+
+
+LABEL_MODES = [None, "mean", "mean_flip", "pca_flip", "max"]
+
+
+def apply_inverse_epochs_labels(epochs: mne.BaseEpochs, inv: mne.minimum_norm.InverseOperator,
+                                labels: List[Union[str, Path, mne.Label, mne.BiHemiLabel]], out_dir: Union[str, Path],
+                                mode: Union[None, str] = "mean_flip", lambda2: float = 1.0 / 9.0,
+                                method: str = "dSPM", pick_ori: Union[None, str] = None, nave: int = 1,
+                                chunk_size: int = 64) -> Path:
+    """
+    Source estimates of the vertices in labels, or a summary time course per label, written to the memory-mapped format
+    (see `apply_inverse_epochs_mmap`)
+    :param epochs: epochs, not modified
+    :param inv: inverse operator of surface source spaces
+    :param labels: labels or paths to FreeSurfer `.label` files
+    :param mode: None for all vertices in the labels (without duplicates), or a summary per label: 'mean', 'mean_flip',
+        'pca_flip' or 'max' (see `mne.extract_label_time_course`). Label names are stored in the parameters
+    :param lambda2: regularization parameter, 1 / SNR ** 2
+    :param method: 'MNE', 'dSPM', 'sLORETA' or 'eLORETA'
+    :param pick_ori: None or 'normal' (see `get_inverse_kernel`)
+    :param nave: number of averages of the data
+    :param chunk_size: number of epochs projected at a time
+    :return:
+        path to the estimates, (n_epochs, n_vertices or n_labels, n_times)
+    """
+
+    if mode not in LABEL_MODES:
+        raise ValueError(f"Unknown mode {mode}")
+    if any(src["type"] != "surf" for src in inv["src"]):
+        raise ValueError("Labels are only supported for surface source spaces")
+
+    labels = [label if isinstance(label, (mne.Label, mne.BiHemiLabel)) else mne.read_label(label)
+              for label in labels]
+
+    # Kernel of the vertices in any of the labels
+    _check_reference(epochs, inv["info"]["ch_names"])
+    union = functools.reduce(operator.add, labels)
+    kernel, noise_norm, n_orient, vertices, picks = get_inverse_kernel(inv, epochs.info, lambda2=lambda2,
+                                                                        method=method, pick_ori=pick_ori, nave=nave,
+                                                                        label=union)
+
+    rows = [get_label_rows(label, inv["src"], vertices) for label in labels]
+    flips = [mne.label_sign_flip(label, inv["src"]) for label in labels]
+
+    # Linear summaries are part of the kernel
+    weights = None
+    if mode in ["mean", "mean_flip"]:
+        weights = get_label_weights(rows, None if mode == "mean" else flips, sum(len(one) for one in vertices))
+        if n_orient == 1:
+            kernel, weights = weights @ kernel, None
+
+    epochs = get_good_epochs(epochs)
+    n_sources = sum(len(one) for one in vertices) if mode is None else len(labels)
+    data = create_source_mmap(out_dir, len(epochs), vertices, len(epochs.times), tmin=epochs.times[0],
+                              tstep=1.0 / epochs.info["sfreq"], subject=_subject_from_inverse(inv),
+                              src_type="surface", events=epochs.events, n_sources=n_sources,
+                              params={"method": method, "lambda2": lambda2, "pick_ori": pick_ori, "nave": nave,
+                                      "mode": mode, "labels": [label.name for label in labels]})
+
+    for start in range(0, len(epochs), chunk_size):
+        stop = min(start + chunk_size, len(epochs))
+        sol = apply_kernel(kernel, noise_norm, n_orient, epochs[start:stop].get_data(picks=picks))
+
+        if weights is not None:
+            sol = (weights @ sol.transpose(1, 0, 2).reshape(sol.shape[1], -1)).reshape(len(labels), sol.shape[0], -1)
+            sol = sol.transpose(1, 0, 2)
+        elif mode == "pca_flip":
+            sol = np.stack([_pca_flip(flip, sol[:, one]) for one, flip in zip(rows, flips)], axis=1)
+        elif mode == "max":
+            sol = np.stack([np.abs(sol[:, one]).max(axis=1) for one in rows], axis=1)
+
+        data[start:stop] = sol
+
+    data.flush()
+    logger.info(f"Projected {len(epochs)} epochs to {n_sources} {'vertices' if mode is None else 'labels'}")
+
+    return Path(out_dir)
+
+
+def get_label_rows(label: Union[mne.Label, mne.BiHemiLabel], src: mne.SourceSpaces,
+                   vertices: List[np.ndarray]) -> np.ndarray:
+    """
+    Rows of the vertices of a label in estimates of `vertices` (e.g. of the union of several labels)
+    :param label: label
+    :param src: source spaces
+    :param vertices: vertices of each source space of the estimates
+    :return:
+        row indices, in the order of `mne.label_sign_flip`
+    """
+
+    label_vertices, _ = label_src_vertno_sel(label, src)
+    offsets = np.cumsum([0] + [len(one) for one in vertices[:-1]])
+
+    rows = []
+    for one, label_one, offset in zip(vertices, label_vertices, offsets):
+        if not np.isin(label_one, one).all():
+            raise ValueError(f"Vertices of label {label.name} are missing from the estimates")
+        rows.append(np.searchsorted(one, label_one) + offset)
+
+    return np.concatenate(rows).astype(int)
+
+
+def get_label_weights(rows: List[np.ndarray], flips: Union[None, List[np.ndarray]],
+                      n_sources: int) -> scipy.sparse.csr_matrix:
+    """
+    Sparse (n_labels, n_sources) matrix averaging the (sign-flipped) rows of each label
+    :param rows: rows of each label, see `get_label_rows`
+    :param flips: sign flips of each label (see `mne.label_sign_flip`), None for no flips
+    :param n_sources: number of rows of the estimates
+    :return:
+        weights
+    """
+
+    values = [np.full(len(one), 1.0 / len(one)) if flips is None else np.ravel(flip) / len(one)
+              for one, flip in zip(rows, [None] * len(rows) if flips is None else flips)]
+    label_idx = np.concatenate([np.full(len(one), idx) for idx, one in enumerate(rows)])
+
+    return scipy.sparse.csr_matrix((np.concatenate(values), (label_idx, np.concatenate(rows))),
+                                   shape=(len(rows), n_sources))
+
+
+def _pca_flip(flip: np.ndarray, data: np.ndarray) -> np.ndarray:
+    """
+    First principal component of the estimates of a label, batched over epochs (see `mne.extract_label_time_course`)
+    :param flip: sign flips of the label vertices
+    :param data: (n_epochs, n_vertices, n_times)
+    :return:
+        (n_epochs, n_times)
+    """
+
+    u, s, vh = np.linalg.svd(data, full_matrices=False)
+    sign = np.sign(u[:, :, 0] @ np.ravel(flip))
+    scale = np.linalg.norm(s, axis=1) / np.sqrt(data.shape[1])
+
+    return (sign * scale)[:, np.newaxis] * vh[:, 0]
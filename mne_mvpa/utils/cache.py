@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Union
+
+
+def hash_path(path: Union[str, Path], chunk_size: int = 2 ** 20) -> str:
+    """
+    Content hash of a file, or of all files in a directory (e.g. CTF `.ds` directories)
+    :param path: path to the file or directory
+    :param chunk_size: number of bytes read at a time
+    :return:
+        SHA-256 hex digest
+    """
+
+    path = Path(path)
+    digest = hashlib.sha256()
+
+    if path.is_dir():
+        files = sorted(p for p in path.rglob("*") if p.is_file())
+    else:
+        files = [path]
+
+    for file in files:
+        if path.is_dir():
+            digest.update(str(file.relative_to(path)).encode())
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def hash_params(*params) -> str:
+    """
+    Hash of JSON serializable parameters (anything else is converted with `str`)
+    :param params: parameters to hash
+    :return:
+        SHA-256 hex digest
+    """
+
+    text = json.dumps(params, sort_keys=True, default=str)
+
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def atomic_path(file: Union[str, Path]) -> Path:
+    """
+    Temporary path next to `file` to write to before moving it in place with `os.replace`, so that an interrupted
+    write never leaves a file that looks like a valid cache entry
+    :param file: final path
+    :return:
+        temporary path
+    """
+
+    file = Path(file)
+
+    return file.with_name(f".{file.name}.{os.getpid()}.tmp")
@@ -0,0 +1,40 @@
+from contextlib import contextmanager
+import os
+from typing import Tuple, Union
+
+
+def split_cores(n_tasks: int, n_cores: int, n_workers: Union[None, int] = None) -> Tuple[int, int]:
+    """
+    Split the core budget between tasks run in parallel (processes) and `n_jobs` within each task, such that
+    `n_workers * n_jobs <= n_cores`. Parallelism over tasks is preferred as it has less overhead
+    :param n_tasks: number of tasks
+    :param n_cores: total number of cores
+    :param n_workers: number of tasks run at the same time, None to use as many as possible
+    :return:
+        n_workers, n_jobs
+    """
+
+    n_cores = max(n_cores, 1)
+    if n_workers is None:
+        n_workers = min(max(n_tasks, 1), n_cores)
+    n_workers = min(max(n_workers, 1), n_cores)
+
+    return n_workers, n_cores // n_workers
+
+
+@contextmanager
+def limit_threads(n_threads: int):
+    """ Limit the number of BLAS/OpenMP threads of processes started within the context """
+
+    variables = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+    original = {variable: os.environ.get(variable) for variable in variables}
+
+    os.environ.update({variable: str(n_threads) for variable in variables})
+    try:
+        yield
+    finally:
+        for variable, value in original.items():
+            if value is None:
+                del os.environ[variable]
+            else:
+                os.environ[variable] = value
@@ -0,0 +1 @@
+# `test/` is put on `sys.path` by pytest for this file, so that all tests can import the shared `synthetic` helpers
@@ -0,0 +1,55 @@
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from mne_mvpa.decoding.generalization import decode_generalization
+from mne_mvpa.decoding.linear import decision_function, fit_linear, score_decision
+from mne_mvpa.decoding.time_resolved import decode_time, get_splits
+
+from .test_time_resolved import make_decoding_data
+
+
+class TestGeneralization(TestCase):
+
+    def test_decode_generalization(self):
+
+        X, y = make_decoding_data(n_epochs=40, n_times=9)
+        splits = get_splits(y, cv=4)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            out_dir = Path(tmp_dir) / "gat"
+            scores = decode_generalization(X, y, out_dir, model="ridge", cv=splits, train_chunk=4, test_chunk=2,
+                                           n_jobs=2)
+            self.assertEqual(scores.shape, (4, 9, 9))
+
+            # Diagonal is time-resolved decoding, other cells the model of one time point at another
+            np.testing.assert_allclose(np.diagonal(scores, axis1=1, axis2=2),
+                                       decode_time(X, y, model="ridge", cv=splits))
+            train, test = splits[1]
+            coef, intercept = fit_linear(X[train][:, :, [2]], y[train], model="ridge")
+            decision = decision_function(X[test][:, :, [7]], coef, intercept)
+            self.assertAlmostEqual(scores[1, 2, 7], score_decision(y[test], decision)[0])
+
+            # Interrupted run: only the unfinished units are computed again
+            expected = np.array(scores)
+            done = np.load(out_dir / "done.npy", mmap_mode="r+")
+            done[2, 1] = False
+            done.flush()
+            results = np.load(out_dir / "scores.npy", mmap_mode="r+")
+            results[2, 4:8] = np.nan
+            results[0, 0, 0] = -1.0
+            results.flush()
+            del done, results
+
+            continued = decode_generalization(X, y, out_dir, model="ridge", cv=splits, train_chunk=4, test_chunk=2)
+            np.testing.assert_allclose(continued[2], expected[2])
+            self.assertEqual(continued[0, 0, 0], -1.0)
+
+            # Other parameters
+            with self.assertRaises(ValueError):
+                decode_generalization(X, y, out_dir, model="lda", cv=splits, train_chunk=4)
+            scores = decode_generalization(X, y, out_dir, model="lda", cv=splits, train_chunk=4, overwrite=True)
+            self.assertTrue(np.isfinite(scores).all())
@@ -0,0 +1,59 @@
+from unittest import TestCase
+
+import numpy as np
+
+from mne_mvpa.decoding.permutation import _get_cluster_mass, _score_permutations, cluster_test, permutation_test
+from mne_mvpa.decoding.time_resolved import decode_time, get_labels, get_splits
+
+from .test_time_resolved import make_decoding_data
+
+
+class TestPermutation(TestCase):
+
+    def test_permutation_test(self):
+
+        X, y = make_decoding_data(n_epochs=40, n_features=8, n_times=10)
+        splits = get_splits(y, cv=4)
+
+        scores, null, p_values = permutation_test(X, y, model="ridge", cv=splits, n_permutations=60, batch_size=25,
+                                                  chunk_size=4, n_jobs=2)
+        np.testing.assert_allclose(scores, decode_time(X, y, model="ridge", cv=splits).mean(axis=0))
+        self.assertEqual(null.shape, (60, 10))
+        self.assertTrue((p_values[5:] < 0.05).all())
+        self.assertAlmostEqual(null.mean(), 0.5, delta=0.05)
+
+        # Batched ridge null is the same as refitting each permutation, and with many features (dual)
+        for n_features in [8, 50]:
+            X, y = make_decoding_data(n_epochs=30, n_features=n_features, n_times=4)
+            scores, null, _ = permutation_test(X, y, model="ridge", cv=3, n_permutations=5, batch_size=2,
+                                               random_state=1)
+
+            # Same splits and permutations as `permutation_test`
+            _, labels = get_labels(y)
+            rng = np.random.default_rng(1)
+            permuted = labels[np.stack([np.arange(len(labels))] + [rng.permutation(len(labels)) for _ in range(5)])]
+            refitted = _score_permutations(X, permuted, get_splits(labels, 3, None, 1), "ridge", None, "roc_auc", 4)
+            np.testing.assert_allclose(scores, refitted[0])
+            np.testing.assert_allclose(null, refitted[1:])
+
+        # Multiclass, other models
+        X, y = make_decoding_data(n_epochs=30, n_times=4, n_classes=3)
+        scores, null, _ = permutation_test(X, y, model="ridge", scoring="accuracy", cv=3, n_permutations=5)
+        np.testing.assert_allclose(scores, decode_time(X, y, model="ridge", scoring="accuracy", cv=3).mean(axis=0))
+        scores, _, _ = permutation_test(X, y, model="lda", scoring="accuracy", cv=3, n_permutations=3, n_jobs=2)
+        np.testing.assert_allclose(scores, decode_time(X, y, model="lda", scoring="accuracy", cv=3).mean(axis=0))
+
+    def test_cluster_test(self):
+
+        ids, mass = _get_cluster_mass(np.array([[True, True, False, True], [False, False, False, False]]),
+                                      np.array([[1.0, 2.0, 5.0, 3.0], [1.0, 1.0, 1.0, 1.0]]))
+        np.testing.assert_array_equal(ids, [[1, 1, 0, 2], [0, 0, 0, 0]])
+        np.testing.assert_array_equal(mass, [[3.0, 3.0], [0.0, 0.0]])
+
+        X, y = make_decoding_data(n_epochs=40, n_times=10)
+        scores, null, _ = permutation_test(X, y, cv=4, n_permutations=100)
+        clusters, p_values = cluster_test(scores, null)
+        self.assertEqual(len(clusters), len(p_values))
+        significant = [cluster for cluster, p_value in zip(clusters, p_values) if p_value < 0.05]
+        self.assertEqual(len(significant), 1)
+        self.assertTrue(np.isin(np.arange(3, 10), significant[0]).all())
@@ -0,0 +1,78 @@
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+from scipy.spatial.distance import pdist
+import scipy.stats
+
+from mne_mvpa.decoding.rsa import compare_rdms, compute_rdm
+
+
+class TestRSA(TestCase):
+
+    def test_compute_rdm(self):
+
+        X, items, folds = make_item_data()
+        means = np.stack([X[items == item].mean(axis=0) for item in np.unique(items)])
+
+        for metric in ["correlation", "euclidean"]:
+            unique, rdms = compute_rdm(X, items, metric=metric, chunk_size=4, item_chunk=3)
+            np.testing.assert_array_equal(unique, np.unique(items))
+            expected = np.stack([pdist(means[:, :, time], metric) for time in range(X.shape[2])])
+            np.testing.assert_allclose(rdms, expected, atol=1e-12)
+
+        # Crossnobis against the definition, whitened with the shrunk residual covariance
+        unique, rdms = compute_rdm(X, items, metric="crossnobis", folds=folds, shrinkage=0.2, item_chunk=2)
+        groups = [(items == item) & (folds == fold) for fold in range(2) for item in unique]
+        residuals = np.concatenate([(X[group] - X[group].mean(axis=0)).transpose(0, 2, 1).reshape(-1, X.shape[1])
+                                    for group in groups])
+        cov = residuals.T @ residuals / (len(residuals) - len(groups) * X.shape[2])
+        cov = 0.8 * cov + 0.2 * np.trace(cov) / X.shape[1] * np.eye(X.shape[1])
+        eigval, eigvec = np.linalg.eigh(cov)
+        whitener = eigvec @ np.diag(eigval ** -0.5) @ eigvec.T
+
+        time = 3
+        fold_means = [np.stack([X[(items == item) & (folds == fold), :, time].mean(axis=0) for item in unique])
+                      @ whitener for fold in range(2)]
+        expected = [(fold_means[0][i] - fold_means[0][j]) @ (fold_means[1][i] - fold_means[1][j]) / X.shape[1]
+                    for i in range(len(unique)) for j in range(i + 1, len(unique))]
+        np.testing.assert_allclose(rdms[time], expected, atol=1e-12)
+
+        with self.assertRaises(ValueError):
+            compute_rdm(X, items, metric="crossnobis", folds=folds, selection=~((items == "w1") & (folds == 0)))
+
+        # Cached by data and selection
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            unique, rdms = compute_rdm(X, items, selection=items != "w3", cache_dir=tmp_dir)
+            self.assertNotIn("w3", unique)
+            cached_unique, cached = compute_rdm(X, items, selection=items != "w3", cache_dir=tmp_dir)
+            np.testing.assert_array_equal(cached, rdms)
+            np.testing.assert_array_equal(cached_unique, unique)
+            compute_rdm(X, items, cache_dir=tmp_dir)
+            compute_rdm(X + 1.0, items, selection=items != "w3", cache_dir=tmp_dir)
+            self.assertEqual(len(list(Path(tmp_dir).glob("rdm-*.npy"))), 3)
+
+    def test_compare_rdms(self):
+
+        X, items, _ = make_item_data()
+        _, rdms = compute_rdm(X, items)
+        models = np.random.default_rng(1).standard_normal((3, rdms.shape[1]))
+
+        correlations = compare_rdms(rdms, models, chunk_size=4)
+        self.assertEqual(correlations.shape, (3, X.shape[2]))
+        self.assertAlmostEqual(correlations[1, 2], scipy.stats.spearmanr(models[1], rdms[2])[0])
+        correlations = compare_rdms(rdms, models[0], method="pearson")
+        self.assertAlmostEqual(correlations[0, 5], scipy.stats.pearsonr(models[0], rdms[5])[0])
+
+
+def make_item_data(n_items: int = 7, n_repetitions: int = 4, n_features: int = 5, n_times: int = 6):
+    """ Random epochs of repeated items, repetitions alternate between two folds """
+
+    rng = np.random.default_rng(0)
+    items = np.repeat(np.array([f"w{idx}" for idx in range(n_items)]), n_repetitions)
+    folds = np.tile(np.arange(n_repetitions) % 2, n_items)
+    X = rng.standard_normal((len(items), n_features, n_times))
+    X += rng.standard_normal((n_items, n_features, n_times)).repeat(n_repetitions, axis=0)
+
+    return X, items, folds
@@ -0,0 +1,70 @@
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import mne
+import numpy as np
+
+from mne_mvpa.decoding.searchlight import get_neighbors, searchlight
+from mne_mvpa.decoding.time_resolved import decode_time, get_splits
+from mne_mvpa.io.source import create_source_mmap
+from synthetic import make_surface_source_space
+
+
+class TestSearchlight(TestCase):
+
+    def test_get_neighbors(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            src = make_surface_source_space(tmp_dir)
+            rr = np.concatenate([s["rr"][s["vertno"]] for s in src])
+            hemi = np.repeat([0, 1], [s["nuse"] for s in src])
+
+            # Euclidean: all pairs within the radius in the same hemisphere
+            neighbors = get_neighbors(src, 0.01, cache_dir=tmp_dir / "cache")
+            dist = np.linalg.norm(rr[:, np.newaxis] - rr, axis=2)
+            np.testing.assert_array_equal(neighbors.toarray(), (dist <= 0.01) & (hemi[:, np.newaxis] == hemi))
+
+            # Cached
+            self.assertEqual(len(list((tmp_dir / "cache").glob("searchlight-*.npz"))), 1)
+            cached = get_neighbors(src, 0.01, cache_dir=tmp_dir / "cache")
+            self.assertEqual((cached != neighbors).nnz, 0)
+
+            # Geodesic: same as the distances computed by MNE, within the Euclidean neighbours
+            geodesic = get_neighbors(src, 0.01, metric="geodesic")
+            mne.add_source_space_distances(src, dist_limit=0.01, verbose=False)
+            self.assertEqual((get_neighbors(src, 0.01, metric="geodesic") != geodesic).nnz, 0)
+            self.assertEqual((geodesic > neighbors).nnz, 0)
+            self.assertTrue(geodesic.diagonal().all())
+
+    def test_searchlight(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            src = make_surface_source_space(tmp_dir)
+            neighbors = get_neighbors(src, 0.01)
+
+            # Class differences in the left hemisphere
+            rng = np.random.default_rng(0)
+            y = np.arange(40) % 2
+            data = create_source_mmap(tmp_dir / "stc", len(y), [s["vertno"] for s in src], 4, tmin=0.0, tstep=0.01)
+            data[:] = rng.standard_normal(data.shape)
+            data[:, :src[0]["nuse"], 2:] += y[:, np.newaxis, np.newaxis]
+            data.flush()
+            del data
+
+            splits = get_splits(y, cv=4)
+            scores = searchlight(tmp_dir / "stc", y, neighbors, cv=splits, times=slice(1, 4), chunk_size=500,
+                                 n_cores=2)
+            self.assertEqual(scores.shape, (neighbors.shape[0], 3))
+            self.assertGreater(scores[:src[0]["nuse"], 1:].mean(), 0.8)
+            self.assertLess(np.abs(scores[src[0]["nuse"]:].mean() - 0.5), 0.05)
+
+            # Same as decoding the neighbourhood
+            X = np.load(tmp_dir / "stc" / "data.npy")
+            for centre in [0, 700]:
+                expected = decode_time(X[:, neighbors[centre].indices, 1:4], y, cv=splits).mean(axis=0)
+                np.testing.assert_allclose(scores[centre], expected)
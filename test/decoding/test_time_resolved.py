@@ -0,0 +1,82 @@
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.linear_model import LogisticRegression, RidgeClassifier
+from sklearn.metrics import roc_auc_score
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+from mne_mvpa.decoding.linear import decision_function, fit_linear
+from mne_mvpa.decoding.time_resolved import decode_time, get_splits
+from mne_mvpa.io.source import create_source_mmap
+
+
+class TestTimeResolved(TestCase):
+
+    def test_fit_linear(self):
+
+        # Same decision values as scikit-learn at each time point
+        estimators = {"lda": LinearDiscriminantAnalysis(solver="lsqr", shrinkage="auto"),
+                      "ridge": RidgeClassifier(alpha=1.0),
+                      "logistic": LogisticRegression(C=1.0, tol=1e-10, max_iter=1000)}
+
+        for n_classes, n_features in [(2, 8), (3, 8), (2, 50)]:
+            X, y = make_decoding_data(n_classes=n_classes, n_features=n_features)
+            for model, estimator in estimators.items():
+                if model == "logistic" and n_classes > 2:
+                    continue
+
+                coef, intercept = fit_linear(X, y, model)
+                decision = decision_function(X, coef, intercept)
+                for time in range(X.shape[2]):
+                    expected = make_pipeline(StandardScaler(), estimator).fit(X[:, :, time], y)
+                    np.testing.assert_allclose(decision[:, time],
+                                               expected.decision_function(X[:, :, time]).reshape(len(y), -1),
+                                               rtol=1e-5, atol=1e-5)
+
+        with self.assertRaises(ValueError):
+            fit_linear(*make_decoding_data(n_classes=3), model="logistic")
+
+    def test_decode_time(self):
+
+        X, y = make_decoding_data(n_epochs=60, n_times=10)
+        splits = get_splits(y, cv=4)
+
+        # Same as a scikit-learn pipeline per time point
+        scores = decode_time(X, y, model="lda", cv=splits)
+        self.assertEqual(scores.shape, (4, 10))
+        for time in [0, 5]:
+            for fold, (train, test) in enumerate(splits):
+                pipeline = make_pipeline(StandardScaler(), LinearDiscriminantAnalysis(solver="lsqr", shrinkage="auto"))
+                pipeline.fit(X[train, :, time], y[train])
+                expected = roc_auc_score(y[test], pipeline.decision_function(X[test, :, time]))
+                self.assertAlmostEqual(scores[fold, time], expected)
+
+        # Signal only after the first time points
+        self.assertLess(scores[:, :3].mean(), 0.75)
+        self.assertGreater(scores[:, 5:].mean(), 0.9)
+
+        # Memory-mapped source estimates, parallel folds and chunks of time points
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data = create_source_mmap(Path(tmp_dir), len(X), [np.arange(X.shape[1])], X.shape[2], tmin=0.0,
+                                      tstep=0.01, src_type="discrete")
+            data[:] = X
+            data.flush()
+            del data
+
+            mmap_scores = decode_time(tmp_dir, y, model="lda", cv=splits, chunk_size=3, n_jobs=2)
+            np.testing.assert_allclose(mmap_scores, scores, atol=1e-6)
+
+
+def make_decoding_data(n_epochs: int = 40, n_features: int = 8, n_times: int = 6, n_classes: int = 2):
+    """ Random data with class differences from the fourth time point on """
+
+    rng = np.random.default_rng(0)
+    y = np.arange(n_epochs) % n_classes
+    X = rng.standard_normal((n_epochs, n_features, n_times)) * rng.uniform(0.5, 2.0, (1, n_features, 1))
+    X[:, :, 3:] += (y[:, np.newaxis, np.newaxis] * rng.standard_normal((1, n_features, 1)))
+
+    return X, y
@@ -1,10 +1,15 @@
+import os
+from pathlib import Path
 import re
+import tempfile
 from unittest import TestCase
 
+import mne
 import numpy as np
 import pandas as pd
 
-from mne_mvpa.events.mous import combine_visual
+from mne_mvpa.events.mous import combine_visual, combine_visual_batch, EventSelector, select_events
+from mne_mvpa.events.mous.batch import read_batch_events
 from mne_mvpa.definitions import ROOT_DIR
 
 MOUS_DIR = ROOT_DIR / "data" / "test_data" / "mous"
@@ -46,3 +51,99 @@ class MOUS(TestCase):
                 self.assertIn(row["value"], ["1", "2", "3"], "response can be 1, 2, or 3")
             elif row["type"] == "word":
                 self.assertIsNotNone(re.match(r"([\w.]+|<END>)", row["value"]), f"word is {row['value']}")
+
+    def test_combine_events_vectorized(self):
+
+        events, original_df = make_synthetic_events()
+
+        events_df, error_df = combine_visual(events, original_df, tolerance=2, vectorized=False)
+        vectorized_events_df, vectorized_error_df = combine_visual(events, original_df, tolerance=2, vectorized=True)
+
+        pd.testing.assert_frame_equal(events_df, vectorized_events_df)
+        pd.testing.assert_frame_equal(error_df, vectorized_error_df)
+
+    def test_combine_visual_batch(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            pairs = []
+            for seed in range(3):
+                events, original_df = make_synthetic_events(seed)
+                np.save(tmp_dir / f"events-{seed}.npy", events)
+                original_df.to_csv(tmp_dir / f"events-{seed}.tsv", sep="\t", index=False)
+                pairs.append((tmp_dir / f"events-{seed}.npy", tmp_dir / f"events-{seed}.tsv"))
+
+            dst_files = combine_visual_batch(pairs, dst_dir=tmp_dir / "batch", n_jobs=2)
+
+            for (events_file, tsv_file), dst_file in zip(pairs, dst_files):
+                events_df, _ = combine_visual(np.load(events_file), pd.read_csv(tsv_file, sep="\t"))
+                batch_df = read_batch_events(dst_file)
+                self.assertIsInstance(batch_df["type"].dtype, pd.CategoricalDtype, "type is categorical")
+                pd.testing.assert_frame_equal(events_df, batch_df.astype(events_df.dtypes.to_dict()))
+
+            # Unchanged inputs are not processed again
+            mtimes = [os.path.getmtime(dst_file) for dst_file in dst_files]
+            self.assertEqual(dst_files, combine_visual_batch(pairs, dst_dir=tmp_dir / "batch", n_jobs=2))
+            self.assertEqual(mtimes, [os.path.getmtime(dst_file) for dst_file in dst_files])
+
+    def test_event_selector(self):
+
+        events, original_df = make_synthetic_events()
+        events_df, _ = combine_visual(events, original_df)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            events_df.to_csv(tmp_dir / "events.csv", index=False)
+            selector = EventSelector.from_file(tmp_dir / "events.csv")
+
+            # Sentence words, non-target, longer than 3 characters
+            mask = selector.select(type="word", sentence=True, target=False, min_length=4)
+            expected = events_df[(events_df["type"] == "word") & events_df["sentence"] & ~events_df["target"] &
+                                 (events_df["value"].str.len() >= 4) & (events_df["value"] != "<END>")]
+            selected, event_id = selector.get_events(mask)
+            self.assertEqual(event_id, {"selected": 1})
+            np.testing.assert_array_equal(selected[:, 0], expected["sample"].to_numpy())
+
+            # Metadata of the selected events
+            metadata = selector.get_metadata(mask)
+            self.assertEqual(list(metadata.columns), list(events_df.columns))
+            np.testing.assert_array_equal(metadata["sample"].to_numpy(), selected[:, 0])
+            np.testing.assert_array_equal(metadata["value"].to_numpy(), expected["value"].to_numpy())
+
+            # Split by word
+            selected, event_id = selector.get_events(mask, name="word", by="value")
+            self.assertEqual(set(event_id), {f"word/{value}" for value in expected["value"]})
+
+            # Contrast
+            contrast, event_id = selector.get_contrast({"target": selector.select(type="word", target=True),
+                                                        "non-target": selector.select(type="word", target=False)})
+            self.assertEqual(len(contrast), np.count_nonzero(events_df["type"] == "word"))
+            self.assertTrue(np.all(np.diff(contrast[:, 0]) >= 0), "sorted by sample")
+
+            # Save as FIF
+            event_id = select_events(tmp_dir / "events.csv", tmp_dir / "selected-eve.fif", type="fixation")
+            self.assertEqual(len(mne.read_events(tmp_dir / "selected-eve.fif")),
+                             np.count_nonzero(events_df["type"] == "fixation"))
+
+
+def make_synthetic_events(seed: int = 0):
+    """ Synthetic events array and TSV covering every trigger value, mismatches and ignored rows """
+
+    rows = [(1, "Picture", "1 de 300"), (2, "Picture", "2 man 250"), (3, "Response", "3"),
+            (4, "Picture", "4 300"), (5, "Picture", "5 gemene 300"), (6, "Picture", "6 d'r 300"),
+            (7, "Picture", "7 hij. 300"), (8, "Picture", "8 300"), (10, "Picture", "ZINNEN"),
+            (10, "Picture", "WOORDEN"), (15, "Picture", "ISI"), (20, "Picture", "FIX 3948"),
+            (30, "Picture", "pause"), (40, "Picture", "QUESTION 341"), (16, "Response", "1"),
+            (32, "Response", "2"), (128, "UDIO001", "x"), (128, "Picture", "x"), (5, "Picture", "4 x 300"),
+            (16, "Response", "2"), (1, "Sound", "1 x 300"), (1, "trial", "1"), (1, "Picture", "blank")]
+    rng = np.random.default_rng(seed)
+    events, tsv = [], []
+    for i in range(500):
+        value, row_type, row_value = rows[rng.integers(len(rows))]
+        sample = 100 + 20 * i
+        events.append([sample, 0, value])
+        tsv.append([sample / 1000, rng.random(), sample + rng.integers(-4, 5), row_type, row_value])
+
+    return np.array(events), pd.DataFrame(tsv, columns=["onset", "duration", "sample", "type", "value"])
@@ -1,11 +1,15 @@
 import os
 from pathlib import Path
+import pickle
 import tempfile
-from unittest import TestCase
+from unittest import TestCase, mock
 
 import mne
+from mne.io.constants import FIFF
+import numpy as np
+import pandas as pd
 
-from mne_mvpa.forward.coregistration import get_trans
+from mne_mvpa.forward.coregistration import CachedCoregistration, HeadCache, fit_trans, get_trans, get_trans_batch
 from mne_mvpa.definitions import ROOT_DIR
 
 SAMPLE_FILE = ROOT_DIR / "data" / "test_data" / "sample_raw.fif"
@@ -27,3 +31,126 @@ class TestCoregistration(TestCase):
                       subjects_dir=subjects_dir)
 
             self.assertIn(f"{subject}-auto-trans.fif", os.listdir(tmp_dir))
+
+    def test_get_trans_batch(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            make_head_subject(tmp_dir, "head")
+            shifts = [np.array([0.0, 0.004, 0.003]), np.array([0.002, 0.0, 0.0])]
+            pairs = [(make_head_info(tmp_dir / f"run{idx}-info.fif", shift), "head")
+                     for idx, shift in enumerate(shifts)]
+
+            summary = get_trans_batch(pairs, tmp_dir / "trans", subjects_dir=tmp_dir, n_jobs=2)
+
+            self.assertEqual(len(os.listdir(tmp_dir / "trans" / "head-cache")), 1, "head prepared once")
+            pd.testing.assert_frame_equal(summary, pd.read_csv(tmp_dir / "trans" / "coregistration.csv"))
+            for (_, row), shift in zip(summary.iterrows(), shifts):
+                trans = mne.read_trans(row["trans_file"])
+                np.testing.assert_allclose(trans["trans"][:3, 3], shift, atol=5e-4)
+                self.assertLess(row["mean_distance"], 2.0)
+            self.assertTrue((summary["n_iterations"] <= 26).all())
+
+    def test_cached_coregistration(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            make_head_subject(tmp_dir, "head")
+            info = mne.io.read_info(make_head_info(tmp_dir / "run-info.fif", np.array([0.0, 0.004, 0.003])))
+
+            expected = mne.coreg.Coregistration(info, "head", subjects_dir=tmp_dir)
+            expected.fit_fiducials().fit_icp(n_iterations=6)
+
+            # Same as MNE, with the surfaces read, from memory and from disk
+            for head_cache in [HeadCache(), None, None, HeadCache()]:
+                coreg = CachedCoregistration(info, "head", subjects_dir=tmp_dir, head_cache=head_cache,
+                                             head_cache_dir=tmp_dir / "head-cache")
+                coreg.fit_fiducials().fit_icp(n_iterations=6)
+                np.testing.assert_allclose(coreg.trans["trans"], expected.trans["trans"])
+                np.testing.assert_allclose(coreg.compute_dig_mri_distances(), expected.compute_dig_mri_distances())
+
+            self.assertEqual(len(os.listdir(tmp_dir / "head-cache")), 1)
+
+    def test_tolerance(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            make_head_subject(tmp_dir, "head")
+            info = mne.io.read_info(make_head_info(tmp_dir / "run-info.fif", np.array([0.0, 0.004, 0.003])))
+
+            # An ICP stops at the first iteration which rotates less than `angle` and moves less than `distance`
+            for angle, distance in [(1.0, 0.05), (0.05, 1.0)]:
+                coreg = CachedCoregistration(info, "head", subjects_dir=tmp_dir).set_tolerance(angle, distance)
+                coreg.fit_fiducials().perturb(rotation=np.deg2rad([3.0, -2.0, 2.0]), translation=np.zeros(3))
+
+                changes = []  # translation (mm), rotation (degrees)
+                coreg.fit_icp(n_iterations=20, callback=lambda *_: changes.append(coreg._changes[:2]))
+                converged = [move <= distance and rotation <= angle for move, rotation in changes]
+                self.assertEqual(coreg.n_iterations, converged.index(True) + 1)
+
+    def test_fit_trans_multi_start(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            make_head_subject(tmp_dir, "head")
+            shift = np.array([0.0, 0.004, 0.003])
+            info_file = make_head_info(tmp_dir / "run-info.fif", shift)
+
+            # Without tolerance all iterations are used
+            _, _, n_iterations = fit_trans(info_file, "head", tmp_dir, tolerance_angle=0.0, tolerance_distance=0.0)
+            self.assertEqual(n_iterations, 26)
+
+            head_cache = HeadCache()
+            trans, dists, n_iterations = fit_trans(info_file, "head", tmp_dir, n_starts=3,
+                                                   perturbation_distance=10.0, n_jobs=2, head_cache=head_cache)
+            np.testing.assert_allclose(trans["trans"][:3, 3], shift, atol=5e-4)
+            self.assertLess(np.mean(dists), 2.0)
+            self.assertLess(n_iterations, 26)
+
+            # The parallel starts get the head read in the parent process, without reading it again
+            self.assertEqual(len(head_cache._heads), 1)
+            shared = pickle.loads(pickle.dumps(head_cache.share("head", tmp_dir)))
+            with mock.patch.object(HeadCache, "_prepare", side_effect=AssertionError("head read again")):
+                head = shared.get("head", tmp_dir)
+            np.testing.assert_array_equal(head["low_res"]["rr"], head_cache.get("head", tmp_dir)["low_res"]["rr"])
+
+
+def make_head_subject(subjects_dir: Path, subject: str, radius: float = 0.09):
+    """ Subject with a spherical head surface and fiducials on the sphere (radius in m) """
+
+    bem_dir = subjects_dir / subject / "bem"
+    os.makedirs(bem_dir, exist_ok=True)
+
+    ico = mne.surface._get_ico_surface(5)
+    surf = mne.surface.complete_surface_info({"rr": ico["rr"] * radius, "tris": ico["tris"]}, verbose=False)
+    surf.update(id=FIFF.FIFFV_BEM_SURF_ID_HEAD, sigma=0.3, coord_frame=FIFF.FIFFV_COORD_MRI, np=len(surf["rr"]),
+                ntri=len(surf["tris"]))
+    mne.write_bem_surfaces(bem_dir / f"{subject}-head.fif", [surf], overwrite=True)
+
+    fiducials = [{"kind": FIFF.FIFFV_POINT_CARDINAL, "ident": ident, "r": radius * np.array(r),
+                  "coord_frame": FIFF.FIFFV_COORD_MRI}
+                 for ident, r in [(FIFF.FIFFV_POINT_LPA, [-1, 0, 0]), (FIFF.FIFFV_POINT_NASION, [0, 1, 0]),
+                                  (FIFF.FIFFV_POINT_RPA, [1, 0, 0])]]
+    mne.io.write_fiducials(bem_dir / f"{subject}-fiducials.fif", fiducials, coord_frame="mri", overwrite=True)
+
+
+def make_head_info(file: Path, shift: np.ndarray, radius: float = 0.09, n_points: int = 200) -> Path:
+    """ Info with fiducials and head shape points on the sphere of `make_head_subject`, shifted by `-shift` """
+
+    rng = np.random.default_rng(0)
+    hsp = rng.standard_normal((n_points, 3))
+    hsp[:, 2] = np.abs(hsp[:, 2])
+    hsp /= np.linalg.norm(hsp, axis=1, keepdims=True)
+
+    montage = mne.channels.make_dig_montage(nasion=[0, radius, 0] - shift, lpa=[-radius, 0, 0] - shift,
+                                            rpa=[radius, 0, 0] - shift, hsp=radius * hsp - shift,
+                                            coord_frame="head")
+    info = mne.create_info(["MEG001"], 100.0, "mag")
+    info.set_montage(montage)
+    mne.io.write_info(file, info, overwrite=True)
+
+    return file
@@ -0,0 +1,58 @@
+import os
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import mne
+import numpy as np
+
+from mne_mvpa.forward.batch import get_forward_solution_batch
+from mne_mvpa.forward.forward_solution import get_bem_solution, get_forward_solution
+from synthetic import make_sphere_info, make_sphere_subject
+
+
+class TestForwardSolution(TestCase):
+
+    def test_bem_cache(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            subjects_dir = Path(tmp_dir)
+            cache_dir = subjects_dir / "cache"
+            make_sphere_subject(subjects_dir, "sphere")
+
+            bem = get_bem_solution("sphere", subjects_dir, (0.3,), cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2, "BEM model and solution cached")
+
+            cached = get_bem_solution("sphere", subjects_dir, (0.3,), cache_dir=cache_dir)
+            np.testing.assert_allclose(bem["solution"], cached["solution"])
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # Changed surface or conductivity
+            make_sphere_subject(subjects_dir, "sphere", radius=85.0)
+            get_bem_solution("sphere", subjects_dir, (0.3,), cache_dir=cache_dir)
+            get_bem_solution("sphere", subjects_dir, (0.33,), cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 6)
+
+    def test_forward_solution_batch(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            subjects_dir = Path(tmp_dir)
+            cache_dir = subjects_dir / "cache"
+            for subject in ["sphere1", "sphere2"]:
+                make_sphere_subject(subjects_dir, subject)
+
+            info, trans = make_sphere_info(), mne.transforms.Transform("head", "mri")
+            entries = [(subject, info, trans) for subject in ["sphere1", "sphere1", "sphere2"]]
+            dst_files = [subjects_dir / f"run{idx}-fwd.fif" for idx in range(len(entries))]
+
+            get_forward_solution_batch(entries, dst_files, subjects_dir, layers=1, spacing="ico3",
+                                       cache_dir=cache_dir, n_cores=2)
+            self.assertEqual(len(os.listdir(cache_dir)), 6, "source space and BEM computed once per subject")
+
+            # Saved as float32
+            expected = get_forward_solution(info, trans, "sphere2", subjects_dir, layers=1, spacing="ico3")
+            expected = expected["sol"]["data"]
+            np.testing.assert_allclose(mne.read_forward_solution(dst_files[-1])["sol"]["data"], expected,
+                                       rtol=0, atol=1e-6 * np.abs(expected).max())
@@ -0,0 +1,62 @@
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import mne
+import numpy as np
+
+from mne_mvpa.io.forward import read_forward_mmap, read_gain_mmap, save_forward_mmap
+from synthetic import make_sphere_info
+
+
+class TestForwardMmap(TestCase):
+
+    def test_forward_mmap(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            fwd = make_synthetic_forward()
+
+            # Fixed orientation
+            save_forward_mmap(fwd, tmp_dir / "fixed.fwd", fixed=True)
+            gain, metadata = read_gain_mmap(tmp_dir / "fixed.fwd")
+            expected = mne.convert_forward_solution(fwd, force_fixed=True, verbose=False)
+
+            self.assertIsInstance(gain, np.memmap)
+            self.assertEqual(gain.dtype, np.float32)
+            np.testing.assert_allclose(gain, expected["sol"]["data"], rtol=1e-6)
+            np.testing.assert_array_equal(metadata["vertices"][0], fwd["src"][0]["vertno"])
+            np.testing.assert_allclose(metadata["nn"], expected["source_nn"])
+
+            # Inverse operators from the memory-mapped forward solution
+            info = make_sphere_info()
+            cov = mne.make_ad_hoc_cov(info, verbose=False)
+            inv = mne.minimum_norm.make_inverse_operator(info, read_forward_mmap(tmp_dir / "fixed.fwd"), cov,
+                                                         fixed=True, depth=None, verbose=False)
+            expected_inv = mne.minimum_norm.make_inverse_operator(info, fwd, cov, fixed=True, depth=None,
+                                                                  verbose=False)
+            np.testing.assert_allclose(inv["sing"], expected_inv["sing"], rtol=1e-5)
+
+            # Free orientation
+            save_forward_mmap(fwd, tmp_dir / "free.fwd", fixed=False)
+            free = read_forward_mmap(tmp_dir / "free.fwd")
+            self.assertEqual(free["sol"]["data"].shape, (info["nchan"], 3 * fwd["nsource"]))
+            inv = mne.minimum_norm.make_inverse_operator(info, free, cov, loose=0.2, verbose=False)
+            expected_inv = mne.minimum_norm.make_inverse_operator(info, fwd, cov, loose=0.2, verbose=False)
+            np.testing.assert_allclose(inv["sing"], expected_inv["sing"], rtol=1e-5)
+
+
+def make_synthetic_forward(n_sources: int = 200) -> mne.Forward:
+    """ Radial dipoles on a sphere of 5 cm radius (discrete source space) in a spherical head model """
+
+    rng = np.random.default_rng(0)
+    nn = rng.standard_normal((n_sources, 3))
+    nn[:, 2] = np.abs(nn[:, 2])
+    nn /= np.linalg.norm(nn, axis=1, keepdims=True)
+
+    src = mne.setup_volume_source_space(pos={"rr": 0.05 * nn, "nn": nn}, verbose=False)
+    sphere = mne.make_sphere_model(r0=(0.0, 0.0, 0.0), head_radius=0.09, verbose=False)
+
+    return mne.make_forward_solution(make_sphere_info(), mne.transforms.Transform("head", "mri"), src, sphere,
+                                     verbose=False)
@@ -0,0 +1,70 @@
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import mne
+import numpy as np
+
+from mne_mvpa.io.raw import read_raw_mmap, save_raw_mmap
+from mne_mvpa.preprocessing.filter import filter
+
+
+class TestRawMmap(TestCase):
+
+    def test_raw_mmap(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+
+            sfreq, n_times = 600.0, 36000
+            info = mne.create_info(["MEG001", "MEG002", "STI 014"], sfreq, ["mag", "mag", "stim"])
+            data = np.random.default_rng(0).standard_normal((3, n_times)) * 1e-12
+            raw = mne.io.RawArray(data, info, first_samp=100)
+            raw.set_annotations(mne.Annotations([1.0], [0.5], ["BAD"]))
+            raw.save(tmp_dir / "synthetic_raw.fif")
+
+            # Round trip
+            save_raw_mmap(raw, tmp_dir / "synthetic.mmap", chunk_duration=7.0)
+            mmap_raw = read_raw_mmap(str(tmp_dir / "synthetic.mmap"), preload=False)
+
+            self.assertFalse(mmap_raw.preload)
+            self.assertEqual(mmap_raw.first_samp, 100)
+            self.assertEqual(len(mmap_raw.annotations), 1)
+            self.assertEqual(mmap_raw.mmap.dtype, np.float32)
+            np.testing.assert_allclose(mmap_raw.get_data(picks=[1], start=500, stop=900), data[[1], 500:900],
+                                       rtol=1e-6)
+
+            # Original calibration is kept, in the info and in FIF files saved from the memory map (as saving directly)
+            calibrated = raw.copy()
+            for ch, cal in zip(calibrated.info["chs"], [2e-13, 3e-13, 1.0]):
+                ch["cal"], ch["range"] = cal, 0.5
+            calibrated.save(tmp_dir / "expected_raw.fif")
+            save_raw_mmap(calibrated, tmp_dir / "calibrated.mmap")
+            read_raw_mmap(str(tmp_dir / "calibrated.mmap"), preload=False).save(tmp_dir / "calibrated_raw.fif")
+
+            expected = mne.io.read_raw(tmp_dir / "expected_raw.fif")
+            for one in [read_raw_mmap(str(tmp_dir / "calibrated.mmap"), preload=False),
+                        mne.io.read_raw(tmp_dir / "calibrated_raw.fif")]:
+                self.assertEqual([(ch["cal"], ch["range"]) for ch in one.info["chs"]],
+                                 [(ch["cal"], ch["range"]) for ch in expected.info["chs"]])
+                np.testing.assert_allclose(one.get_data(), expected.get_data(), rtol=1e-6)
+
+            # Projectors applied while reading
+            projected = read_raw_mmap(str(tmp_dir / "calibrated.mmap"), preload=False)
+            projected.add_proj(mne.compute_proj_raw(raw, n_mag=1, verbose=False)).apply_proj(verbose=False)
+            expected = raw.copy().add_proj(projected.info["projs"]).apply_proj(verbose=False)
+            np.testing.assert_allclose(projected.get_data(), expected.get_data(), rtol=1e-5, atol=1e-18)
+
+            # Filter output, preloaded and streamed
+            filter(raw_file=tmp_dir / "synthetic_raw.fif", out_file=tmp_dir / "filtered_raw.fif",
+                   l_freq=1.0, h_freq=40.0, raw_reader=mne.io.read_raw)
+            expected = mne.io.read_raw(tmp_dir / "filtered_raw.fif").get_data()
+
+            for chunk_duration in [None, 10.0]:
+                filter(raw_file=tmp_dir / "synthetic_raw.fif", out_file=tmp_dir / "filtered.mmap",
+                       l_freq=1.0, h_freq=40.0, raw_reader=mne.io.read_raw, chunk_duration=chunk_duration,
+                       out_format="mmap")
+                filtered = read_raw_mmap(str(tmp_dir / "filtered.mmap"), preload=True)
+                np.testing.assert_allclose(filtered.get_data(), expected, rtol=0, atol=1e-20)
+                self.assertEqual(filtered.info["highpass"], 1.0)
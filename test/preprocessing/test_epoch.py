@@ -0,0 +1,71 @@
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import mne
+import numpy as np
+import pandas as pd
+
+from mne_mvpa.decoding.time_resolved import get_data
+from mne_mvpa.io.epochs import get_epochs, read_epochs_mmap
+from mne_mvpa.io.raw import read_raw_mmap, save_raw_mmap
+from mne_mvpa.preprocessing.epoch import epoch
+
+
+class TestEpoch(TestCase):
+
+    def test_epoch(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            raw, events = make_raw_with_events()
+            save_raw_mmap(raw, tmp_dir / "raw")
+            metadata = pd.DataFrame({"event": np.arange(len(events)), "code": events[:, 2]})
+
+            for decim, baseline in [(1, (None, 0)), (3, (-0.1, 0.0)), (4, None)]:
+
+                out_dir = epoch(tmp_dir / "raw", tmp_dir / "epochs", events, read_raw_mmap, tmin=-0.2, tmax=0.5,
+                                baseline=baseline, decim=decim, metadata=metadata, chunk_duration=5.0, batch_size=7)
+                data, meta = read_epochs_mmap(out_dir)
+
+                # Same as MNE with preloading
+                with mne.utils.use_log_level("error"):
+                    expected = mne.Epochs(read_raw_mmap(str(tmp_dir / "raw"), preload=False), events, tmin=-0.2,
+                                          tmax=0.5, baseline=baseline, decim=decim, picks="data", preload=True)
+
+                self.assertEqual(data.shape, expected.get_data().shape)
+                np.testing.assert_allclose(data, expected.get_data(), rtol=1e-5, atol=1e-12)
+                np.testing.assert_array_equal(meta["selection"], expected.selection)
+                self.assertAlmostEqual(meta["tmin"], expected.tmin)
+                self.assertAlmostEqual(meta["info"]["sfreq"], expected.info["sfreq"], places=4)
+                self.assertEqual(meta["info"]["ch_names"], expected.ch_names)
+
+                # Out of range and bad segment windows are dropped with their metadata
+                self.assertLess(len(data), len(events))
+                np.testing.assert_array_equal(meta["metadata"]["event"], meta["selection"])
+                np.testing.assert_array_equal(meta["events"], events[meta["selection"]])
+
+            # Readers
+            self.assertEqual(get_epochs(tmp_dir / "epochs").get_data().shape, data.shape)
+            self.assertEqual(get_data(tmp_dir / "epochs").shape, data.shape)
+
+
+def make_raw_with_events(sfreq: float = 200.0, duration: float = 100.0, n_events: int = 300):
+    """ EEG and magnetometer noise with a bad channel, a bad segment and events near the ends of the data """
+
+    rng = np.random.default_rng(0)
+    n_times = int(sfreq * duration)
+    info = mne.create_info(["EEG001", "EEG002", "MEG001", "STI 014"], sfreq, ["eeg", "eeg", "mag", "stim"])
+
+    data = rng.standard_normal((4, n_times))
+    data[:2] *= 1e-6
+    data[2] *= 1e-12
+    raw = mne.io.RawArray(data, info, first_samp=137, verbose=False)
+    raw.info["bads"] = ["EEG002"]
+    raw.set_annotations(mne.Annotations([30.0, 61.2], [1.0, 0.3], ["BAD_segment", "other"], orig_time=None))
+
+    samples = np.sort(rng.choice(np.arange(100, n_times + 30), n_events, replace=False))
+    events = np.c_[samples, np.zeros(n_events, dtype=int), rng.integers(1, 3, n_events)]
+
+    return raw, events
@@ -1,12 +1,15 @@
 import os
 from pathlib import Path
 import tempfile
-from unittest import TestCase
+from unittest import TestCase, mock
 
 import mne
+import numpy as np
 
-from mne_mvpa.preprocessing.filter import filter
+from mne_mvpa.preprocessing.batch import estimate_memory, filter_batch
+from mne_mvpa.preprocessing.filter import filter, KERNEL_CACHE, KernelCache, resample_events
 from mne_mvpa.definitions import ROOT_DIR
+from mne_mvpa.utils.parallel import split_cores
 
 SAMPLE_FILE = ROOT_DIR / "data" / "test_data" / "sample_raw.fif"
 
@@ -28,3 +31,257 @@ class TestFilter(TestCase):
 
             self.assertIn("outfile_raw.fif", os.listdir(tmp_dir))
             self.assertIn("outfile2_raw.fif", os.listdir(tmp_dir))
+
+    def test_filter_streaming(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            raw_file = make_synthetic_raw(tmp_dir / "synthetic_raw.fif")
+
+            filter(raw_file=raw_file, out_file=tmp_dir / "preloaded_raw.fif",
+                   l_freq=0.1, h_freq=40.0, notch=50.0, raw_reader=mne.io.read_raw)
+            filter(raw_file=raw_file, out_file=tmp_dir / "streamed_raw.fif",
+                   l_freq=0.1, h_freq=40.0, notch=50.0, raw_reader=mne.io.read_raw, chunk_duration=10.0)
+
+            preloaded = mne.io.read_raw(tmp_dir / "preloaded_raw.fif")
+            streamed = mne.io.read_raw(tmp_dir / "streamed_raw.fif")
+
+            np.testing.assert_allclose(preloaded.get_data(), streamed.get_data(), rtol=0, atol=1e-20)
+            self.assertEqual(preloaded.info["highpass"], streamed.info["highpass"])
+            self.assertEqual(preloaded.info["lowpass"], streamed.info["lowpass"])
+
+            # Segments separated by annotations are filtered separately, annotated spans are not filtered
+            raw = mne.io.read_raw(raw_file, preload=True)
+            raw.set_annotations(mne.Annotations([30.0, 71.0], [2.0, 1.0], ["bad_acq_skip", "bad_acq_skip"]))
+            raw.save(tmp_dir / "annotated_raw.fif")
+            raw = mne.io.read_raw(tmp_dir / "annotated_raw.fif")  # skips are stored as zeros
+            for fused in [False, True]:
+                params = {"raw_file": tmp_dir / "annotated_raw.fif", "l_freq": 0.1, "h_freq": 40.0, "notch": 50.0,
+                          "raw_reader": mne.io.read_raw, "fused": fused}
+                filter(out_file=tmp_dir / f"preloaded-{fused}_raw.fif", **params)
+                filter(out_file=tmp_dir / f"streamed-{fused}_raw.fif", chunk_duration=10.0, **params)
+
+                preloaded = mne.io.read_raw(tmp_dir / f"preloaded-{fused}_raw.fif").get_data()
+                np.testing.assert_allclose(mne.io.read_raw(tmp_dir / f"streamed-{fused}_raw.fif").get_data(),
+                                           preloaded, rtol=0, atol=1e-20)
+                skipped = raw.time_as_index([30.0, 32.0])
+                np.testing.assert_array_equal(preloaded[:, skipped[0]:skipped[1]],
+                                              raw.get_data(start=skipped[0], stop=skipped[1]))
+
+            with self.assertRaises(ValueError):
+                filter(raw_file=tmp_dir / "annotated_raw.fif", out_file=tmp_dir / "decimated_raw.fif", l_freq=0.1,
+                       h_freq=40.0, raw_reader=mne.io.read_raw, target_sfreq=150.0, chunk_duration=10.0)
+
+    def test_filter_fused(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            raw_file = make_synthetic_raw(tmp_dir / "synthetic_raw.fif")
+
+            filter(raw_file=raw_file, out_file=tmp_dir / "separate_raw.fif",
+                   l_freq=0.1, h_freq=40.0, notch=50.0, raw_reader=mne.io.read_raw)
+            filter(raw_file=raw_file, out_file=tmp_dir / "fused_raw.fif",
+                   l_freq=0.1, h_freq=40.0, notch=50.0, raw_reader=mne.io.read_raw, fused=True)
+            filter(raw_file=raw_file, out_file=tmp_dir / "fused_iir_raw.fif",
+                   l_freq=1.0, h_freq=40.0, notch=50.0, raw_reader=mne.io.read_raw, fused=True,
+                   filter_params={"method": "iir"}, notch_params={"method": "iir"})
+
+            separate = mne.io.read_raw(tmp_dir / "separate_raw.fif")
+            fused = mne.io.read_raw(tmp_dir / "fused_raw.fif")
+
+            np.testing.assert_allclose(separate.get_data(), fused.get_data(), rtol=0, atol=1e-20)
+            self.assertEqual(separate.info["highpass"], fused.info["highpass"])
+            self.assertEqual(separate.info["lowpass"], fused.info["lowpass"])
+
+            # IIR, the same as separate filters away from the edges (MNE notches one frequency at a time)
+            separate_iir = mne.io.read_raw(raw_file, preload=True).filter(1.0, 40.0, method="iir", verbose=False)
+            for freq in [50.0, 100.0, 150.0, 200.0]:
+                separate_iir.notch_filter(freq, method="iir", verbose=False)
+            fused_iir = mne.io.read_raw(tmp_dir / "fused_iir_raw.fif")
+            middle = slice(6000, -6000)
+            np.testing.assert_allclose(fused_iir.get_data()[:, middle], separate_iir.get_data()[:, middle], rtol=0,
+                                       atol=1e-6 * np.abs(separate_iir.get_data()).max())
+
+            # Options of `raw.filter` are honoured or rejected
+            filter(raw_file=raw_file, out_file=tmp_dir / "picked_raw.fif", l_freq=0.1, h_freq=40.0,
+                   raw_reader=mne.io.read_raw, fused=True, filter_params={"picks": ["MEG000"]})
+            picked = mne.io.read_raw(tmp_dir / "picked_raw.fif")
+            np.testing.assert_allclose(picked.get_data(picks="MEG000"), fused.get_data(picks="MEG000"), rtol=0,
+                                       atol=1e-13)
+            np.testing.assert_array_equal(picked.get_data(picks="MEG001"),
+                                          mne.io.read_raw(raw_file).get_data(picks="MEG001"))
+
+            with self.assertRaises(ValueError):
+                filter(raw_file=raw_file, out_file=tmp_dir / "padded_raw.fif", l_freq=0.1, h_freq=40.0,
+                       raw_reader=mne.io.read_raw, fused=True, filter_params={"pad": "edge"})
+            with self.assertRaises(ValueError):
+                filter(raw_file=raw_file, out_file=tmp_dir / "padded_raw.fif", l_freq=0.1, h_freq=40.0, notch=50.0,
+                       raw_reader=mne.io.read_raw, fused=True, notch_params={"picks": ["MEG000"]})
+
+    def test_filter_picks(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            raw_file = make_synthetic_raw(tmp_dir / "synthetic_raw.fif")
+            params = {"l_freq": 1.0, "h_freq": 40.0, "raw_reader": mne.io.read_raw}
+
+            # Highpass and lowpass are only updated if all data channels are filtered, as in `raw.filter`
+            for picks in [["MEG000"], None]:
+                expected = mne.io.read_raw(raw_file, preload=True).filter(1.0, 40.0, picks=picks, verbose=False)
+                for name, kwargs in [("default", {}), ("streamed", {"chunk_duration": 10.0}),
+                                     ("fused", {"fused": True})]:
+                    out_file = tmp_dir / f"{name}-{picks is None}_raw.fif"
+                    filter(raw_file=raw_file, out_file=out_file, filter_params={"picks": picks}, **kwargs, **params)
+                    filtered = mne.io.read_raw(out_file)
+                    self.assertEqual(filtered.info["highpass"], expected.info["highpass"], name)
+                    self.assertEqual(filtered.info["lowpass"], expected.info["lowpass"], name)
+                    np.testing.assert_allclose(filtered.get_data(), expected.get_data(), rtol=0,
+                                               atol=1e-6 * np.abs(expected.get_data(picks="data")).max())
+
+    def test_filter_decimation(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            raw_file = make_synthetic_raw(tmp_dir / "synthetic_raw.fif")
+            params = {"l_freq": 0.1, "h_freq": 40.0, "notch": 50.0, "raw_reader": mne.io.read_raw}
+
+            filter(raw_file=raw_file, out_file=tmp_dir / "fused_raw.fif", fused=True, **params)
+            filter(raw_file=raw_file, out_file=tmp_dir / "decimated_raw.fif", target_sfreq=150.0, **params)
+            filter(raw_file=raw_file, out_file=tmp_dir / "streamed_raw.fif", target_sfreq=150.0,
+                   chunk_duration=10.0, **params)
+
+            fused = mne.io.read_raw(tmp_dir / "fused_raw.fif")
+            decimated = mne.io.read_raw(tmp_dir / "decimated_raw.fif")
+            streamed = mne.io.read_raw(tmp_dir / "streamed_raw.fif")
+
+            self.assertEqual(decimated.info["sfreq"], 150.0)
+            self.assertEqual(decimated.n_times, fused.n_times // 4)
+            np.testing.assert_allclose(fused.get_data(picks="data")[:, ::4], decimated.get_data(picks="data"),
+                                       rtol=0, atol=1e-20)
+            np.testing.assert_allclose(decimated.get_data(), streamed.get_data(), rtol=0, atol=1e-20)
+
+            # Event samples are consistent with the decimated stim channel
+            events = mne.find_events(mne.io.read_raw(raw_file), verbose=False)
+            np.testing.assert_array_equal(resample_events(events, 600.0, 150.0),
+                                          mne.find_events(decimated, verbose=False))
+
+            with self.assertRaises(ValueError):
+                filter(raw_file=raw_file, out_file=tmp_dir / "aliased_raw.fif", target_sfreq=60.0, **params)
+
+            # Highpass and lowpass are only updated if all data channels are filtered, as in `raw.filter`
+            filter(raw_file=raw_file, out_file=tmp_dir / "picked_raw.fif", target_sfreq=150.0,
+                   filter_params={"picks": ["MEG000"]}, notch_params={"picks": ["MEG000"]}, **params)
+            picked = mne.io.read_raw(tmp_dir / "picked_raw.fif")
+            original = mne.io.read_raw(raw_file)
+            self.assertEqual(picked.info["highpass"], original.info["highpass"])
+            self.assertEqual(picked.info["lowpass"], original.info["lowpass"])
+            self.assertAlmostEqual(decimated.info["highpass"], 0.1, places=6)
+            self.assertEqual(decimated.info["lowpass"], 40.0)
+
+            # Reference channels are filtered as the other data channels (CTF)
+            raw = mne.io.read_raw(raw_file, preload=True)
+            raw.set_channel_types({"MEG003": "ref_meg"})
+            raw.save(tmp_dir / "reference_raw.fif")
+            filter(raw_file=tmp_dir / "reference_raw.fif", out_file=tmp_dir / "reference_decimated_raw.fif",
+                   target_sfreq=150.0, **params)
+            decimated = mne.io.read_raw(tmp_dir / "reference_decimated_raw.fif").get_data(picks=["MEG000", "MEG003"])
+
+            expected = raw.filter(0.1, 40.0, verbose=False).notch_filter(np.arange(50.0, 250.0, 50.0), verbose=False)
+            scale = np.abs(expected.get_data(picks="data")).max()
+            np.testing.assert_allclose(decimated, expected.get_data(picks=["MEG000", "MEG003"])[:, ::4], rtol=0,
+                                       atol=1e-6 * scale)
+            np.testing.assert_allclose(decimated, expected.resample(150.0, verbose=False).get_data(
+                picks=["MEG000", "MEG003"]), rtol=0, atol=1e-3 * scale)
+
+    def test_kernel_cache(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            cache = KernelCache(max_size=1, max_disk_size=1)
+            kernel = cache.get(600.0, 0.1, 40.0, {}, cache_dir=tmp_dir)
+            self.assertIs(kernel, cache.get(600.0, 0.1, 40.0, {}, cache_dir=tmp_dir), "cached in memory")
+            self.assertEqual(len(os.listdir(tmp_dir)), 1, "cached on disk")
+
+            # Evicted from memory, read from disk
+            cache.get(600.0, 1.0, 40.0, {})
+            np.testing.assert_array_equal(kernel, cache.get(600.0, 0.1, 40.0, {}, cache_dir=tmp_dir))
+
+            # Evicted from disk
+            iir = cache.get(600.0, 1.0, 40.0, {"method": "iir"}, cache_dir=tmp_dir)
+            self.assertEqual(len(os.listdir(tmp_dir)), 1, "least recently used design removed")
+            cache.clear()
+            np.testing.assert_array_equal(iir["sos"], cache.get(600.0, 1.0, 40.0, {"method": "iir"},
+                                                                cache_dir=tmp_dir)["sos"])
+
+    def test_filter_kernel_cache(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            raw_file = make_synthetic_raw(tmp_dir / "synthetic_raw.fif")
+            params = {"l_freq": 0.1, "h_freq": 40.0, "notch": 50.0, "raw_reader": mne.io.read_raw,
+                      "kernel_cache_dir": tmp_dir / "kernels"}
+
+            # Default (preloaded, separate filters) path designs once, then reads the cache
+            KERNEL_CACHE.clear()
+            with mock.patch("mne.filter.create_filter", wraps=mne.filter.create_filter) as create_filter:
+                filter(raw_file=raw_file, out_file=tmp_dir / "first_raw.fif", **params)
+                self.assertEqual(create_filter.call_count, 2, "band-pass and notch kernels designed")
+                self.assertEqual(len(os.listdir(tmp_dir / "kernels")), 2, "cached on disk")
+
+                filter(raw_file=raw_file, out_file=tmp_dir / "second_raw.fif", **params)
+                KERNEL_CACHE.clear()
+                filter(raw_file=raw_file, out_file=tmp_dir / "third_raw.fif", **params)
+                self.assertEqual(create_filter.call_count, 2, "cached in memory and on disk")
+
+            # Same as MNE
+            expected = mne.io.read_raw(raw_file, preload=True).filter(0.1, 40.0, verbose=False)
+            expected.notch_filter(np.arange(50.0, 250.0, 50.0), verbose=False)
+            for out_file in ["first_raw.fif", "third_raw.fif"]:
+                np.testing.assert_allclose(mne.io.read_raw(tmp_dir / out_file).get_data(), expected.get_data(),
+                                           rtol=1e-6, atol=1e-20)
+
+    def test_filter_batch(self):
+
+        self.assertEqual(split_cores(n_tasks=2, n_cores=8), (2, 4))
+        self.assertEqual(split_cores(n_tasks=20, n_cores=8), (8, 1))
+        self.assertEqual(split_cores(n_tasks=20, n_cores=8, n_workers=3), (3, 2))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            manifest = [(make_synthetic_raw(tmp_dir / f"synthetic{idx}_raw.fif", duration=30.0 * (idx + 1)),
+                         tmp_dir / f"filtered{idx}_raw.fif") for idx in range(3)]
+
+            memory_limit = estimate_memory(manifest[-1][0]) * 1.5  # the largest file runs alone
+            filter_batch(manifest, l_freq=1.0, h_freq=40.0, raw_reader=mne.io.read_raw, notch=50.0, fused=True,
+                         n_cores=2, memory_limit=memory_limit)
+
+            for raw_file, out_file in manifest:
+                filter(raw_file=raw_file, out_file=tmp_dir / "expected_raw.fif", l_freq=1.0, h_freq=40.0,
+                       notch=50.0, raw_reader=mne.io.read_raw, fused=True)
+                np.testing.assert_array_equal(mne.io.read_raw(out_file).get_data(),
+                                              mne.io.read_raw(tmp_dir / "expected_raw.fif").get_data())
+                os.remove(tmp_dir / "expected_raw.fif")
+
+
+def make_synthetic_raw(file: Path, sfreq: float = 600.0, duration: float = 120.0, n_channels: int = 4) -> Path:
+    """ Magnetometer noise with 50 Hz line noise and a stim channel """
+
+    rng = np.random.default_rng(0)
+    n_times = int(sfreq * duration)
+    info = mne.create_info([f"MEG{idx:03d}" for idx in range(n_channels)] + ["STI 014"], sfreq,
+                           ["mag"] * n_channels + ["stim"])
+
+    data = np.zeros((n_channels + 1, n_times))
+    data[:n_channels] = 1e-12 * (rng.standard_normal((n_channels, n_times)) +
+                                 np.sin(2 * np.pi * 50.0 * np.arange(n_times) / sfreq))
+    data[-1, ::int(sfreq)] = 1
+
+    mne.io.RawArray(data, info).save(file, overwrite=True)
+
+    return file
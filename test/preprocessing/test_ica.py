@@ -0,0 +1,68 @@
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import mne
+import numpy as np
+
+from mne_mvpa.io.raw import read_raw_mmap, save_raw_mmap
+from mne_mvpa.preprocessing.ica import apply_ica, fit_ica
+
+
+class TestICA(TestCase):
+
+    def test_ica(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            save_raw_mmap(make_mixed_raw(), tmp_dir / "raw")
+            params = {"n_components": 4, "l_freq": 1.0, "target_sfreq": 200.0, "max_samples": 10000,
+                      "cache_dir": tmp_dir / "cache"}
+
+            # Fitted on the decimated copy, then read from the cache
+            ica = fit_ica(tmp_dir / "raw", read_raw_mmap, **params)
+            self.assertEqual(ica.info["sfreq"], 200.0)
+            self.assertLessEqual(ica.n_samples_, 10000)
+            self.assertEqual(len(list((tmp_dir / "cache").glob("*-ica.fif"))), 1)
+
+            cached = fit_ica(tmp_dir / "raw", read_raw_mmap, **params)
+            np.testing.assert_allclose(cached.unmixing_matrix_, ica.unmixing_matrix_)
+
+            # Same as `ICA.apply` on the full data, for any exclusions without refitting
+            for exclude in [[0], [1, 3]]:
+
+                apply_ica(tmp_dir / "raw", tmp_dir / "clean", read_raw_mmap, ica, exclude=exclude, chunk_duration=7.0,
+                          out_format="mmap")
+                clean = read_raw_mmap(str(tmp_dir / "clean"), preload=True)
+
+                expected = read_raw_mmap(str(tmp_dir / "raw"), preload=True)
+                with mne.utils.use_log_level("error"):
+                    ica.apply(expected, exclude=exclude)
+
+                self.assertEqual(clean.first_samp, expected.first_samp)
+                np.testing.assert_allclose(clean.get_data(), expected.get_data(), rtol=1e-4, atol=1e-18)
+
+            self.assertEqual(len(list((tmp_dir / "cache").glob("*-ica.fif"))), 1)
+
+            # New parameters are a new decomposition
+            fit_ica(tmp_dir / "raw", read_raw_mmap, **{**params, "max_samples": 5000})
+            self.assertEqual(len(list((tmp_dir / "cache").glob("*-ica.fif"))), 2)
+
+
+def make_mixed_raw(sfreq: float = 600.0, duration: float = 60.0, n_channels: int = 6) -> mne.io.RawArray:
+    """ Magnetometers mixing independent sources (a blink-like artefact, a sine and noise) and a stim channel """
+
+    rng = np.random.default_rng(0)
+    times = np.arange(int(sfreq * duration)) / sfreq
+    sources = np.array([np.sin(2 * np.pi * 10.0 * times), np.sign(np.sin(2 * np.pi * 0.7 * times)),
+                        rng.laplace(size=len(times)), rng.laplace(size=len(times))])
+    mixing = rng.standard_normal((n_channels, len(sources)))
+
+    info = mne.create_info([f"MEG{idx:03d}" for idx in range(n_channels)] + ["STI 014"], sfreq,
+                           ["mag"] * n_channels + ["stim"])
+    data = np.zeros((n_channels + 1, len(times)))
+    data[:n_channels] = 1e-12 * (mixing @ sources + 0.01 * rng.standard_normal((n_channels, len(times))))
+    data[-1, ::int(sfreq)] = 1
+
+    return mne.io.RawArray(data, info, first_samp=100, verbose=False)
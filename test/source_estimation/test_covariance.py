@@ -0,0 +1,97 @@
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import mne
+import numpy as np
+
+from mne_mvpa.source_estimation.covariance import SHRINKAGE, CovarianceAccumulator, get_covariance_statistics
+
+
+class TestCovariance(TestCase):
+
+    def test_covariance_statistics(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            epochs = make_noise_epochs()
+            epochs.save(tmp_dir / "run-epo.fif", verbose=False)
+
+            accumulator = get_covariance_statistics("sub", [tmp_dir / "run-epo.fif"], cache_dir=tmp_dir, tmax=0.0,
+                                                    chunk_size=7)
+            expected = mne.compute_covariance(mne.read_epochs(tmp_dir / "run-epo.fif", verbose=False), tmax=0.0,
+                                              method="empirical", verbose=False)
+            cov = accumulator.get_covariance(method="empirical")
+            np.testing.assert_allclose(cov.data, expected.data, rtol=1e-6)
+            self.assertEqual(cov["nfree"], expected["nfree"])
+            self.assertEqual(cov.ch_names, expected.ch_names)
+
+            # Cached
+            self.assertEqual(len(list(tmp_dir.glob("sub-*-cov-stats.npz"))), 1)
+            cached = get_covariance_statistics("sub", [tmp_dir / "run-epo.fif"], cache_dir=tmp_dir, tmax=0.0)
+            np.testing.assert_allclose(cached.get_covariance(method="empirical").data, cov.data)
+
+    def test_shrinkage_selection(self):
+
+        info = mne.create_info(20, 100.0, "eeg")
+        data = np.random.default_rng(0).standard_normal((6, 20, 5)) * 1e-6
+
+        # Few samples: shrinkage is selected, from the statistics of all folds
+        accumulator = CovarianceAccumulator(info, n_folds=3)
+        for epoch in data:
+            accumulator.add(epoch)
+        self.assertEqual(accumulator.get_covariance()["method"], "shrunk")
+
+        # Same as adding everything at once
+        other = CovarianceAccumulator(info, n_folds=3).add(data)
+        np.testing.assert_allclose(other.get_log_likelihood(np.array([0.1, 0.5])),
+                                   accumulator.get_log_likelihood(np.array([0.1, 0.5])))
+
+        with self.assertRaises(ValueError):
+            CovarianceAccumulator(info, n_folds=3).add(data[:1]).get_covariance()
+
+    def test_shrinkage_per_channel_type(self):
+
+        # White magnetometer noise and strongly correlated EEG
+        rng = np.random.default_rng(0)
+        info = mne.create_info([f"MEG{idx:03d}" for idx in range(8)] + [f"EEG{idx:03d}" for idx in range(8)], 100.0,
+                               ["mag"] * 8 + ["eeg"] * 8)
+        data = rng.standard_normal((10, 16, 5))
+        data[:, 8:] = np.einsum("ij,ejt->eit", rng.standard_normal((8, 2)), data[:, 8:10]) + 1e-3 * data[:, 8:]
+        data[:, :8] *= 1e-13
+        data[:, 8:] *= 1e-6
+        epochs = mne.EpochsArray(data, info, verbose=False)
+
+        # Same as MNE for a given shrinkage
+        for shrinkage in [0.1, 0.7]:
+            with mne.utils.use_log_level("error"):
+                expected = mne.compute_covariance(epochs, method="shrunk", rank="full",
+                                                  method_params={"shrunk": {"shrinkage": [shrinkage]}})
+            cov = CovarianceAccumulator(info).add(data).get_covariance(method="shrunk", shrinkage=shrinkage)
+            np.testing.assert_allclose(cov.data, expected.data, rtol=1e-10, atol=1e-10 * np.abs(expected.data).max())
+
+        # Selected for each channel type
+        accumulator = CovarianceAccumulator(info).add(data)
+        cov = accumulator.get_covariance(method="shrunk")
+        self.assertTrue(np.all(cov.data[:8, 8:] == 0.0))
+        for picks in [np.arange(8), np.arange(8, 16)]:
+            loglik = accumulator.get_log_likelihood(SHRINKAGE, picks=picks)
+            np.testing.assert_allclose(cov.data[np.ix_(picks, picks)],
+                                       CovarianceAccumulator(info).add(data).get_covariance(
+                                           method="shrunk", shrinkage=SHRINKAGE[np.argmax(loglik)]
+                                       ).data[np.ix_(picks, picks)])
+
+
+def make_noise_epochs(n_epochs: int = 40, n_channels: int = 10, n_times: int = 50) -> mne.EpochsArray:
+    """ Correlated noise on magnetometers and a stimulus channel, which is not part of the covariance """
+
+    rng = np.random.default_rng(0)
+    mixing = rng.standard_normal((n_channels, n_channels)) * 1e-13
+    data = np.einsum("ij,ejt->eit", mixing, rng.standard_normal((n_epochs, n_channels, n_times)))
+    data = np.concatenate([data, np.zeros((n_epochs, 1, n_times))], axis=1)
+
+    info = mne.create_info([f"MEG{idx:03d}" for idx in range(n_channels)] + ["STI101"], 100.0,
+                           ["mag"] * n_channels + ["stim"])
+
+    return mne.EpochsArray(data, info, tmin=-0.2, verbose=False)
@@ -0,0 +1,61 @@
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import mne
+import numpy as np
+
+from mne_mvpa.source_estimation.inverse_operator import get_inverse_grid, get_inverse_operator_sweep
+from synthetic import make_sphere_info
+
+
+class TestInverseOperator(TestCase):
+
+    def test_inverse_operator_sweep(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            info = make_sphere_info()
+            fwd = make_dipole_forward(info)
+            cov = mne.make_ad_hoc_cov(info, verbose=False)
+            evoked = mne.EvokedArray(np.random.default_rng(0).standard_normal((info["nchan"], 10)) * 1e-13, info)
+
+            grid = get_inverse_grid(loose=[0.2, 1.0], depth=[None, 0.8], snr=[1.0, 3.0])
+            sweep = get_inverse_operator_sweep(info, fwd, cov, grid)
+            self.assertEqual(len(sweep), 8)
+            self.assertIs(sweep[0][0], sweep[1][0], "operators are shared between SNRs")
+
+            for entry, (inv, lambda2) in zip(grid, sweep):
+                self.assertAlmostEqual(lambda2, 1.0 / entry["snr"] ** 2)
+                expected = mne.minimum_norm.make_inverse_operator(info, fwd, cov, loose=entry["loose"],
+                                                                  depth=entry["depth"], verbose=False)
+                for method in ["MNE", "dSPM"]:
+                    stc = mne.minimum_norm.apply_inverse(evoked, inv, lambda2, method, pick_ori="vector",
+                                                         verbose=False)
+                    expected_stc = mne.minimum_norm.apply_inverse(evoked, expected, lambda2, method,
+                                                                  pick_ori="vector", verbose=False)
+                    np.testing.assert_allclose(stc.data, expected_stc.data, rtol=0,
+                                               atol=1e-8 * np.abs(expected_stc.data).max())
+
+            # Written to disk
+            files = get_inverse_operator_sweep(info, fwd, cov, grid[:2], dst_dir=Path(tmp_dir) / "inv")
+            inv = mne.minimum_norm.read_inverse_operator(files[0][0], verbose=False)
+            np.testing.assert_allclose(inv["sing"], sweep[0][0]["sing"], rtol=1e-6)
+            with self.assertRaises(ValueError):
+                get_inverse_operator_sweep(info, fwd, cov, [{"loose": 0.0, "depth": 0.8}])
+
+
+def make_dipole_forward(info: mne.Info, n_sources: int = 100) -> mne.Forward:
+    """ Dipoles on a sphere of 5 cm radius with random (not radial) normals, in a spherical head model """
+
+    rng = np.random.default_rng(1)
+    rr = rng.standard_normal((n_sources, 3))
+    rr[:, 2] = np.abs(rr[:, 2])
+    rr *= 0.05 / np.linalg.norm(rr, axis=1, keepdims=True)
+    nn = rng.standard_normal((n_sources, 3))
+    nn /= np.linalg.norm(nn, axis=1, keepdims=True)
+
+    src = mne.setup_volume_source_space(pos={"rr": rr, "nn": nn}, verbose=False)
+    sphere = mne.make_sphere_model(r0=(0.0, 0.0, 0.0), head_radius=0.09, verbose=False)
+
+    return mne.make_forward_solution(info, mne.transforms.Transform("head", "mri"), src, sphere, verbose=False)
@@ -0,0 +1,130 @@
+from pathlib import Path
+import tempfile
+from unittest import TestCase
+
+import mne
+import numpy as np
+
+from mne_mvpa.io.source import get_source_estimate, read_source_mmap
+from mne_mvpa.source_estimation.source_estimate import apply_inverse_epochs_labels, apply_inverse_epochs_mmap
+from synthetic import make_sphere_info, make_surface_source_space
+from .test_inverse_operator import make_dipole_forward
+
+
+class TestSourceEstimate(TestCase):
+
+    def test_apply_inverse_epochs_mmap(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            info = make_sphere_info()
+            fwd = make_dipole_forward(info)
+            cov = mne.make_ad_hoc_cov(info, verbose=False)
+            epochs = make_random_epochs(info)
+
+            for loose, pick_ori, method in [(0.2, None, "dSPM"), (0.2, "normal", "sLORETA"), (1.0, None, "MNE")]:
+
+                inv = mne.minimum_norm.make_inverse_operator(info, fwd, cov, loose=loose, depth=0.8, verbose=False)
+                out_dir = apply_inverse_epochs_mmap(epochs, inv, Path(tmp_dir) / "stc", method=method,
+                                                    pick_ori=pick_ori, chunk_size=7)
+                data, metadata = read_source_mmap(out_dir)
+
+                expected = mne.minimum_norm.apply_inverse_epochs(epochs, inv, 1.0 / 9.0, method, pick_ori=pick_ori,
+                                                                 verbose=False)
+                self.assertIsInstance(data, np.memmap)
+                self.assertEqual(data.dtype, np.float32)
+                np.testing.assert_allclose(data, np.array([stc.data for stc in expected]), rtol=1e-5,
+                                           atol=1e-6 * np.abs(expected[0].data).max())
+                np.testing.assert_array_equal(metadata["events"], epochs.events)
+                self.assertEqual(metadata["params"]["method"], method)
+
+            stc = get_source_estimate(out_dir, 3)
+            self.assertEqual(stc.tmin, expected[3].tmin)
+            np.testing.assert_array_equal(stc.vertices[0], expected[3].vertices[0])
+
+            # Bad epochs of epochs which are not preloaded are dropped, without modifying the epochs
+            epochs = make_lazy_epochs(info)
+            out_dir = apply_inverse_epochs_mmap(epochs, inv, Path(tmp_dir) / "lazy", method=method, chunk_size=7)
+            data, metadata = read_source_mmap(out_dir)
+
+            self.assertFalse(epochs.preload)
+            self.assertEqual(epochs.drop_log, ((),) * len(epochs.events))
+            good = epochs.copy().drop_bad(verbose=False)
+            self.assertLess(len(good), len(epochs.drop_log))
+            expected = mne.minimum_norm.apply_inverse_epochs(good, inv, 1.0 / 9.0, method, verbose=False)
+            np.testing.assert_allclose(data, np.array([stc.data for stc in expected]), rtol=1e-5,
+                                       atol=1e-6 * np.abs(expected[0].data).max())
+            np.testing.assert_array_equal(metadata["events"], good.events)
+
+    def test_apply_inverse_epochs_labels(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            tmp_dir = Path(tmp_dir)
+            info = make_sphere_info()
+            fwd = make_surface_forward(info, tmp_dir)
+            cov = mne.make_ad_hoc_cov(info, verbose=False)
+            epochs = make_random_epochs(info, n_epochs=12)
+
+            labels = [mne.Label(fwd["src"][0]["vertno"], hemi="lh", name="lh", subject="surface")]
+            for hemi, src in zip(["lh", "rh"], fwd["src"]):
+                top = src["vertno"][src["rr"][src["vertno"], 2] > 0.02]
+                labels.append(mne.Label(top, hemi=hemi, name=f"top-{hemi}", subject="surface"))
+            labels.append(labels[1] + labels[2])
+            self.assertTrue((mne.label_sign_flip(labels[0], fwd["src"]) < 0).any())
+
+            for pick_ori in [None, "normal"]:
+
+                inv = mne.minimum_norm.make_inverse_operator(info, fwd, cov, loose=0.2, depth=0.8, verbose=False)
+                stcs = mne.minimum_norm.apply_inverse_epochs(epochs, inv, 1.0 / 9.0, "dSPM", pick_ori=pick_ori,
+                                                             verbose=False)
+
+                for mode in ["mean_flip", "pca_flip", "max", None]:
+
+                    out_dir = apply_inverse_epochs_labels(epochs, inv, labels, tmp_dir / "labels", mode=mode,
+                                                          pick_ori=pick_ori, chunk_size=5)
+                    data, metadata = read_source_mmap(out_dir)
+
+                    if mode is None:
+                        expected = np.array([stc.in_label(labels[0] + labels[2]).data for stc in stcs])
+                    else:
+                        expected = np.array(mne.extract_label_time_course(stcs, labels, inv["src"], mode=mode,
+                                                                          verbose=False))
+                        self.assertEqual(metadata["params"]["labels"], [label.name for label in labels])
+                    np.testing.assert_allclose(data, expected, rtol=1e-5, atol=1e-6 * np.abs(expected).max())
+
+            # Bad epochs are dropped without modifying the epochs
+            epochs = make_lazy_epochs(info)
+            data, _ = read_source_mmap(apply_inverse_epochs_labels(epochs, inv, labels, tmp_dir / "lazy"))
+            self.assertEqual(epochs.drop_log, ((),) * len(epochs.events))
+            self.assertEqual(len(data), len(epochs.copy().drop_bad(verbose=False)))
+
+
+def make_random_epochs(info: mne.Info, n_epochs: int = 30, n_times: int = 20) -> mne.EpochsArray:
+    """ White noise epochs of the channels in `info` """
+
+    rng = np.random.default_rng(0)
+
+    return mne.EpochsArray(rng.standard_normal((n_epochs, info["nchan"], n_times)) * 1e-13, info, tmin=-0.1,
+                           verbose=False)
+
+
+def make_lazy_epochs(info: mne.Info, n_epochs: int = 20, n_times: int = 20) -> mne.Epochs:
+    """ Epochs of white noise which are not preloaded, with artefacts in every fifth epoch rejected by amplitude """
+
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((info["nchan"], n_epochs * n_times)) * 1e-13
+    events = np.c_[np.arange(n_epochs) * n_times + 10, np.zeros(n_epochs, dtype=int), np.ones(n_epochs, dtype=int)]
+    data[0, events[::5, 0]] = 1e-10
+
+    return mne.Epochs(mne.io.RawArray(data, info, verbose=False), events, tmin=-0.1, tmax=0.09, baseline=None,
+                      reject={"mag": 1e-11}, preload=False, verbose=False)
+
+
+def make_surface_forward(info: mne.Info, subjects_dir: Path, subject: str = "surface") -> mne.Forward:
+    """ Forward solution of `make_surface_source_space` in a spherical head model """
+
+    src = make_surface_source_space(subjects_dir, subject)
+    sphere = mne.make_sphere_model(r0=(0.0, 0.0, 0.0), head_radius=0.09, verbose=False)
+
+    return mne.make_forward_solution(info, mne.transforms.Transform("head", "mri"), src, sphere, verbose=False)
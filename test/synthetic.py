@@ -0,0 +1,55 @@
+import os
+from pathlib import Path
+
+import mne
+import numpy as np
+
+
+########################################################################################################################
+# Synthetic subjects and sensors shared by the tests                                                                   #
+########################################################################################################################
+
+
+def make_sphere_subject(subjects_dir: Path, subject: str, radius: float = 80.0):
+    """ Subject with a spherical inner skull surface (radius in mm) and spherical white matter surfaces """
+
+    subject_dir = subjects_dir / subject
+    for directory in ["bem", "surf"]:
+        os.makedirs(subject_dir / directory, exist_ok=True)
+
+    ico = mne.surface._get_ico_surface(3)
+    mne.write_surface(subject_dir / "bem" / "inner_skull.surf", ico["rr"] * radius, ico["tris"], overwrite=True)
+
+    ico = mne.surface._get_ico_surface(4)
+    for hemi, offset in [("lh", -25.0), ("rh", 25.0)]:
+        mne.write_surface(subject_dir / "surf" / f"{hemi}.white", ico["rr"] * 40.0 + [offset, 0.0, 0.0],
+                          ico["tris"], overwrite=True)
+        mne.write_surface(subject_dir / "surf" / f"{hemi}.sphere", ico["rr"] * 100.0, ico["tris"], overwrite=True)
+
+
+def make_surface_source_space(subjects_dir: Path, subject: str = "surface") -> mne.SourceSpaces:
+    """ ico3 source spaces on the white matter surfaces of `make_sphere_subject` (radius 4 cm) """
+
+    make_sphere_subject(subjects_dir, subject)
+
+    return mne.setup_source_space(subject, spacing="ico3", subjects_dir=subjects_dir, add_dist=False, verbose=False)
+
+
+def make_sphere_info(n_channels: int = 32, sfreq: float = 100.0) -> mne.Info:
+    """ Magnetometers on the upper half of a sphere of 12 cm radius, head and device coordinates are the same """
+
+    rng = np.random.default_rng(0)
+    positions = rng.standard_normal((n_channels, 3))
+    positions[:, 2] = np.abs(positions[:, 2])
+    positions /= np.linalg.norm(positions, axis=1, keepdims=True)
+
+    info = mne.create_info([f"MEG{idx:03d}" for idx in range(n_channels)], sfreq, "mag")
+    for ch, ez in zip(info["chs"], positions):
+        ex = np.cross([0.0, 1.0, 0.0], ez)
+        ex /= np.linalg.norm(ex)
+        ch["loc"][:3] = 0.12 * ez
+        ch["loc"][3:12] = np.concatenate([ex, np.cross(ez, ex), ez])
+    with info._unlock():
+        info["dev_head_t"] = mne.transforms.Transform("meg", "head")
+
+    return info